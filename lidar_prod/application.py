@@ -1,22 +1,40 @@
 import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from itertools import repeat
 from tempfile import TemporaryDirectory
-from typing import Callable
+from typing import Callable, Iterator, List, Optional, Tuple
 
 import hydra
 from omegaconf import DictConfig
 
 from lidar_prod.commons import commons
+from lidar_prod.commons.result_cache import (
+    ResultCache,
+    get_cache_key,
+    hash_config_sections,
+)
 from lidar_prod.tasks.basic_identification import BasicIdentifier
+from lidar_prod.tasks.bd_uni_client import BDUniClient
+from lidar_prod.tasks.bd_uni_prefetch import (
+    BDUniPrefetch,
+    prefetch_bd_uni_buildings,
+    set_prefetched_buildings,
+)
 from lidar_prod.tasks.building_completion import BuildingCompletor
 from lidar_prod.tasks.building_identification import BuildingIdentifier
 from lidar_prod.tasks.building_validation import BuildingValidator
 from lidar_prod.tasks.cleaning import Cleaner
+from lidar_prod.tasks.clustering import TileSpatialIndex
 from lidar_prod.tasks.utils import (
     BDUniConnectionParams,
+    IncrementalPipeline,
     get_integer_bbox,
     get_las_data_from_las,
     get_pipeline,
+    pdal_read_las_array,
     request_bd_uni_for_building_shapefile,
     save_las_data_to_las,
 )
@@ -24,20 +42,292 @@ from lidar_prod.tasks.utils import (
 log = logging.getLogger(__name__)
 
 
+# Config sections that determine the output of each task. They are part of the key of cached
+# results, along with the content of the input file.
+TASKS_CONFIG_SECTIONS = {
+    "apply_building_module": [
+        "building_validation.application",
+        "building_completion",
+        "building_identification",
+        "data_format",
+    ],
+    "identify_vegetation_unclassified": ["basic_identification", "data_format"],
+    "just_clean": ["data_format"],
+}
+
+# Config values of these sections that only change how results are computed (e.g. threads, local
+# caches of inputs), not the results. They are not part of the key of cached results.
+EXECUTION_CONFIG_KEYS = [
+    "building_validation.application.cluster.n_threads",
+    "building_validation.application.overlay.n_threads",
+    "building_validation.application.bd_uni_request.cache",
+    "building_validation.application.bd_uni_request.prefetch",
+    "building_completion.cluster.n_threads",
+    "building_identification.cluster.n_threads",
+]
+
+
+# Subdirectory of the output directory where cached results are written until they are complete.
+PARTIAL_RESULTS_DIRNAME = ".partial"
+
+# Tasks that request BD Uni buildings for each tile, which can be prefetched for all tiles.
+BD_UNI_TASKS = ["apply_building_module"]
+
+
+@dataclass
+class TileResult:
+    """Outcome of the processing of a tile by `apply`."""
+
+    error: Optional[str] = None  # error message, if processing failed
+    cache_key: Optional[str] = None  # key of the result, if results are cached
+    skipped: bool = False  # True if the result was already up to date in cache
+
+
 @commons.eval_time
 def apply(config: DictConfig, logic: Callable):
-    applied_file_list = []
-    for src_las_path in get_list_las_path_from_src(config.paths.src_las):
-        target_las_path = os.path.join(config.paths.output_dir, os.path.basename(src_las_path))
-        logic(config, src_las_path, target_las_path)
-        applied_file_list.append(target_las_path)
+    """Apply a logic to each LAS found in `config.paths.src_las`.
+
+    Tiles are processed sequentially in the main process, or over a pool of
+    `config.application.n_workers` processes. In the latter case, `logic` must be a
+    module-level function so that it can be sent to the workers.
+
+    Each tile is processed in isolation, so that a failure on a tile, or the death of the worker
+    process of a tile (see `apply_on_tiles_in_pool`), does not stop the batch.
+    Failed tiles are logged, and an error listing them is raised at the end of the batch unless
+    `config.application.ignore_failures` is true.
+
+    If `config.application.cache.enabled`, tiles whose output was already produced from the same
+    input content and config are skipped (see `ResultCache`).
+
+    Returns:
+        list: target paths of the successfully processed tiles, in the order of the source files.
+
+    """
+    src_las_paths = get_list_las_path_from_src(config.paths.src_las)
+    target_las_paths = [
+        os.path.join(config.paths.output_dir, os.path.basename(src_las_path))
+        for src_las_path in src_las_paths
+    ]
+    cache, config_hash = get_result_cache(config, logic)
+    cached_keys = [
+        cache.get_key(target_las_path) if cache else None for target_las_path in target_las_paths
+    ]
+
+    prefetched_buildings = None
+    if logic.__name__ in BD_UNI_TASKS:
+        prefetched_buildings = prefetch_bd_uni_buildings_for_tiles(config, src_las_paths)
+
+    n_workers = min(config.application.n_workers, len(src_las_paths))
+    tile_args = (
+        repeat(config),
+        repeat(logic),
+        src_las_paths,
+        target_las_paths,
+        repeat(config_hash),
+        cached_keys,
+    )
+    results = []
+    set_prefetched_buildings(prefetched_buildings)
+    try:
+        if n_workers > 1:
+            log.info(f"Processing {len(src_las_paths)} tiles with {n_workers} workers")
+            tile_results = apply_on_tiles_in_pool(
+                list(zip(*tile_args)), n_workers, prefetched_buildings
+            )
+        else:
+            tile_results = map(apply_on_tile, *tile_args)
+        # Results are recorded in cache as soon as they are available, to survive a crash.
+        for target_las_path, result in zip(target_las_paths, tile_results):
+            if cache and result.cache_key:
+                cache.record(target_las_path, result.cache_key)
+            results.append(result)
+    finally:
+        set_prefetched_buildings(None)
+
+    failed_src_las_paths = [
+        src_las_path for src_las_path, result in zip(src_las_paths, results) if result.error
+    ]
+    if failed_src_las_paths and not config.application.ignore_failures:
+        raise RuntimeError(
+            f"{len(failed_src_las_paths)} tile(s) out of {len(src_las_paths)} failed: "
+            + ", ".join(failed_src_las_paths)
+        )
+    n_skipped = sum(result.skipped for result in results)
+    if n_skipped:
+        log.info(f"{n_skipped} tile(s) out of {len(src_las_paths)} were already up to date")
+
+    applied_file_list = [
+        target_las_path
+        for target_las_path, result in zip(target_las_paths, results)
+        if not result.error
+    ]
     return applied_file_list
 
 
+def _get_tile_pool(n_workers: int, prefetched_buildings: Optional[BDUniPrefetch]):
+    return ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=set_prefetched_buildings,
+        initargs=(prefetched_buildings,),
+    )
+
+
+def apply_on_tiles_in_pool(
+    tiles_args: List[tuple], n_workers: int, prefetched_buildings: Optional[BDUniPrefetch] = None
+) -> Iterator[TileResult]:
+    """Apply `apply_on_tile` to tiles over a pool of processes, yielding results in tile order.
+
+    Errors raised by the logic are caught by `apply_on_tile`, but a worker process that dies
+    (e.g. killed by the OOM killer, or a crash of a library) breaks the whole pool. The tile whose
+    result is awaited is then run alone in a new process: it fails if its worker dies again, so
+    that a tile is not blamed for the crash of another one. The pool is then rebuilt for the
+    remaining tiles, keeping the results that were obtained before the crash.
+
+    Args:
+        tiles_args (List[tuple]): arguments of `apply_on_tile` for each tile
+        n_workers (int): number of worker processes
+        prefetched_buildings (Optional[BDUniPrefetch]): BD Uni buildings shared with workers.
+
+    """
+    results = {}
+    next_idx = 0
+    while next_idx < len(tiles_args):
+        with _get_tile_pool(n_workers, prefetched_buildings) as executor:
+            futures = {
+                idx: executor.submit(apply_on_tile, *tiles_args[idx])
+                for idx in range(next_idx, len(tiles_args))
+                if idx not in results
+            }
+            try:
+                while next_idx < len(tiles_args):
+                    if next_idx not in results:
+                        results[next_idx] = futures[next_idx].result()
+                    yield results.pop(next_idx)
+                    next_idx += 1
+            except BrokenProcessPool:
+                for idx, future in futures.items():
+                    if future.done() and future.exception() is None:
+                        results[idx] = future.result()
+        if next_idx < len(tiles_args):
+            log.error("A worker process died: running the awaited tile alone.")
+            yield _apply_on_tile_in_isolation(tiles_args[next_idx], prefetched_buildings)
+            next_idx += 1
+
+
+def _apply_on_tile_in_isolation(
+    tile_args: tuple, prefetched_buildings: Optional[BDUniPrefetch]
+) -> TileResult:
+    """Apply `apply_on_tile` to a tile in a process of its own, which may die."""
+    with _get_tile_pool(1, prefetched_buildings) as executor:
+        try:
+            return executor.submit(apply_on_tile, *tile_args).result()
+        except BrokenProcessPool as e:
+            src_las_path = tile_args[2]
+            log.error(f"Failed to process {src_las_path}: its worker process died.")
+            return TileResult(error=f"{type(e).__name__}: {e}")
+
+
+def apply_on_tile(
+    config: DictConfig,
+    logic: Callable,
+    src_las_path: str,
+    target_las_path: str,
+    config_hash: Optional[str] = None,
+    cached_key: Optional[str] = None,
+) -> TileResult:
+    """Apply a logic to a single tile, catching any error to isolate the tile from the batch.
+
+    When results are cached, the logic writes its result in `PARTIAL_RESULTS_DIRNAME`, which
+    replaces the target once complete: a failure does not leave an incomplete target, that a
+    later run could take for the result of the key recorded for the target.
+
+    Args:
+        config_hash (Optional[str]): hash of the config used by the logic, if results are cached.
+        cached_key (Optional[str]): key of the result already in cache for this tile, if any.
+
+    """
+    cache_key = None
+    try:
+        if config_hash:
+            cache_key = get_cache_key(src_las_path, config_hash)
+            if cache_key == cached_key:
+                log.info(f"Skipping {src_las_path}: {target_las_path} is up to date.")
+                return TileResult(cache_key=cache_key, skipped=True)
+            partial_las_path = get_partial_result_path(target_las_path)
+            logic(config, src_las_path, partial_las_path)
+            if os.path.exists(partial_las_path):
+                os.replace(partial_las_path, target_las_path)
+        else:
+            logic(config, src_las_path, target_las_path)
+    except Exception as e:
+        log.exception(f"Failed to process {src_las_path}")
+        return TileResult(error=f"{type(e).__name__}: {e}")
+    return TileResult(cache_key=cache_key)
+
+
+def prefetch_bd_uni_buildings_for_tiles(
+    config: DictConfig, src_las_paths: List[str]
+) -> Optional[BDUniPrefetch]:
+    """Prefetch the BD Uni buildings of all tiles at once, if enabled and if the buildings are not
+    read from a shapefile. Returns None otherwise."""
+    bv_cfg = config.building_validation.application
+    if not bv_cfg.bd_uni_request.prefetch.enabled or bv_cfg.shp_path:
+        return None
+    return prefetch_bd_uni_buildings(
+        BDUniClient(hydra.utils.instantiate(config.bd_uni_connection_params)),
+        src_las_paths,
+        config.data_format.epsg,
+        buffer=bv_cfg.bd_uni_request.buffer,
+        max_envelope_size=bv_cfg.bd_uni_request.prefetch.max_envelope_size,
+    )
+
+
+def get_partial_result_path(target_las_path: str) -> str:
+    """Path of a result until it is complete, with the same name as the target."""
+    partial_dir = os.path.join(os.path.dirname(target_las_path), PARTIAL_RESULTS_DIRNAME)
+    os.makedirs(partial_dir, exist_ok=True)
+    return os.path.join(partial_dir, os.path.basename(target_las_path))
+
+
+def get_result_cache(
+    config: DictConfig, logic: Callable
+) -> Tuple[Optional[ResultCache], Optional[str]]:
+    """Get the cache of results in the output directory, and the hash of the config sections
+    that the logic depends on. Returns (None, None) if results are not cached."""
+    if not config.application.cache.enabled:
+        return None, None
+    sections = TASKS_CONFIG_SECTIONS.get(logic.__name__)
+    if sections is None:
+        log.warning(f"Results of {logic.__name__} cannot be cached: processing every tile.")
+        return None, None
+    cache = ResultCache(config.paths.output_dir, config.application.cache.manifest_filename)
+    config_hash = hash_config_sections(config, sections, EXECUTION_CONFIG_KEYS)
+    config_hash = f"{logic.__name__}-{config_hash}"
+    return cache, config_hash
+
+
+def invalidate_cache(config: DictConfig):
+    """Invalidate cached results in `config.paths.output_dir`, so that they are computed again.
+
+    Only the results of the tiles in `config.paths.src_las` are invalidated if it exists,
+    otherwise every result is. Entries whose output file was deleted are always evicted.
+
+    """
+    cache = ResultCache(config.paths.output_dir, config.application.cache.manifest_filename)
+    cache.evict_stale()
+    if os.path.exists(config.paths.src_las):
+        cache.invalidate(
+            os.path.basename(src_las_path)
+            for src_las_path in get_list_las_path_from_src(config.paths.src_las)
+        )
+    else:
+        cache.invalidate()
+
+
 def get_list_las_path_from_src(src_path: str):
     """get a list of las from a path.
     If the path is a single file, that file will be the only one in the returned list
-    if the path is a directory, all the .las will be in the returned list"""
+    if the path is a directory, all the .las will be in the returned list, sorted by name"""
     # src_path is a unique file
     if os.path.isfile(src_path):
         return [src_path]
@@ -46,8 +336,8 @@ def get_list_las_path_from_src(src_path: str):
     src_las_path = []
     for path in os.scandir(src_path):
         if os.path.isfile(path) and os.path.splitext(path)[1] in [".las", ".laz"]:
-            src_las_path.append(os.path.join(src_path, path))
-    return src_las_path
+            src_las_path.append(path.path)
+    return sorted(src_las_path)
 
 
 @commons.eval_time
@@ -109,6 +399,9 @@ def apply_building_module(config: DictConfig, src_las_path: str, dest_las_path:
         dest_las_path: the path to save the result (optional)
     """
     log.info(f"Processing {src_las_path}")
+    if config.application.in_memory:
+        return apply_building_module_in_memory(config, src_las_path, dest_las_path)
+
     with TemporaryDirectory() as td:
         # Temporary LAS file for intermediary results.
         tmp_las_path = os.path.join(td, os.path.basename(src_las_path))
@@ -117,28 +410,23 @@ def apply_building_module(config: DictConfig, src_las_path: str, dest_las_path:
         cl: Cleaner = hydra.utils.instantiate(config.data_format.cleaning.input_building)
         cl.run(src_las_path, tmp_las_path, config.data_format.epsg)
 
+        # Spatial index of the points of the tile, shared by the clusterings of the next steps.
+        spatial_index = get_tile_spatial_index(config)
+
         # Validate buildings (unsure/confirmed/refuted) on a per-group basis.
-        bd_uni_connection_params: BDUniConnectionParams = hydra.utils.instantiate(
-            config.bd_uni_connection_params
-        )
-        bv_cfg = config.building_validation.application
-        bv = BuildingValidator(
-            shp_path=bv_cfg.shp_path,
-            bd_uni_connection_params=bd_uni_connection_params,
-            cluster=bv_cfg.cluster,
-            bd_uni_request=bv_cfg.bd_uni_request,
-            data_format=bv_cfg.data_format,
-            thresholds=bv_cfg.thresholds,
-            use_final_classification_codes=bv_cfg.use_final_classification_codes,
-        )
+        bv = get_building_validator(config, spatial_index)
         las_metadata = bv.run(tmp_las_path)
 
         # Complete buildings with non-candidates that were nevertheless confirmed
-        bc: BuildingCompletor = hydra.utils.instantiate(config.building_completion)
+        bc: BuildingCompletor = hydra.utils.instantiate(
+            config.building_completion, spatial_index=spatial_index
+        )
         las_metadata = bc.run(bv.pipeline, las_metadata)
 
         # Define groups of confirmed building points among non-candidates
-        bi: BuildingIdentifier = hydra.utils.instantiate(config.building_identification)
+        bi: BuildingIdentifier = hydra.utils.instantiate(
+            config.building_identification, spatial_index=spatial_index
+        )
         bi.run(bc.pipeline, tmp_las_path, las_metadata=las_metadata)
 
         # Remove unnecessary intermediary dimensions
@@ -148,6 +436,81 @@ def apply_building_module(config: DictConfig, src_las_path: str, dest_las_path:
     return dest_las_path
 
 
+def apply_building_module_in_memory(
+    config: DictConfig, src_las_path: str, dest_las_path: str = None
+):
+    """Same steps as `apply_building_module`, run on a single in-memory array of points.
+
+    The source LAS is read once and the destination LAS written once: there is no intermediary
+    LAS, and dimensions are removed from the array of points instead of from LAS files.
+
+    Args:
+        src_las_path: the path of the source las
+        dest_las_path: the path to save the result (optional)
+    """
+    points, las_metadata = pdal_read_las_array(src_las_path, config.data_format.epsg)
+
+    # Removes unnecessary input dimensions to reduce memory usage
+    cl: Cleaner = hydra.utils.instantiate(config.data_format.cleaning.input_building)
+    points = cl.remove_dimensions_from_array(points)
+
+    # Spatial index of the points of the tile, shared by the clusterings of the next steps.
+    spatial_index = get_tile_spatial_index(config)
+
+    # Validate buildings (unsure/confirmed/refuted) on a per-group basis.
+    bv = get_building_validator(config, spatial_index)
+    las_metadata = bv.run(IncrementalPipeline([points]), las_metadata=las_metadata)
+
+    # Complete buildings with non-candidates that were nevertheless confirmed
+    bc: BuildingCompletor = hydra.utils.instantiate(
+        config.building_completion, spatial_index=spatial_index
+    )
+    las_metadata = bc.run(bv.pipeline, las_metadata)
+
+    # Define groups of confirmed building points among non-candidates
+    bi: BuildingIdentifier = hydra.utils.instantiate(
+        config.building_identification, spatial_index=spatial_index
+    )
+    las_metadata = bi.run(bc.pipeline, las_metadata=las_metadata)
+
+    # Save, keeping only the necessary dimensions
+    if dest_las_path:
+        cl: Cleaner = hydra.utils.instantiate(config.data_format.cleaning.output_building)
+        cl.save(bi.pipeline.arrays[0], dest_las_path, las_metadata)
+
+    return dest_las_path
+
+
+def get_building_validator(
+    config: DictConfig, spatial_index: TileSpatialIndex = None
+) -> BuildingValidator:
+    """Instantiate a BuildingValidator for application, from the hydra config."""
+    bd_uni_connection_params: BDUniConnectionParams = hydra.utils.instantiate(
+        config.bd_uni_connection_params
+    )
+    bv_cfg = config.building_validation.application
+    return BuildingValidator(
+        shp_path=bv_cfg.shp_path,
+        bd_uni_connection_params=bd_uni_connection_params,
+        cluster=bv_cfg.cluster,
+        bd_uni_request=bv_cfg.bd_uni_request,
+        data_format=bv_cfg.data_format,
+        thresholds=bv_cfg.thresholds,
+        use_final_classification_codes=bv_cfg.use_final_classification_codes,
+        overlay=bv_cfg.overlay,
+        spatial_index=spatial_index,
+    )
+
+
+def get_tile_spatial_index(config: DictConfig) -> TileSpatialIndex:
+    """Spatial index for the points of a tile, built by the first clustering that uses it (i.e.
+    with the grid engine)."""
+    return TileSpatialIndex(
+        cell_size=config.application.spatial_index.cell_size,
+        resolution=config.application.spatial_index.resolution,
+    )
+
+
 @commons.eval_time
 def get_shapefile(config: DictConfig, src_las_path: str, dest_las_path: str):
     """save a shapefile for the las in the destination path
@@ -1,3 +1,4 @@
+import functools
 import logging
 import time
 import warnings
@@ -55,6 +56,9 @@ def print_config(
 def eval_time(function: Callable):
     """decorator to log the duration of the decorated method"""
 
+    # wraps keeps the name of the decorated function, so that it can be pickled by reference
+    # and sent to worker processes.
+    @functools.wraps(function)
     def timed(*args, **kwargs):
         log = logging.getLogger(__name__)
         time_start = time.time()
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import logging
+import os
+import os.path as osp
+from typing import Dict, Iterable, List, Optional
+
+from omegaconf import DictConfig, OmegaConf
+
+log = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 2**20  # bytes
+
+
+def hash_file_content(file_path: str) -> str:
+    """sha256 of the content of a file, read by blocks to bound memory usage."""
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def hash_config_sections(
+    config: DictConfig, sections: Iterable[str], ignored_keys: Iterable[str] = ()
+) -> str:
+    """sha256 of the resolved content of some sections of a config.
+
+    Args:
+        config (DictConfig): hydra config
+        sections (Iterable[str]): dotted keys of the sections to hash
+        (e.g. "building_validation.application")
+        ignored_keys (Iterable[str]): dotted keys of values that are not hashed, e.g. execution
+        parameters that do not change results (e.g. "building_completion.cluster.n_threads")
+
+    """
+    content = {}
+    for section in sections:
+        value = OmegaConf.select(config, section)
+        if isinstance(value, DictConfig) or OmegaConf.is_list(value):
+            value = OmegaConf.to_container(value, resolve=True)
+        content[section] = value
+    for ignored_key in ignored_keys:
+        for section in content:
+            if not ignored_key.startswith(section + "."):
+                continue
+            *parents, name = ignored_key[len(section) + 1 :].split(".")
+            node = content[section]
+            for parent in parents:
+                node = node.get(parent) if isinstance(node, dict) else None
+            if isinstance(node, dict):
+                node.pop(name, None)
+    serialized = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def get_cache_key(src_las_path: str, config_hash: str) -> str:
+    """Key of a result: depends on the content of the input file and on the config hash."""
+    key = hashlib.sha256()
+    key.update(hash_file_content(src_las_path).encode("utf-8"))
+    key.update(config_hash.encode("utf-8"))
+    return key.hexdigest()
+
+
+class ResultCache:
+    """Manifest of the results already produced in an output directory.
+
+    Each result (i.e. target file) is associated to a key computed from the content of its
+    input file and from the config used to produce it. A result whose key did not change does
+    not need to be computed again.
+
+    The manifest is an append-only file of json lines, so that results can be recorded as soon
+    as they are produced and survive a crash of the batch. The last line of a target wins.
+
+    """
+
+    def __init__(self, output_dir: str, manifest_filename: str):
+        self.output_dir = output_dir
+        self.manifest_path = osp.join(output_dir, manifest_filename)
+        self.entries: Dict[str, str] = self._load()
+
+    def _load(self) -> Dict[str, str]:
+        entries = {}
+        if not osp.isfile(self.manifest_path):
+            return entries
+        with open(self.manifest_path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                entries[entry["target"]] = entry["key"]
+        return entries
+
+    def _append(self, target: str, key: str):
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(self.manifest_path, "a") as f:
+            f.write(json.dumps({"target": target, "key": key}) + "\n")
+
+    def _rewrite(self):
+        """Compact the manifest, keeping only current entries."""
+        tmp_manifest_path = self.manifest_path + ".tmp"
+        with open(tmp_manifest_path, "w") as f:
+            for target, key in self.entries.items():
+                f.write(json.dumps({"target": target, "key": key}) + "\n")
+        os.replace(tmp_manifest_path, self.manifest_path)
+
+    def get_key(self, target_path: str) -> Optional[str]:
+        """Key recorded for a target, or None if its target file does not exist anymore."""
+        target = osp.basename(target_path)
+        if not osp.exists(osp.join(self.output_dir, target)):
+            return None
+        return self.entries.get(target)
+
+    def record(self, target_path: str, key: str):
+        """Record the key of a result that was just produced."""
+        target = osp.basename(target_path)
+        if self.entries.get(target) == key:
+            return
+        self.entries[target] = key
+        self._append(target, key)
+
+    def invalidate(self, target_paths: Optional[Iterable[str]] = None) -> List[str]:
+        """Remove entries from the manifest, so that their results are computed again.
+
+        Args:
+            target_paths (Optional[Iterable[str]]): targets to invalidate. All targets if None.
+
+        Returns:
+            List[str]: invalidated targets.
+
+        """
+        if target_paths is None:
+            invalidated = list(self.entries)
+        else:
+            invalidated = [
+                osp.basename(p) for p in target_paths if osp.basename(p) in self.entries
+            ]
+        for target in invalidated:
+            del self.entries[target]
+        if invalidated and osp.isfile(self.manifest_path):
+            self._rewrite()
+        log.info(f"Invalidated {len(invalidated)} cached result(s) in {self.manifest_path}")
+        return invalidated
+
+    def evict_stale(self) -> List[str]:
+        """Remove the entries whose target file does not exist anymore.
+
+        Returns:
+            List[str]: evicted targets.
+
+        """
+        stale = [
+            target for target in self.entries if not osp.exists(osp.join(self.output_dir, target))
+        ]
+        return self.invalidate(stale)
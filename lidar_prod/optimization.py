@@ -56,6 +56,7 @@ def optimize_vegetation(
         data_format["las_dimensions"]["classification"],
         config["basic_identification"]["vegetation_nb_trials"],
         list(data_format["codes"]["vegetation_target"].values()),
+        threshold_sweep=config["basic_identification"].get("threshold_sweep", False),
     )
     vegetation_identification_optimiser.optimize()
 
@@ -72,5 +73,6 @@ def optimize_unclassified(
         data_format["codes"]["unclassified"],
         data_format["las_dimensions"]["classification"],
         config["basic_identification"]["unclassified_nb_trials"],
+        threshold_sweep=config["basic_identification"].get("threshold_sweep", False),
     )
     unclassified_identification_optimiser.optimize()
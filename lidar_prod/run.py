@@ -15,6 +15,7 @@ class POSSIBLE_TASK(Enum):
     APPLY_BUILDING = "apply_on_building"
     OPT_BUIlDING = "optimize_building"
     GET_SHAPEFILE = "get_shapefile"
+    INVALIDATE_CACHE = "invalidate_cache"
 
 
 @hydra.main(config_path="../configs/", config_name="config.yaml")
@@ -32,6 +33,7 @@ def main(config: DictConfig):  # pragma: no cover
         apply_building_module,
         get_shapefile,
         identify_vegetation_unclassified,
+        invalidate_cache,
         just_clean,
     )
     from lidar_prod.commons.commons import extras
@@ -66,6 +68,9 @@ def main(config: DictConfig):  # pragma: no cover
     elif config.get("task") == POSSIBLE_TASK.GET_SHAPEFILE.value:
         apply(config, get_shapefile)
 
+    elif config.get("task") == POSSIBLE_TASK.INVALIDATE_CACHE.value:
+        invalidate_cache(config)
+
     else:
         log.info("Starting applying the default process")
         apply(config, apply_building_module)
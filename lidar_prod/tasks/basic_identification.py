@@ -65,6 +65,14 @@ class IoU:
         return IoU(true_positive, false_negative, false_positive)
 
 
+def get_target_mask(target_values: np.ndarray, target_result_code: Union[int, list]):
+    """return the mask of the points whose target value is (one of) the target result code(s)"""
+    if isinstance(target_result_code, int):
+        return target_values == target_result_code
+    # if not an int, target_result_code should be a list
+    return np.isin(target_values, target_result_code)
+
+
 class BasicIdentifier:
     def __init__(
         self,
@@ -115,10 +123,9 @@ class BasicIdentifier:
 
         # calculate ious if necessary
         if self.evaluate_iou:
-            if isinstance(self.target_result_code, int):
-                target_mask = las_data.points[self.target_column] == self.target_result_code
-            else:  # if not an int, truth_mask should be a list
-                target_mask = np.isin(las_data.points[self.target_column], self.target_result_code)
+            target_mask = get_target_mask(
+                las_data.points[self.target_column], self.target_result_code
+            )
             self.iou = IoU.iou_by_mask(threshold_mask, target_mask)
 
         # MONKEY PATCHING !!! for debugging
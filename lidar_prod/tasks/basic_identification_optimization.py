@@ -1,16 +1,100 @@
 import logging
-from typing import Union
+from typing import Tuple, Union
 
+import numpy as np
 import optuna
 from omegaconf import DictConfig
 
 from lidar_prod.application import get_list_las_path_from_src
-from lidar_prod.tasks.basic_identification import BasicIdentifier, IoU
+from lidar_prod.tasks.basic_identification import BasicIdentifier, IoU, get_target_mask
 from lidar_prod.tasks.utils import get_las_data_from_las
 
 log = logging.getLogger(__name__)
 
 
+class IoUSweep:
+    """IoU of the points above a threshold, for all the candidate thresholds at once.
+
+    The points above a threshold only change when the threshold crosses the probability of a
+    point, so the IoU as a function of the threshold is fully determined by the number of target
+    and non-target points of each probability. These counts are accumulated tile by tile, and the
+    true and false positives of all thresholds are then cumulative counts from the highest
+    probability down. Candidate thresholds are all the distinct probabilities of the points, so
+    that the best threshold is exact instead of sampled.
+    """
+
+    def __init__(self):
+        self.probabilities = np.empty(0)
+        self.target_counts = np.empty(0, dtype=np.int64)
+        self.other_counts = np.empty(0, dtype=np.int64)
+
+    def add(self, probabilities: np.ndarray, target_mask: np.ndarray):
+        """Count the target and non-target points of each probability, e.g. of a tile.
+
+        Args:
+            probabilities (np.ndarray): probability of each point
+            target_mask (np.ndarray): True for target points
+
+        """
+        target_mask = np.asarray(target_mask, dtype=bool)
+        values, inverse = np.unique(
+            np.concatenate([self.probabilities, probabilities]), return_inverse=True
+        )
+        previous_idx = inverse[: len(self.probabilities)]
+        new_idx = inverse[len(self.probabilities) :]
+        target_counts = np.bincount(new_idx[target_mask], minlength=len(values))
+        other_counts = np.bincount(new_idx[~target_mask], minlength=len(values))
+        # Previous probabilities are distinct, so that their counts are added without collision.
+        target_counts[previous_idx] += self.target_counts
+        other_counts[previous_idx] += self.other_counts
+        self.probabilities = values
+        self.target_counts = target_counts
+        self.other_counts = other_counts
+
+    def get_counts(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """True positives, false negatives and false positives of each candidate threshold.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: increasing thresholds, and
+            their counts of true positives, false negatives and false positives.
+
+        """
+        true_positives = np.cumsum(self.target_counts[::-1])[::-1]
+        false_positives = np.cumsum(self.other_counts[::-1])[::-1]
+        false_negatives = self.target_counts.sum() - true_positives
+        return self.probabilities, true_positives, false_negatives, false_positives
+
+    def get_iou_curve(self) -> Tuple[np.ndarray, np.ndarray]:
+        """IoU of each candidate threshold, with the same values as `IoU`.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: increasing thresholds, and their IoU.
+
+        """
+        thresholds, true_positives, false_negatives, false_positives = self.get_counts()
+        union = true_positives + false_negatives + false_positives
+        ious = np.ones(len(thresholds))
+        np.divide(true_positives, union, out=ious, where=union > 0)
+        return thresholds, ious
+
+    def get_best_threshold(self) -> Tuple[float, IoU]:
+        """Lowest threshold with the best IoU.
+
+        Returns:
+            Tuple[float, IoU]: best threshold, and its IoU.
+
+        """
+        if not len(self.probabilities):
+            raise ValueError("Cannot search a threshold without any point.")
+        thresholds, ious = self.get_iou_curve()
+        best = int(np.argmax(ious))
+        _, true_positives, false_negatives, false_positives = self.get_counts()
+        iou = IoU(
+            int(true_positives[best]), int(false_negatives[best]), int(false_positives[best])
+        )
+        return float(thresholds[best]), iou
+
+
 class BasicIdentifierOptimizer:
     def __init__(
         self,
@@ -21,6 +105,7 @@ class BasicIdentifierOptimizer:
         target_column: str,
         n_trials: int,
         target_result_code: Union[int, list] = None,
+        threshold_sweep: bool = False,
     ) -> None:
         """
         Search the best threshold for BasicIdentifier
@@ -35,6 +120,8 @@ class BasicIdentifierOptimizer:
             target_result_code: the code(s) defining the points with the target results.
                 Can be an int of a list of int, if we want an IoU but
                 target_result_code is not provided then result_code is used instead.
+            threshold_sweep: True to search the exact best threshold with an `IoUSweep`, which
+                reads each .las once, instead of running n_trials optuna trials.
         """
 
         self.study = optuna.create_study(
@@ -47,13 +134,36 @@ class BasicIdentifierOptimizer:
         self.truth_column = target_column
         self.n_trials = n_trials
         self.truth_result_code = target_result_code if target_result_code else result_code
+        self.threshold_sweep = threshold_sweep
 
     def optimize(self) -> None:
         """Search the best threshold."""
+        if self.threshold_sweep:
+            self.sweep()
+            print(f"    min_threshold_proba: {self.best_threshold}")
+            print(f"    {self.best_iou}")
+            return
         self.study.optimize(self._optuna_objective_func, self.n_trials)
         for key, value in self.study.best_trial.params.items():
             print(f"    {key}: {value}")
 
+    def sweep(self) -> IoUSweep:
+        """Search the exact best threshold, reading each .las once.
+
+        The best threshold and its IoU are stored as `best_threshold` and `best_iou`, and the
+        IoU of all the candidate thresholds as `iou_curve` (see `IoUSweep.get_iou_curve`).
+        """
+        iou_sweep = IoUSweep()
+        for src_las_path in get_list_las_path_from_src(self.config.paths.src_las):
+            points = get_las_data_from_las(src_las_path).points
+            iou_sweep.add(
+                np.asarray(points[self.proba_column]),
+                get_target_mask(np.asarray(points[self.truth_column]), self.truth_result_code),
+            )
+        self.best_threshold, self.best_iou = iou_sweep.get_best_threshold()
+        self.iou_curve = iou_sweep.get_iou_curve()
+        return iou_sweep
+
     def _optuna_objective_func(self, trial) -> IoU:
         """Get the best IoU"""
         threshold = trial.suggest_float("min_threshold_proba", 0.0, 1.0)
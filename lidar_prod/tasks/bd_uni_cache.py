@@ -0,0 +1,285 @@
+import hashlib
+import logging
+import math
+import os
+import os.path as osp
+import sqlite3
+import time
+from contextlib import closing
+from typing import Dict, List, Tuple
+
+import geopandas
+import shapely
+
+from lidar_prod.tasks.bd_uni_client import PRESENCE_COLUMN, BDUniClient
+from lidar_prod.tasks.utils import get_srid_from_epsg
+
+log = logging.getLogger(__name__)
+
+Cell = Tuple[int, int]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cells (
+    srid TEXT NOT NULL,
+    cell_x INTEGER NOT NULL,
+    cell_y INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (srid, cell_x, cell_y)
+);
+CREATE TABLE IF NOT EXISTS footprints (
+    id INTEGER PRIMARY KEY,
+    srid TEXT NOT NULL,
+    cell_x INTEGER NOT NULL,
+    cell_y INTEGER NOT NULL,
+    wkb_hash TEXT NOT NULL,
+    wkb BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS footprints_cell ON footprints (srid, cell_x, cell_y);
+CREATE VIRTUAL TABLE IF NOT EXISTS footprints_rtree USING rtree (
+    id, min_x, max_x, min_y, max_y
+);
+"""
+
+
+class BDUniFootprintCache:
+    """Local cache of the building footprints of the BD Uni.
+
+    Adjacent tiles request mostly the same buildings, because requests are buffered around
+    tiles. Footprints are thus requested to the BD Uni by cells of a regular grid and stored in a
+    SQLite database with an R-tree index, keyed by srid (i.e. territory) and grid cell.
+    Later requests that fall in cells already fetched are served locally.
+
+    Cells are requested again once older than `ttl`, so that changes to the BD Uni are
+    eventually taken into account. When the database grows above `max_size_mb`, the least
+    recently used cells are evicted.
+
+    The database may be shared by several processes.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        cell_size: float = 1000,
+        ttl: float = 7 * 24 * 3600,
+        max_size_mb: float = 1024,
+    ):
+        """Initialization.
+
+        Args:
+            path (str): path to the SQLite database, created if needed.
+            cell_size (float): size of the cells of the grid, in meters.
+            ttl (float): time to live of a cell, in seconds.
+            max_size_mb (float): size above which least recently used cells are evicted.
+
+        """
+        self.path = path
+        self.cell_size = cell_size
+        self.ttl = ttl
+        self.max_size_mb = max_size_mb
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(osp.dirname(osp.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=120)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        return conn
+
+    def get_buildings(
+        self, client: BDUniClient, bbox: Dict[str, int], epsg: int | str
+    ) -> geopandas.GeoDataFrame:
+        """Drop-in replacement of `BDUniClient.get_buildings`, served from the cache.
+
+        Returns:
+            geopandas.GeoDataFrame: buildings, with a "PRESENCE" column filled with 1 for later
+            use by pdal.
+
+        Raises:
+            ValueError: if the bbox does not intersect any territory with the srid of epsg.
+
+        """
+        epsg_srid = get_srid_from_epsg(epsg)
+        if not client.check_bbox_intersects_territoire(bbox, epsg_srid):
+            raise ValueError(
+                f"The query bbox ({bbox}) does not intersect with any territoire in the database "
+                + f"with the query srid ({epsg_srid}). Please check that you passed the correct "
+                + "srid."
+            )
+
+        footprints = self.get_footprints(client, bbox, epsg_srid)
+        return geopandas.GeoDataFrame(
+            {PRESENCE_COLUMN: [1] * len(footprints)},
+            geometry=shapely.from_wkb(footprints),
+            crs=f"EPSG:{epsg_srid}",
+        )
+
+    def get_footprints(
+        self, client: BDUniClient, bbox: Dict[str, int], epsg_srid: int | str
+    ) -> List[bytes]:
+        """Get the footprints whose bounding box intersects a bbox, as WKB.
+
+        Cells of the bbox that are missing or expired are requested to the BD Uni first.
+
+        """
+        srid = str(epsg_srid)
+        cells = self._get_cells(bbox)
+        now = time.time()
+        with closing(self._connect()) as conn:
+            with conn:
+                fresh_cells = {
+                    (cell_x, cell_y)
+                    for cell_x, cell_y in conn.execute(
+                        "SELECT cell_x, cell_y FROM cells WHERE srid = ? AND fetched_at > ? "
+                        + "AND cell_x BETWEEN ? AND ? AND cell_y BETWEEN ? AND ?",
+                        (srid, now - self.ttl, *self._get_cells_range(bbox)),
+                    )
+                }
+            missing_cells = [cell for cell in cells if cell not in fresh_cells]
+            log.info(
+                f"BD Uni footprints cache: {len(cells) - len(missing_cells)}/{len(cells)} cells "
+                + "served locally"
+            )
+            if missing_cells:
+                self._fetch(conn, client, missing_cells, srid)
+
+            with conn:
+                conn.executemany(
+                    "UPDATE cells SET last_access = ? "
+                    + "WHERE srid = ? AND cell_x = ? AND cell_y = ?",
+                    [(now, srid, *cell) for cell in cells],
+                )
+                # Footprints that span several cells are stored once per cell.
+                footprints = [
+                    wkb
+                    for (wkb,) in conn.execute(
+                        "SELECT MIN(f.wkb) FROM footprints f "
+                        + "JOIN footprints_rtree r ON f.id = r.id "
+                        + "WHERE f.srid = ? "
+                        + "AND f.cell_x BETWEEN ? AND ? AND f.cell_y BETWEEN ? AND ? "
+                        + "AND r.max_x >= ? AND r.min_x <= ? AND r.max_y >= ? AND r.min_y <= ? "
+                        + "GROUP BY f.wkb_hash ORDER BY MIN(f.id)",
+                        (
+                            srid,
+                            *self._get_cells_range(bbox),
+                            bbox["x_min"],
+                            bbox["x_max"],
+                            bbox["y_min"],
+                            bbox["y_max"],
+                        ),
+                    )
+                ]
+            self._evict(conn, now)
+        return footprints
+
+    def _get_cells_range(self, bbox: Dict[str, int]) -> Tuple[int, int, int, int]:
+        return (
+            math.floor(bbox["x_min"] / self.cell_size),
+            math.floor(bbox["x_max"] / self.cell_size),
+            math.floor(bbox["y_min"] / self.cell_size),
+            math.floor(bbox["y_max"] / self.cell_size),
+        )
+
+    def _get_cells(self, bbox: Dict[str, int]) -> List[Cell]:
+        min_cell_x, max_cell_x, min_cell_y, max_cell_y = self._get_cells_range(bbox)
+        return [
+            (cell_x, cell_y)
+            for cell_x in range(min_cell_x, max_cell_x + 1)
+            for cell_y in range(min_cell_y, max_cell_y + 1)
+        ]
+
+    def _get_cell_bbox(self, cell: Cell) -> Dict[str, float]:
+        return {
+            "x_min": cell[0] * self.cell_size,
+            "y_min": cell[1] * self.cell_size,
+            "x_max": (cell[0] + 1) * self.cell_size,
+            "y_max": (cell[1] + 1) * self.cell_size,
+        }
+
+    def _fetch(
+        self,
+        conn: sqlite3.Connection,
+        client: BDUniClient,
+        cells: List[Cell],
+        srid: str,
+    ):
+        """Request the BD Uni for the footprints of some cells, with a single request on
+        their envelope, and store them."""
+        cells_bboxes = [self._get_cell_bbox(cell) for cell in cells]
+        envelope = {
+            "x_min": min(b["x_min"] for b in cells_bboxes),
+            "y_min": min(b["y_min"] for b in cells_bboxes),
+            "x_max": max(b["x_max"] for b in cells_bboxes),
+            "y_max": max(b["y_max"] for b in cells_bboxes),
+        }
+        log.info(f"Request BD Uni for {len(cells)} cells of footprints")
+        gdf = client.fetch_buildings(envelope, srid)
+
+        fetched_at = time.time()
+        with conn:
+            for cell, cell_bbox in zip(cells, cells_bboxes):
+                self._delete_cells(conn, [(srid, *cell)])
+                cell_geometries = gdf.geometry.iloc[
+                    gdf.sindex.query(
+                        shapely.box(
+                            cell_bbox["x_min"],
+                            cell_bbox["y_min"],
+                            cell_bbox["x_max"],
+                            cell_bbox["y_max"],
+                        )
+                    )
+                ]
+                for geometry in cell_geometries:
+                    wkb = shapely.to_wkb(geometry)
+                    cursor = conn.execute(
+                        "INSERT INTO footprints (srid, cell_x, cell_y, wkb_hash, wkb) "
+                        + "VALUES (?, ?, ?, ?, ?)",
+                        (srid, *cell, hashlib.sha1(wkb).hexdigest(), wkb),
+                    )
+                    min_x, min_y, max_x, max_y = geometry.bounds
+                    conn.execute(
+                        "INSERT INTO footprints_rtree VALUES (?, ?, ?, ?, ?)",
+                        (cursor.lastrowid, min_x, max_x, min_y, max_y),
+                    )
+                conn.execute(
+                    "INSERT INTO cells VALUES (?, ?, ?, ?, ?)",
+                    (srid, *cell, fetched_at, fetched_at),
+                )
+
+    def _delete_cells(self, conn: sqlite3.Connection, keys: List[Tuple[str, int, int]]):
+        for key in keys:
+            conn.execute(
+                "DELETE FROM footprints_rtree WHERE id IN (SELECT id FROM footprints "
+                + "WHERE srid = ? AND cell_x = ? AND cell_y = ?)",
+                key,
+            )
+            conn.execute(
+                "DELETE FROM footprints WHERE srid = ? AND cell_x = ? AND cell_y = ?", key
+            )
+            conn.execute("DELETE FROM cells WHERE srid = ? AND cell_x = ? AND cell_y = ?", key)
+
+    def _get_size_mb(self, conn: sqlite3.Connection) -> float:
+        """Size of the data in the database. Free pages are reused by SQLite."""
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        return (page_count - freelist_count) * page_size / 2**20
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        """Evict expired cells, then least recently used cells until the size limit is met."""
+        with conn:
+            expired = conn.execute(
+                "SELECT srid, cell_x, cell_y FROM cells WHERE fetched_at <= ?", (now - self.ttl,)
+            ).fetchall()
+            self._delete_cells(conn, expired)
+
+        while self._get_size_mb(conn) > self.max_size_mb:
+            with conn:
+                num_cells = conn.execute("SELECT COUNT(*) FROM cells").fetchone()[0]
+                if not num_cells:
+                    break
+                least_recently_used = conn.execute(
+                    "SELECT srid, cell_x, cell_y FROM cells ORDER BY last_access LIMIT ?",
+                    (max(1, num_cells // 10),),
+                ).fetchall()
+                self._delete_cells(conn, least_recently_used)
+            log.info(f"Evicted {len(least_recently_used)} cells from the BD Uni footprints cache")
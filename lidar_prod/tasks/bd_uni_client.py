@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+import geopandas
+import psycopg2
+import psycopg2.pool
+import shapely
+
+from lidar_prod.tasks.utils import (
+    BDUniConnectionParams,
+    bbox_intersects_envelope,
+    get_srid_from_epsg,
+    get_territoire_envelope,
+)
+
+log = logging.getLogger(__name__)
+
+# Name of the flag column used by the pdal overlay.
+PRESENCE_COLUMN = "PRESENCE"
+
+SQL_BUILDINGS = """WITH territoire(code) AS (
+        SELECT code FROM public.gcms_territoire WHERE srid = %(srid)s
+    )
+    SELECT ST_AsBinary(ST_MakeValid(ST_Force2D(ST_SetSRID(batiment.geometrie, %(srid)s))))
+    FROM batiment, territoire
+    WHERE (batiment.gcms_territoire = territoire.code)
+    AND batiment.geometrie && ST_MakeEnvelope(%(x_min)s, %(y_min)s, %(x_max)s, %(y_max)s, 0)
+    AND NOT gcms_detruit
+    UNION
+    SELECT ST_AsBinary(ST_MakeValid(ST_Force2D(ST_SetSRID(reservoir.geometrie, %(srid)s))))
+    FROM reservoir, territoire
+    WHERE (reservoir.gcms_territoire = territoire.code)
+    AND reservoir.geometrie && ST_MakeEnvelope(%(x_min)s, %(y_min)s, %(x_max)s, %(y_max)s, 0)
+    AND (reservoir.nature = 'Château d''eau' OR reservoir.nature = 'Réservoir industriel')
+    AND NOT gcms_detruit;
+"""
+
+# One pool of connections per process and per database. Connections cannot be shared between
+# processes, hence the pid in the key.
+_connection_pools: Dict[Tuple, psycopg2.pool.SimpleConnectionPool] = {}
+
+
+def get_connection_pool(bd_params: BDUniConnectionParams) -> psycopg2.pool.SimpleConnectionPool:
+    """Get the pool of connections to a database for the current process, created if needed."""
+    key = (os.getpid(), bd_params.host, bd_params.user, bd_params.bd_name)
+    if key not in _connection_pools:
+        _connection_pools[key] = psycopg2.pool.SimpleConnectionPool(
+            1,
+            1,
+            dbname=bd_params.bd_name,
+            user=bd_params.user,
+            password=bd_params.pwd,
+            host=bd_params.host,
+        )
+    return _connection_pools[key]
+
+
+class BDUniClient:
+    """Client of the BD Uni, which reuses a pooled connection between requests.
+
+    Building footprints are fetched as WKB and returned as a GeoDataFrame, without any file
+    written to disk.
+
+    Note on the projections:
+    Projections are mixed in the BDUni tables.
+    In PostGIS, the declared projection is 0 but the data are stored in the legal projection of
+    the corresponding territories.
+    In each table, there is a a "gcms_territoire" field, which tells the corresponding territory
+    (3 letters code).
+    The gcms_territoire table gives hints on each territory (SRID, footprint)
+    """
+
+    def __init__(self, bd_params: BDUniConnectionParams):
+        self.bd_params = bd_params
+
+    @contextmanager
+    def cursor(self):
+        """Cursor on a pooled connection, in a transaction.
+
+        Connections that were broken (e.g. by a network error) are discarded from the pool.
+        """
+        pool = get_connection_pool(self.bd_params)
+        conn = pool.getconn()
+        discard = False
+        try:
+            with conn:
+                with conn.cursor() as curs:
+                    yield curs
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            pool.putconn(conn, close=discard or bool(conn.closed))
+
+    def check_bbox_intersects_territoire(self, bbox: Dict[str, int], epsg_srid: int | str) -> bool:
+        """Check if a bounding box intersects one of the territories from the BDUni database
+        (public.gcms_territoire) with the expected srid.
+
+        The envelope of the territories is requested once per process and srid, and the check
+        is then done locally (see `utils.get_territoire_envelope`).
+        """
+        envelope = get_territoire_envelope(self.bd_params, epsg_srid, cursor_factory=self.cursor)
+        return bbox_intersects_envelope(bbox, envelope)
+
+    def fetch_buildings(
+        self, bbox: Dict[str, int], epsg_srid: int | str
+    ) -> geopandas.GeoDataFrame:
+        """Fetch the non destructed buildings whose bounding box intersects a bbox.
+
+        Returns:
+            geopandas.GeoDataFrame: buildings, with a "PRESENCE" column filled with 1 for later
+            use by pdal.
+
+        """
+        with self.cursor() as curs:
+            curs.execute(SQL_BUILDINGS, {**bbox, "srid": int(epsg_srid)})
+            rows = curs.fetchall()
+        geometries = shapely.from_wkb([bytes(row[0]) for row in rows])
+        return geopandas.GeoDataFrame(
+            {PRESENCE_COLUMN: [1] * len(geometries)},
+            geometry=geometries,
+            crs=f"EPSG:{epsg_srid}",
+        )
+
+    def get_buildings(self, bbox: Dict[str, int], epsg: int | str) -> geopandas.GeoDataFrame:
+        """Request BD Uni for the buildings in an area of interest.
+
+        Drop-in replacement of `utils.request_bd_uni_for_building_shapefile`, which returns the
+        buildings instead of saving them to a shapefile.
+
+        Raises:
+            ValueError: if the bbox does not intersect any territory with the srid of epsg.
+
+        """
+        epsg_srid = get_srid_from_epsg(epsg)
+        if not self.check_bbox_intersects_territoire(bbox, epsg_srid):
+            raise ValueError(
+                f"The query bbox ({bbox}) does not intersect with any territoire in the database "
+                + f"with the query srid ({epsg_srid}). Please check that you passed the correct "
+                + "srid."
+            )
+        return self.fetch_buildings(bbox, epsg_srid)
+
+
+def to_overlay_datasource(gdf: geopandas.GeoDataFrame) -> str:
+    """Inline GeoJSON datasource of buildings, to be passed to a pdal overlay instead of a path.
+
+    The crs is declared explicitly, as GeoJSON defaults to WGS84.
+    """
+    geojson = json.loads(gdf.to_json())
+    geojson["crs"] = {
+        "type": "name",
+        "properties": {"name": f"urn:ogc:def:crs:EPSG::{gdf.crs.to_epsg()}"},
+    }
+    return json.dumps(geojson)
@@ -0,0 +1,153 @@
+import logging
+import math
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+import geopandas
+import pandas
+import shapely
+
+from lidar_prod.tasks.bd_uni_client import PRESENCE_COLUMN, BDUniClient
+from lidar_prod.tasks.utils import get_integer_bbox_from_las_header, get_srid_from_epsg
+
+log = logging.getLogger(__name__)
+
+
+class BDUniPrefetch:
+    """Buildings of the BD Uni prefetched on a few envelopes, served by bbox from an STRtree.
+
+    A bbox is served if it lies within one of the prefetched envelopes, and its buildings are
+    then the same as the ones a request to the BD Uni would give, i.e. buildings whose bounding
+    box intersects the bbox.
+    """
+
+    def __init__(
+        self,
+        buildings: geopandas.GeoDataFrame,
+        envelopes: List[Dict[str, int]],
+        epsg_srid: int | str,
+    ):
+        self.buildings = buildings
+        self.envelopes = envelopes
+        self.epsg_srid = str(epsg_srid)
+        self._tree: Optional[shapely.STRtree] = None
+
+    def __getstate__(self):
+        # The tree is rebuilt when needed, e.g. after being sent to a worker process.
+        state = self.__dict__.copy()
+        state["_tree"] = None
+        return state
+
+    @property
+    def tree(self) -> shapely.STRtree:
+        if self._tree is None:
+            self._tree = shapely.STRtree(self.buildings.geometry.values)
+        return self._tree
+
+    def covers(self, bbox: Dict[str, int], epsg: int | str) -> bool:
+        """True if the buildings of a bbox can be served from the prefetched envelopes."""
+        if str(get_srid_from_epsg(epsg)) != self.epsg_srid:
+            return False
+        return any(
+            envelope["x_min"] <= bbox["x_min"]
+            and envelope["y_min"] <= bbox["y_min"]
+            and envelope["x_max"] >= bbox["x_max"]
+            and envelope["y_max"] >= bbox["y_max"]
+            for envelope in self.envelopes
+        )
+
+    def get_buildings(self, bbox: Dict[str, int]) -> geopandas.GeoDataFrame:
+        """Buildings whose bounding box intersects a bbox."""
+        idx = self.tree.query(
+            shapely.box(bbox["x_min"], bbox["y_min"], bbox["x_max"], bbox["y_max"])
+        )
+        idx.sort()
+        return self.buildings.iloc[idx].reset_index(drop=True)
+
+
+# Prefetched buildings of the current process, set by `apply` before processing tiles (and by
+# the initializer of worker processes).
+_prefetched_buildings: Optional[BDUniPrefetch] = None
+
+
+def set_prefetched_buildings(prefetched_buildings: Optional[BDUniPrefetch]):
+    global _prefetched_buildings
+    _prefetched_buildings = prefetched_buildings
+
+
+def get_prefetched_buildings() -> Optional[BDUniPrefetch]:
+    return _prefetched_buildings
+
+
+def get_coverage_envelopes(
+    bboxes: Iterable[Dict[str, int]], max_envelope_size: float
+) -> List[Dict[str, int]]:
+    """Merge bboxes into a few envelopes that cover them.
+
+    Bboxes are grouped by cells of `max_envelope_size` (based on their center), to bound the
+    size of each request. In each group, overlapping or touching bboxes are merged, and the
+    envelope of each resulting area is kept.
+
+    """
+    groups = defaultdict(list)
+    for bbox in bboxes:
+        cell = (
+            math.floor((bbox["x_min"] + bbox["x_max"]) / 2 / max_envelope_size),
+            math.floor((bbox["y_min"] + bbox["y_max"]) / 2 / max_envelope_size),
+        )
+        groups[cell].append(
+            shapely.box(bbox["x_min"], bbox["y_min"], bbox["x_max"], bbox["y_max"])
+        )
+
+    envelopes = []
+    for cell in sorted(groups):
+        for area in shapely.get_parts(shapely.union_all(groups[cell])):
+            x_min, y_min, x_max, y_max = area.bounds
+            envelopes.append(
+                {
+                    "x_min": math.floor(x_min),
+                    "y_min": math.floor(y_min),
+                    "x_max": math.ceil(x_max),
+                    "y_max": math.ceil(y_max),
+                }
+            )
+    return envelopes
+
+
+def prefetch_bd_uni_buildings(
+    client: BDUniClient,
+    las_paths: Iterable[str],
+    epsg: int | str,
+    buffer: float,
+    max_envelope_size: float,
+) -> BDUniPrefetch:
+    """Request the BD Uni once per envelope of adjacent tiles, instead of once per tile.
+
+    Bboxes of tiles are read from their header, with the same buffer as the per-tile requests.
+    Envelopes that do not intersect any territory with the srid of epsg are not prefetched: the
+    tiles they cover fall back to per-tile requests, which will fail.
+
+    """
+    bboxes = [get_integer_bbox_from_las_header(las_path, buffer) for las_path in las_paths]
+    envelopes = get_coverage_envelopes(bboxes, max_envelope_size)
+    log.info(f"Prefetch BD Uni buildings of {len(bboxes)} tiles with {len(envelopes)} requests")
+
+    epsg_srid = get_srid_from_epsg(epsg)
+    prefetched_envelopes = []
+    buildings = []
+    for envelope in envelopes:
+        try:
+            buildings.append(client.get_buildings(envelope, epsg_srid))
+            prefetched_envelopes.append(envelope)
+        except ValueError as e:
+            log.warning(f"Could not prefetch BD Uni buildings: {e}")
+
+    if buildings:
+        buildings = pandas.concat(buildings, ignore_index=True)
+        # Buildings that intersect several envelopes are requested several times.
+        buildings = buildings[~buildings.geometry.to_wkb().duplicated()].reset_index(drop=True)
+    else:
+        buildings = geopandas.GeoDataFrame(
+            {PRESENCE_COLUMN: []}, geometry=[], crs=f"EPSG:{epsg_srid}"
+        )
+    return BDUniPrefetch(buildings, prefetched_envelopes, epsg_srid)
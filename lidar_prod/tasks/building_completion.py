@@ -1,10 +1,16 @@
 import logging
 from typing import Union
 
+import numpy as np
 import pdal
-from tqdm import tqdm
 
-from lidar_prod.tasks.utils import get_pipeline, split_idx_by_dim
+from lidar_prod.tasks.clustering import TileSpatialIndex, cluster_points
+from lidar_prod.tasks.utils import (
+    ClusterIndex,
+    IncrementalPipeline,
+    add_typed_dimensions,
+    get_pipeline,
+)
 
 log = logging.getLogger(__name__)
 
@@ -33,8 +39,10 @@ class BuildingCompletor:
         min_building_proba: float = 0.5,
         cluster=None,
         data_format=None,
+        spatial_index: TileSpatialIndex = None,
     ):
         self.cluster = cluster
+        self.spatial_index = spatial_index
         self.min_building_proba = min_building_proba
         self.data_format = data_format
         self.pipeline: pdal.pipeline.Pipeline = None
@@ -80,33 +88,40 @@ class BuildingCompletor:
             pipeline (pdal.pipeline.Pipeline): input LAS pipeline
         """
 
-        # Reset Cluster dim out of safety
         dim_cluster_id_pdal = self.data_format.las_dimensions.cluster_id
+        dim_cluster_id = self.data_format.las_dimensions.ClusterID_confirmed_or_high_proba
+        dim_completion_flag = self.data_format.las_dimensions.completion_non_candidate_flag
+        # Intermediary dimensions, with compact types. The completion flag is a placeholder that
+        # will hold non-candidate points with high enough probas.
+        pipeline = add_typed_dimensions(
+            pipeline, {dim_cluster_id: np.uint32, dim_completion_flag: np.uint8}
+        )
+
+        # Reset Cluster dim out of safety
         pipeline |= pdal.Filter.assign(value=f"{dim_cluster_id_pdal} = 0")
 
         # Candidates that where already confirmed by BuildingValidator.
-        confirmed_buildings = f"Classification == {self.data_format.codes.building.final.building}"
+        building_code = self.data_format.codes.building.final.building
+        confirmed_buildings = f"Classification == {building_code}"
         p_heq_threshold = f"(building>={self.min_building_proba})"
         where = f"{p_heq_threshold} || {confirmed_buildings}"
-        pipeline |= pdal.Filter.cluster(
-            min_points=self.cluster.min_points,
-            tolerance=self.cluster.tolerance,
-            is3d=self.cluster.is3d,
+
+        def get_where_mask(points):
+            return (points["building"] >= self.min_building_proba) | (
+                points["Classification"] == building_code
+            )
+
+        pipeline = cluster_points(
+            pipeline,
+            self.cluster,
             where=where,
+            get_where_mask=get_where_mask,
+            dim_cluster_id=dim_cluster_id_pdal,
+            spatial_index=self.spatial_index,
         )
         # Always move then reset ClusterID to avoid conflict with later tasks.
-        pipeline |= pdal.Filter.ferry(
-            dimensions=(
-                f"{self.data_format.las_dimensions.cluster_id}"
-                + f"=>{self.data_format.las_dimensions.ClusterID_confirmed_or_high_proba}"
-            )
-        )
-        pipeline |= pdal.Filter.assign(value=f"{self.data_format.las_dimensions.cluster_id} = 0")
-        # Create a placeholder dimension that will hold non-candidate points with high enough
-        # probas
-        pipeline |= pdal.Filter.ferry(
-            dimensions=f"=> {self.data_format.las_dimensions.completion_non_candidate_flag}"
-        )
+        pipeline |= pdal.Filter.assign(value=f"{dim_cluster_id} = {dim_cluster_id_pdal}")
+        pipeline |= pdal.Filter.assign(value=f"{dim_cluster_id_pdal} = 0")
         # Run
         pipeline.execute()
 
@@ -124,20 +139,21 @@ class BuildingCompletor:
         _candidate_flag = self.data_format.las_dimensions.candidate_buildings_flag
 
         # 2) Decide at the group-level
-        split_idx = split_idx_by_dim(points[_cid])
         # Isolated/confirmed groups have a cluster index > 0
-        split_idx = split_idx[1:]
+        cluster_index = ClusterIndex(points[_cid])
         # For each group of isolated|confirmed points,
         # Assess if the group already contains confirmed points. If it does, points
         # with high proba may belong to the same building.
-        for pts_idx in tqdm(split_idx, desc="Complete buildings with isolated points", unit="grp"):
-            if self.data_format.codes.building.final.building in points[_clf][pts_idx]:
-                candidates_mask = points[_candidate_flag][pts_idx] == 1
-                # (a) If a point is a candidate building, Then confirm it.
-                candidates_idx = pts_idx[candidates_mask]
-                points[_clf][candidates_idx] = self.data_format.codes.building.final.building
-                # (b) If a point is not a candidate building, set a flag to
-                # identify it as a potential completion, for future human inspection.
-                non_candidates_idx = pts_idx[~candidates_mask]
-                points[_completion_flag][non_candidates_idx] = 1
-        self.pipeline = pdal.Pipeline(arrays=[points])
+        building_code = self.data_format.codes.building.final.building
+        group_contains_confirmed = cluster_index.segment_sum(points[_clf] == building_code) > 0
+        completed_mask = np.zeros(len(points), dtype=bool)
+        completed_mask[cluster_index.clustered_mask] = cluster_index.broadcast(
+            group_contains_confirmed
+        )
+        candidates_mask = points[_candidate_flag] == 1
+        # (a) If a point is a candidate building, Then confirm it.
+        points[_clf][completed_mask & candidates_mask] = building_code
+        # (b) If a point is not a candidate building, set a flag to
+        # identify it as a potential completion, for future human inspection.
+        points[_completion_flag][completed_mask & ~candidates_mask] = 1
+        self.pipeline = IncrementalPipeline([points])
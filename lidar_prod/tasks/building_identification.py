@@ -3,9 +3,11 @@ import os
 import os.path as osp
 from typing import Union
 
+import numpy as np
 import pdal
 
-from lidar_prod.tasks.utils import get_pdal_writer, get_pipeline
+from lidar_prod.tasks.clustering import TileSpatialIndex, cluster_points
+from lidar_prod.tasks.utils import add_typed_dimensions, get_pdal_writer, get_pipeline
 
 log = logging.getLogger(__name__)
 
@@ -24,8 +26,10 @@ class BuildingIdentifier:
         min_building_proba: float = 0.5,
         cluster=None,
         data_format=None,
+        spatial_index: TileSpatialIndex = None,
     ):
         self.cluster = cluster
+        self.spatial_index = spatial_index
         self.data_format = data_format
         self.min_building_proba = min_building_proba
         self.pipeline: pdal.pipeline.Pipeline = None
@@ -52,36 +56,48 @@ class BuildingIdentifier:
         # aliases
         _cid = self.data_format.las_dimensions.cluster_id
         _completion_flag = self.data_format.las_dimensions.completion_non_candidate_flag
+        _group = self.data_format.las_dimensions.ai_building_identified
 
         log.info("Clustering of points with high building proba.")
         pipeline, las_metadata = get_pipeline(input_values, self.data_format.epsg, las_metadata)
+        # Cluster ids fit in 4 bytes, like the group of the output.
+        pipeline = add_typed_dimensions(pipeline, {_group: np.uint32})
 
         # Considered for identification:
-        non_candidates = f"({self.data_format.las_dimensions.candidate_buildings_flag} == 0)"
-        not_already_confirmed = (
-            f"({self.data_format.las_dimensions.classification} "
-            + f"!= {self.data_format.codes.building.final.building})"
-        )
+        _candidate_flag = self.data_format.las_dimensions.candidate_buildings_flag
+        _clf = self.data_format.las_dimensions.classification
+        building_code = self.data_format.codes.building.final.building
+        non_candidates = f"({_candidate_flag} == 0)"
+        not_already_confirmed = f"({_clf} != {building_code})"
         not_a_potential_completion = f"({_completion_flag} != 1)"
         p_heq_threshold = f"(building>={self.min_building_proba})"
         where = (
             f"({non_candidates} && {not_already_confirmed} "
             + f"&& {not_a_potential_completion} && {p_heq_threshold})"
         )
-        pipeline |= pdal.Filter.cluster(
-            min_points=self.cluster.min_points,
-            tolerance=self.cluster.tolerance,
-            is3d=self.cluster.is3d,
+
+        def get_where_mask(points):
+            return (
+                (points[_candidate_flag] == 0)
+                & (points[_clf] != building_code)
+                & (points[_completion_flag] != 1)
+                & (points["building"] >= self.min_building_proba)
+            )
+
+        pipeline = cluster_points(
+            pipeline,
+            self.cluster,
             where=where,
+            get_where_mask=get_where_mask,
+            dim_cluster_id=_cid,
+            spatial_index=self.spatial_index,
         )
         # Increment ClusterID, so that points from building completion can become cluster 1
         pipeline |= pdal.Filter.assign(value=f"{_cid} = {_cid} + 1", where=f"{_cid} != 0")
         pipeline |= pdal.Filter.assign(value=f"{_cid} = 1", where=f"{_completion_flag} == 1")
         # Duplicate ClusterID to have an explicit name for it for inspection.
         # Do not reset it to zero to have access to it at human inspection stage.
-        pipeline |= pdal.Filter.ferry(
-            dimensions=f"{_cid}=>{self.data_format.las_dimensions.ai_building_identified}"
-        )
+        pipeline |= pdal.Filter.assign(value=f"{_group} = {_cid}")
         if target_las_path:
             pipeline |= get_pdal_writer(target_las_path, las_metadata)
             os.makedirs(osp.dirname(target_las_path), exist_ok=True)
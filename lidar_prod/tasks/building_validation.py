@@ -1,27 +1,43 @@
 import logging
 import os
 import os.path as osp
-import shutil
 from dataclasses import dataclass
-from tempfile import TemporaryDirectory, mkdtemp
+from tempfile import TemporaryDirectory
 from typing import Optional, Union
 
 import geopandas
 import numpy as np
 import pdal
 import yaml
-from tqdm import tqdm
 
+from lidar_prod.tasks.bd_uni_cache import BDUniFootprintCache
+from lidar_prod.tasks.bd_uni_client import (
+    PRESENCE_COLUMN,
+    BDUniClient,
+    to_overlay_datasource,
+)
+from lidar_prod.tasks.bd_uni_prefetch import get_prefetched_buildings
+from lidar_prod.tasks.clustering import TileSpatialIndex, cluster_points
+from lidar_prod.tasks.overlay import (
+    overlay_points,
+    overlay_points_with_raster,
+    prune_geometries,
+)
 from lidar_prod.tasks.utils import (
-    get_integer_bbox,
+    ClusterIndex,
+    IncrementalPipeline,
+    add_typed_dimensions,
+    get_integer_bbox_from_las_metadata,
     get_pdal_writer,
     get_pipeline,
-    request_bd_uni_for_building_shapefile,
-    split_idx_by_dim,
 )
 
 log = logging.getLogger(__name__)
 
+# "pdal": overlay filter of pdal on all points. "shapely" and "raster": in-process overlay of
+# clustered candidates (see lidar_prod.tasks.overlay).
+OVERLAY_ENGINES = ("pdal", "shapely", "raster")
+
 
 @dataclass
 class BuildingValidationClusterInfo:
@@ -57,6 +73,8 @@ class BuildingValidator:
         data_format=None,
         thresholds=None,
         use_final_classification_codes: bool = True,
+        overlay=None,
+        spatial_index: TileSpatialIndex = None,
     ):
         self.shp_path = shp_path
         self.bd_uni_connection_params = bd_uni_connection_params
@@ -65,6 +83,8 @@ class BuildingValidator:
         self.use_final_classification_codes = use_final_classification_codes
         self.thresholds = thresholds  # default values
         self.data_format = data_format
+        self.overlay = overlay
+        self.spatial_index = spatial_index
         # For easier access
         self.codes = data_format.codes.building
         self.candidate_buildings_codes = data_format.codes.building.candidates
@@ -77,6 +97,20 @@ class BuildingValidator:
         self.detailed_to_final_map: dict = {
             detailed: final for detailed, final in self.codes.detailed_to_final
         }
+        self.overlay_engine = self.overlay.engine if self.overlay else "pdal"
+        if self.overlay_engine not in OVERLAY_ENGINES:
+            raise ValueError(
+                f"Unknown overlay engine {self.overlay_engine}, expected one of {OVERLAY_ENGINES}"
+            )
+        self.footprint_cache = None
+        cache = self.bd_uni_request.get("cache") if self.bd_uni_request else None
+        if cache and cache.get("enabled"):
+            self.footprint_cache = BDUniFootprintCache(
+                path=cache.path,
+                cell_size=cache.cell_size,
+                ttl=cache.ttl,
+                max_size_mb=cache.max_size_mb,
+            )
 
     def run(
         self,
@@ -102,7 +136,6 @@ class BuildingValidator:
             with the same header (las version, srs, ...) as the input
 
         """
-        self.pipeline, las_metadata = get_pipeline(input_values, self.data_format.epsg)
         with TemporaryDirectory() as td:
             log.info("Preparation : Clustering of candidates buildings & Import vectors")
             if isinstance(input_values, str):
@@ -110,7 +143,7 @@ class BuildingValidator:
                 temp_f = osp.join(td, osp.basename(input_values))
             else:
                 temp_f = ""
-            las_metadata = self.prepare(input_values, temp_f, las_metadata)
+            las_metadata = self.prepare(input_values, temp_f, las_metadata=las_metadata)
             log.info("Using AI and Databases to update cloud Classification")
             las_metadata = self.update(target_las_path=target_las_path, las_metadata=las_metadata)
         return las_metadata
@@ -128,7 +161,9 @@ class BuildingValidator:
         `{self.data_format.las_dimensions.ClusterID_candidate_building}`
         dimension where the index of clusters starts at 1 (0 means no cluster).
         2. Identify points overlayed by a BD Uni building, in a new
-        `{self.data_format.las_dimensions.uni_db_overlay}` dimension (0/1 flag).
+        `{self.data_format.las_dimensions.uni_db_overlay}` dimension (0/1 flag). With the
+        "shapely" and "raster" overlay engines, only clustered candidates are flagged, as they are
+        the only points whose flag is used by decisions.
 
         In the process is created a new dimensions which identifies candidate buildings (0/1 flag)
         `{self.data_format.las_dimensions.candidate_buildings_flag}`, to ignore them in later
@@ -143,7 +178,8 @@ class BuildingValidator:
             target_las_path (str): path for saving prepared LAS file.
             save_result (bool): True to save a las instead of propagating a pipeline
             las_metadata (dict): current pipeline metadata, used to propagate input metadata to the
-        application output las (epsg, las version, etc)
+        application output las (epsg, las version, etc). Required if input_values is a pipeline,
+        as the bounding box of the BD Uni request is read from it.
 
         Returns:
             updated las metadata
@@ -155,9 +191,19 @@ class BuildingValidator:
         dim_cluster_id_candidates = self.data_format.las_dimensions.ClusterID_candidate_building
         dim_overlay = self.data_format.las_dimensions.uni_db_overlay
 
-        self.pipeline, las_metadata = get_pipeline(input_values, self.data_format.epsg)
+        self.pipeline, las_metadata = get_pipeline(
+            input_values, self.data_format.epsg, las_metadata
+        )
+        # Intermediary dimensions, with compact types.
+        self.pipeline = add_typed_dimensions(
+            self.pipeline,
+            {
+                dim_candidate_flag: np.uint8,
+                dim_cluster_id_candidates: np.uint32,
+                dim_overlay: np.uint8,
+            },
+        )
         # Identify candidates buildings points with a boolean flag
-        self.pipeline |= pdal.Filter.ferry(dimensions=f"=>{dim_candidate_flag}")
         _is_candidate_building = (
             "("
             + " || ".join(
@@ -171,60 +217,105 @@ class BuildingValidator:
         )
         # Cluster candidates buildings points. This creates a ClusterID dimension (int)
         # in which unclustered points have index 0.
-        self.pipeline |= pdal.Filter.cluster(
-            min_points=self.cluster.min_points,
-            tolerance=self.cluster.tolerance,
+        self.pipeline = cluster_points(
+            self.pipeline,
+            self.cluster,
             where=f"{dim_candidate_flag} == 1",
+            get_where_mask=lambda points: points[dim_candidate_flag] == 1,
+            dim_cluster_id=dim_cluster_id_pdal,
+            spatial_index=self.spatial_index,
         )
 
-        # Copy ClusterID into a new dim and reset it to 0 to avoid conflict with later tasks.
-        self.pipeline |= pdal.Filter.ferry(
-            dimensions=f"{dim_cluster_id_pdal}=>{dim_cluster_id_candidates}"
+        # Copy ClusterID into its own dim and reset it to 0 to avoid conflict with later tasks.
+        self.pipeline |= pdal.Filter.assign(
+            value=f"{dim_cluster_id_candidates} = {dim_cluster_id_pdal}"
         )
         self.pipeline |= pdal.Filter.assign(value=f"{dim_cluster_id_pdal} = 0")
-        self.pipeline.execute()
-        bbox = get_integer_bbox(self.pipeline, buffer=self.bd_uni_request.buffer)
-
-        self.pipeline |= pdal.Filter.ferry(dimensions=f"=>{dim_overlay}")
-
-        if self.shp_path:
-            # no need for a temporay directory to add the shapefile in it, we already have the
-            # shapefile
-            temp_dirpath = None
-            _shp_p = self.shp_path
-            log.info(f"Read shapefile\n {_shp_p}")
-            gdf = geopandas.read_file(_shp_p)
-            buildings_in_bd_topo = not len(gdf) == 0  # check if there are buildings in the shp
-
-        else:
-            temp_dirpath = mkdtemp()
-            # TODO: extract coordinates from LAS directly using pdal.
-            # Request BDUni to get a shapefile of the known buildings in the LAS
-            _shp_p = os.path.join(temp_dirpath, "temp.shp")
-            log.info("Request Bd Uni")
-            buildings_in_bd_topo = request_bd_uni_for_building_shapefile(
-                self.bd_uni_connection_params, _shp_p, bbox, self.data_format.epsg
-            )
+        bbox = get_integer_bbox_from_las_metadata(las_metadata, buffer=self.bd_uni_request.buffer)
 
+        gdf = self._get_buildings(bbox)
         # Create overlay dim
         # If there are some buildings in the database, create a BDTopoOverlay boolean
         # dimension to reflect it.
+        buildings_in_bd_topo = not len(gdf) == 0
+
+        if self.overlay_engine == "pdal":
+            if buildings_in_bd_topo:
+                # Buildings requested to BD Uni are passed to the overlay as an inline GeoJSON
+                # datasource, without writing them to disk.
+                datasource = self.shp_path if self.shp_path else to_overlay_datasource(gdf)
+                self.pipeline |= pdal.Filter.overlay(
+                    column=PRESENCE_COLUMN, datasource=datasource, dimension=dim_overlay
+                )
+            if save_result:
+                self.pipeline |= get_pdal_writer(prepared_las_path, las_metadata)
+                os.makedirs(osp.dirname(prepared_las_path), exist_ok=True)
+            self.pipeline.execute()
+            return las_metadata
 
+        self.pipeline.execute()
+        points = self.pipeline.arrays[0]
         if buildings_in_bd_topo:
-            self.pipeline |= pdal.Filter.overlay(
-                column="PRESENCE", datasource=_shp_p, dimension=dim_overlay
-            )
-
+            self._overlay_clustered_candidates(points, gdf)
         if save_result:
-            self.pipeline |= get_pdal_writer(prepared_las_path, las_metadata)
+            self.pipeline = get_pdal_writer(prepared_las_path, las_metadata).pipeline(points)
             os.makedirs(osp.dirname(prepared_las_path), exist_ok=True)
-        self.pipeline.execute()
-
-        if temp_dirpath:
-            shutil.rmtree(temp_dirpath)
-
+            self.pipeline.execute()
+        else:
+            self.pipeline = IncrementalPipeline([points])
         return las_metadata
 
+    def _get_buildings(self, bbox: dict) -> geopandas.GeoDataFrame:
+        """Get the buildings to overlay, from the shapefile if any, or from the BD Uni."""
+        if self.shp_path:
+            log.info(f"Read shapefile\n {self.shp_path}")
+            return geopandas.read_file(self.shp_path)
+
+        # Request BDUni to get the known buildings in the LAS
+        log.info("Request Bd Uni")
+        client = BDUniClient(self.bd_uni_connection_params)
+        prefetched_buildings = get_prefetched_buildings()
+        if prefetched_buildings and prefetched_buildings.covers(bbox, self.data_format.epsg):
+            return prefetched_buildings.get_buildings(bbox)
+        if self.footprint_cache:
+            return self.footprint_cache.get_buildings(client, bbox, self.data_format.epsg)
+        return client.get_buildings(bbox, self.data_format.epsg)
+
+    def _overlay_clustered_candidates(self, points: np.ndarray, gdf: geopandas.GeoDataFrame):
+        """In-process overlay of buildings, on clustered candidate points only.
+
+        Only the overlay of clustered candidates is used by decisions: buildings that do not
+        intersect the bounding box of any cluster are pruned, and other points keep a null
+        overlay flag.
+        """
+        dims = self.data_format.las_dimensions
+        cluster_index = ClusterIndex(points[dims.ClusterID_candidate_building])
+        x = points["X"]
+        y = points["Y"]
+        clusters_bboxes = np.column_stack(
+            [
+                cluster_index.segment_min(x),
+                cluster_index.segment_min(y),
+                cluster_index.segment_max(x),
+                cluster_index.segment_max(y),
+            ]
+        )
+        geometries = prune_geometries(gdf.geometry.values, clusters_bboxes)
+        mask = cluster_index.clustered_mask
+        if self.overlay_engine == "raster":
+            overlay_flags = overlay_points_with_raster(
+                x[mask],
+                y[mask],
+                geometries,
+                cell_size=self.overlay.cell_size,
+                n_threads=self.overlay.n_threads,
+            )
+        else:
+            overlay_flags = overlay_points(
+                x[mask], y[mask], geometries, n_threads=self.overlay.n_threads
+            )
+        points[dims.uni_db_overlay][mask] = overlay_flags
+
     def update(
         self, src_las_path: str = None, target_las_path: str = None, las_metadata: dict = None
     ) -> dict:
@@ -242,28 +333,23 @@ class BuildingValidator:
         candidates_mask = points[dim_flag] == 1
         points[dim_clf][candidates_mask] = self.codes.final.not_building
 
-        # 2) Decide at the group-level
-        # TODO: check if this can be moved somewhere else.
+        # 2) Decide at the group-level, for all clusters at once.
+        # Unclustered points have ClusterID = 0 and are left untouched.
+        dims = self.data_format.las_dimensions
+        cluster_index = ClusterIndex(points[dims.ClusterID_candidate_building])
+        detailed_codes = self._make_detailed_group_decisions(
+            cluster_index,
+            points[dims.ai_building_proba],
+            points[dims.uni_db_overlay],
+            points[dims.entropy],
+        )
         # WARNING: use_final_classification_codes may be modified in an unsafe manner during
-        # optimization. Consider using a setter that will change decision_func alongside.
-
-        # Decide level of details of classification codes
-        decision_func = self._make_detailed_group_decision
+        # optimization.
         if self.use_final_classification_codes:
-            decision_func = self._make_group_decision
-
-        # Get the index of points of each cluster
-        # Remove unclustered group that have ClusterID = 0 (i.e. the first "group")
-        cluster_id_dim = points[self.data_format.las_dimensions.ClusterID_candidate_building]
-        split_idx = split_idx_by_dim(cluster_id_dim)
-        split_idx = split_idx[1:]
-
-        # Iterate over groups and update their classification
-        for pts_idx in tqdm(split_idx, desc="Update cluster classification", unit="clusters"):
-            infos = self._extract_cluster_info_by_idx(points, pts_idx)
-            points[dim_clf][pts_idx] = decision_func(infos)
+            detailed_codes = self._get_final_codes(detailed_codes)
+        points[dim_clf][cluster_index.clustered_mask] = cluster_index.broadcast(detailed_codes)
 
-        self.pipeline = pdal.Pipeline(arrays=[points])
+        self.pipeline = IncrementalPipeline([points])
 
         if target_las_path:
             self.pipeline = get_pdal_writer(target_las_path, las_metadata).pipeline(points)
@@ -272,26 +358,6 @@ class BuildingValidator:
 
         return las_metadata
 
-    def _extract_cluster_info_by_idx(
-        self, las: np.ndarray, pts_idx: np.ndarray
-    ) -> BuildingValidationClusterInfo:
-        """Extracts all necessary information to make a decision based on points indices.
-
-        Args:
-            las (np.ndarray): point cloud of interest
-            pts_idx (np.ndarray): indices of points in considered clusters
-
-        Returns:
-            BuildingValidationClusterInfo: data necessary to make a decision at cluster level.
-
-        """
-        pts = las[pts_idx]
-        probabilities = pts[self.data_format.las_dimensions.ai_building_proba]
-        overlays = pts[self.data_format.las_dimensions.uni_db_overlay]
-        entropies = pts[self.data_format.las_dimensions.entropy]
-        targets = pts[self.data_format.las_dimensions.classification]
-        return BuildingValidationClusterInfo(probabilities, overlays, entropies, targets)
-
     def _make_group_decision(self, *args, **kwargs) -> int:
         f"""Wrapper to simplify decision codes during LAS update.
         Signature follows the one of {self._make_detailed_group_decision.__name__}
@@ -366,6 +432,109 @@ class BuildingValidator:
             return self.codes.detailed.unsure_by_entropy
         return self.codes.detailed.both_unsure
 
+    def _make_detailed_group_decisions(
+        self,
+        cluster_index: ClusterIndex,
+        probabilities: np.ndarray,
+        overlays: np.ndarray,
+        entropies: np.ndarray,
+    ) -> np.ndarray:
+        f"""Decision process at the cluster level, for all clusters at once.
+
+        Vectorized equivalent of {self._make_detailed_group_decision.__name__}: per-cluster
+        fractions are computed with segmented sums over clusters, and the decision rules
+        are applied in the same order, so that both give identical codes.
+
+        Args:
+            cluster_index (ClusterIndex): index of the points of each cluster
+            probabilities (np.ndarray): building probability of each point
+            overlays (np.ndarray): BDUni overlay flag of each point
+            entropies (np.ndarray): entropy of each point
+
+        Returns:
+            np.ndarray: detailed classification code of each cluster.
+
+        """
+        fraction = cluster_index.segment_mean
+
+        # HIGH ENTROPY
+        high_entropy = (
+            fraction(entropies >= self.thresholds.min_entropy_uncertainty)
+            >= self.thresholds.min_frac_entropy_uncertain
+        )
+
+        # CONFIRMATION - threshold is relaxed under BDUni
+        p_heq_threshold = probabilities >= self.thresholds.min_confidence_confirmation
+        relaxed_threshold = (
+            self.thresholds.min_confidence_confirmation
+            * self.thresholds.min_frac_confirmation_factor_if_bd_uni_overlay
+        )
+        p_heq_relaxed_threshold = probabilities >= relaxed_threshold
+        ia_confirmed_flag = np.logical_or(
+            p_heq_threshold,
+            np.logical_and(overlays, p_heq_relaxed_threshold),
+        )
+        ia_confirmed = fraction(ia_confirmed_flag) >= self.thresholds.min_frac_confirmation
+
+        # REFUTATION
+        ia_refuted = (
+            fraction((1 - probabilities) >= self.thresholds.min_confidence_refutation)
+            >= self.thresholds.min_frac_refutation
+        )
+        uni_overlayed = fraction(overlays) >= self.thresholds.min_uni_db_overlay_frac
+
+        return self._select_detailed_group_codes(
+            high_entropy, ia_confirmed, ia_refuted, uni_overlayed
+        )
+
+    def _select_detailed_group_codes(
+        self,
+        high_entropy: np.ndarray,
+        ia_confirmed: np.ndarray,
+        ia_refuted: np.ndarray,
+        uni_overlayed: np.ndarray,
+    ) -> np.ndarray:
+        """Detailed classification code of each cluster, from the outcome of each decision rule.
+
+        Args:
+            high_entropy (np.ndarray): flag of clusters with a high fraction of uncertain points
+            ia_confirmed (np.ndarray): flag of clusters confirmed by AI
+            ia_refuted (np.ndarray): flag of clusters refuted by AI
+            uni_overlayed (np.ndarray): flag of clusters overlayed by BDUni
+
+        Returns:
+            np.ndarray: detailed classification code of each cluster.
+
+        """
+        # Conditions are listed by priority, the first one that holds gives the code.
+        low_entropy = ~high_entropy
+        return np.select(
+            [
+                low_entropy & ia_refuted & uni_overlayed,
+                low_entropy & ia_refuted,
+                low_entropy & ia_confirmed & uni_overlayed,
+                low_entropy & ia_confirmed,
+                uni_overlayed,
+                high_entropy,
+            ],
+            [
+                self.codes.detailed.ia_refuted_but_under_db_uni,
+                self.codes.detailed.ia_refuted,
+                self.codes.detailed.both_confirmed,
+                self.codes.detailed.ia_confirmed_only,
+                self.codes.detailed.db_overlayed_only,
+                self.codes.detailed.unsure_by_entropy,
+            ],
+            default=self.codes.detailed.both_unsure,
+        )
+
+    def _get_final_codes(self, detailed_codes: np.ndarray) -> np.ndarray:
+        """Maps detailed classification codes to final ones."""
+        final_codes = np.empty_like(detailed_codes)
+        for detailed, final in self.detailed_to_final_map.items():
+            final_codes[detailed_codes == detailed] = final
+        return final_codes
+
 
 @dataclass
 class thresholds:
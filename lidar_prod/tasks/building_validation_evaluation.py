@@ -0,0 +1,160 @@
+from typing import List
+
+import numpy as np
+
+from lidar_prod.tasks.building_validation import BuildingValidator, thresholds
+from lidar_prod.tasks.cluster_store import ClusterStore
+from lidar_prod.tasks.utils import SortedSegments
+
+# Max number of (thresholds, cluster) decisions made at once, which bounds the memory used by a
+# batch of thresholds to a few hundred MB.
+EVALUATION_CHUNK_SIZE = 2_000_000
+
+
+def _segment_sum(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    cumulative_sum = np.concatenate([[0], np.cumsum(values, dtype=np.int64)])
+    return cumulative_sum[offsets[1:]] - cumulative_sum[offsets[:-1]]
+
+
+class BuildingValidationEvaluator:
+    """Decisions of a `BuildingValidator` on all the clusters of a `ClusterStore`, for many sets
+    of thresholds.
+
+    Decisions only depend on the fractions of points of each cluster whose values are above
+    thresholds. Values are sorted once within each cluster (see `SortedSegments`), so that these
+    fractions are found for all clusters with `searchsorted`, instead of comparing each point to
+    the thresholds of each trial. Many sets of thresholds are evaluated together as a
+    (thresholds, clusters) matrix of decisions. Decisions are the same as the ones of
+    `BuildingValidator._make_detailed_group_decision` on each cluster.
+    """
+
+    def __init__(self, building_validator: BuildingValidator, clusters: ClusterStore):
+        """Sorts the values of the points of each cluster.
+
+        Args:
+            building_validator (BuildingValidator): validator whose codes are used.
+            clusters (ClusterStore): clusters on which decisions are made.
+
+        """
+        self.bv = building_validator
+        offsets = np.asarray(clusters.offsets)
+        probabilities = np.asarray(clusters.probabilities)
+        overlays = np.asarray(clusters.overlays)
+        self.sizes = np.diff(offsets)
+        self.targets = np.asarray(clusters.targets)
+
+        self.entropies = SortedSegments(clusters.entropies, offsets)
+        self.probabilities = SortedSegments(probabilities, offsets)
+        # Computed as in the decision of a cluster, i.e. in float32.
+        self.refutation_confidences = SortedSegments(1 - probabilities, offsets)
+        # Probabilities of points under a BDUni building, whose confirmation threshold is relaxed.
+        overlayed = overlays != 0
+        overlayed_offsets = np.concatenate([[0], np.cumsum(_segment_sum(overlayed, offsets))])
+        self.overlayed_probabilities = SortedSegments(probabilities[overlayed], overlayed_offsets)
+        self.overlay_fractions = _segment_sum(overlays, offsets) / self.sizes
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def make_detailed_group_decisions(self, bv_thresholds: thresholds) -> np.ndarray:
+        """Decision process at the cluster level, for all clusters at once.
+
+        Args:
+            bv_thresholds (thresholds): decision thresholds
+
+        Returns:
+            np.ndarray: detailed classification code of each cluster.
+
+        """
+        return self.make_detailed_group_decisions_batch([bv_thresholds])[0]
+
+    def make_group_decisions(self, bv_thresholds: thresholds) -> np.ndarray:
+        """Final classification code of each cluster (see `make_detailed_group_decisions`)."""
+        return self.make_group_decisions_batch([bv_thresholds])[0]
+
+    def make_group_decisions_batch(
+        self, bv_thresholds: List[thresholds], chunk_size: int = EVALUATION_CHUNK_SIZE
+    ) -> np.ndarray:
+        """Final classification codes of each cluster for each set of thresholds.
+
+        Args:
+            bv_thresholds (List[thresholds]): sets of decision thresholds
+            chunk_size (int): max number of decisions made at once.
+
+        Returns:
+            np.ndarray: (thresholds, clusters) array of final classification codes.
+
+        """
+        return self.bv._get_final_codes(
+            self.make_detailed_group_decisions_batch(bv_thresholds, chunk_size)
+        )
+
+    def make_detailed_group_decisions_batch(
+        self, bv_thresholds: List[thresholds], chunk_size: int = EVALUATION_CHUNK_SIZE
+    ) -> np.ndarray:
+        """Detailed classification codes of each cluster for each set of thresholds.
+
+        Sets of thresholds are evaluated by chunks of at most `chunk_size` decisions.
+
+        Args:
+            bv_thresholds (List[thresholds]): sets of decision thresholds
+            chunk_size (int): max number of decisions made at once.
+
+        Returns:
+            np.ndarray: (thresholds, clusters) array of detailed classification codes.
+
+        """
+        n_thresholds_by_chunk = max(1, chunk_size // max(1, len(self)))
+        chunks = [
+            self._make_detailed_group_decisions_chunk(bv_thresholds[i : i + n_thresholds_by_chunk])
+            for i in range(0, len(bv_thresholds), n_thresholds_by_chunk)
+        ]
+        if not chunks:
+            return np.empty((0, len(self)), dtype=np.int64)
+        return np.concatenate(chunks)
+
+    def _make_detailed_group_decisions_chunk(self, bv_thresholds: List[thresholds]) -> np.ndarray:
+        def get(name: str) -> List[float]:
+            """Value of a threshold in each set."""
+            return [getattr(t, name) for t in bv_thresholds]
+
+        def get_column(name: str) -> np.ndarray:
+            """Value of a threshold in each set, as a column to compare to clusters."""
+            return np.array(get(name))[:, None]
+
+        # HIGH ENTROPY
+        high_entropy = self.entropies.count_greater_equal_batch(
+            get("min_entropy_uncertainty")
+        ) / self.sizes >= get_column("min_frac_entropy_uncertain")
+
+        # CONFIRMATION - threshold is relaxed under BDUni
+        # Points above the relaxed threshold are a superset or a subset of the points above the
+        # threshold, hence the count of points above both.
+        confirmation_thresholds = get("min_confidence_confirmation")
+        relaxed_thresholds = [
+            t.min_confidence_confirmation * t.min_frac_confirmation_factor_if_bd_uni_overlay
+            for t in bv_thresholds
+        ]
+        p_heq_threshold = self.probabilities.count_greater_equal_batch(confirmation_thresholds)
+        overlayed_p_heq_threshold = self.overlayed_probabilities.count_greater_equal_batch(
+            confirmation_thresholds
+        )
+        overlayed_p_heq_relaxed_threshold = self.overlayed_probabilities.count_greater_equal_batch(
+            relaxed_thresholds
+        )
+        ia_confirmed_count = (
+            p_heq_threshold
+            + overlayed_p_heq_relaxed_threshold
+            - np.minimum(overlayed_p_heq_threshold, overlayed_p_heq_relaxed_threshold)
+        )
+        ia_confirmed = ia_confirmed_count / self.sizes >= get_column("min_frac_confirmation")
+
+        # REFUTATION
+        ia_refuted = self.refutation_confidences.count_greater_equal_batch(
+            get("min_confidence_refutation")
+        ) / self.sizes >= get_column("min_frac_refutation")
+        uni_overlayed = self.overlay_fractions >= get_column("min_uni_db_overlay_frac")
+
+        return self.bv._select_detailed_group_codes(
+            high_entropy, ia_confirmed, ia_refuted, uni_overlayed
+        )
@@ -1,34 +1,113 @@
-import functools
 import logging
 import math
 import os
 import os.path as osp
-import pickle
 import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 from glob import glob
-from typing import Any, Dict, List
+from itertools import repeat
+from typing import Any, Dict, List, Tuple
 
 import numpy as np
 import optuna
 import yaml
-from omegaconf import DictConfig, OmegaConf
-from sklearn.metrics import confusion_matrix
+from omegaconf import DictConfig, ListConfig, OmegaConf
+from optuna.distributions import FloatDistribution
+from optuna.trial import TrialState
 from tqdm import tqdm
 
-from lidar_prod.tasks.building_validation import (
-    BuildingValidationClusterInfo,
-    BuildingValidator,
-    thresholds,
-)
-from lidar_prod.tasks.utils import pdal_read_las_array, split_idx_by_dim
+from lidar_prod.commons.result_cache import get_cache_key, hash_config_sections
+from lidar_prod.tasks.building_validation import BuildingValidator, thresholds
+from lidar_prod.tasks.building_validation_evaluation import BuildingValidationEvaluator
+from lidar_prod.tasks.cluster_store import ClusterStore
+from lidar_prod.tasks.utils import ClusterIndex, get_pdal_writer
 
 log = logging.getLogger(__name__)
 
+# Name of the file that holds the key of a shard of prepared clusters, written once the shard is
+# complete (see `BuildingValidationOptimizer.prepare`).
+SHARD_KEY_FILENAME = "key.txt"
+
+# Search space of the decision thresholds of `BuildingValidator`.
+THRESHOLDS_SEARCH_SPACE = {
+    "min_confidence_confirmation": FloatDistribution(0.0, 1.0),
+    "min_frac_confirmation": FloatDistribution(0.0, 1.0),
+    "min_confidence_refutation": FloatDistribution(0.0, 1.0),
+    "min_frac_refutation": FloatDistribution(0.0, 1.0),
+    "min_uni_db_overlay_frac": FloatDistribution(0.5, 1.0),
+    "min_frac_confirmation_factor_if_bd_uni_overlay": FloatDistribution(0.5, 1.0),
+    # Max entropy for 7 classes. When looking at prediction's entropy,
+    # the observed maximal value is aqual to the Shannon entropy divided by two,
+    # so this is what we consider as the max for the min entropy for uncertainty.
+    "min_entropy_uncertainty": FloatDistribution(0.0, -math.log2(1 / 7) / 2.0),
+    "min_frac_entropy_uncertain": FloatDistribution(0.33, 1.0),
+}
+
 
 def constraints_func(trial):
     return trial.user_attrs["constraint"]
 
 
+def get_confusion_matrices(
+    targets: np.ndarray, decisions: np.ndarray, labels: List[int]
+) -> np.ndarray:
+    """Confusion matrices of one or many decision vectors, with a single bincount.
+
+    Same as `sklearn.metrics.confusion_matrix(targets, decisions, labels=labels)` for each
+    decision vector: rows are targets, columns are decisions, in the order of labels, and
+    targets or decisions that are not in labels are ignored.
+
+    Args:
+        targets (np.ndarray): (clusters,) target codes
+        decisions (np.ndarray): (..., clusters) decision codes, e.g. of a batch of trials
+        labels (List[int]): codes, in the order of rows and columns of the matrices
+
+    Returns:
+        np.ndarray: (..., labels, labels) matrices of counts.
+
+    """
+    labels = np.asarray(labels)
+    decisions = np.asarray(decisions)
+    n_labels = len(labels)
+    order = np.argsort(labels)
+
+    def get_label_idx(codes: np.ndarray) -> np.ndarray:
+        """Index of codes in labels, or n_labels for codes that are not in labels."""
+        sorted_idx = np.minimum(np.searchsorted(labels[order], codes), n_labels - 1)
+        return np.where(labels[order][sorted_idx] == codes, order[sorted_idx], n_labels)
+
+    # Codes out of labels are counted in an extra row and column, which are dropped.
+    n_bins = n_labels + 1
+    target_idx = get_label_idx(np.asarray(targets))
+    decision_idx = get_label_idx(decisions.reshape(-1, decisions.shape[-1]))
+    batch_idx = np.arange(len(decision_idx))[:, None]
+    counts = np.bincount(
+        ((batch_idx * n_bins + target_idx) * n_bins + decision_idx).ravel(),
+        minlength=len(decision_idx) * n_bins * n_bins,
+    )
+    counts = counts.reshape(len(decision_idx), n_bins, n_bins)[:, :n_labels, :n_labels]
+    return counts.reshape(decisions.shape[:-1] + (n_labels, n_labels))
+
+
+def save_prepared_las(points: np.ndarray, prepared_las_path: str, las_metadata: dict):
+    """Write points prepared for building validation to a LAS file."""
+    os.makedirs(osp.dirname(prepared_las_path), exist_ok=True)
+    get_pdal_writer(prepared_las_path, las_metadata).pipeline(points).execute()
+
+
+def _is_in_memory(study: optuna.Study) -> bool:
+    """Whether a study is stored in the memory of its process, i.e. cannot be shared."""
+    return isinstance(study._storage, optuna.storages.InMemoryStorage)
+
+
+def _normalize(cm: np.ndarray, axis=None) -> np.ndarray:
+    """Normalize confusion matrices by their sums along axis, with 0 when dividing by 0."""
+    with np.errstate(all="ignore"):
+        normalized = cm / cm.sum(axis=axis, keepdims=True)
+    return np.nan_to_num(normalized)
+
+
 class BuildingValidationOptimizer:
     r"""Optimizer of the decision thresholds used by `BuildingValidator`.
 
@@ -55,6 +134,8 @@ class BuildingValidationOptimizer:
     All outputs and intermediary files are stored in a `results_output_dir`
     directory, so that operations may be resumed at any steps, for instance
     to rerun a thresholds optimization with a different optimizer configuration.
+    Tiles are prepared over a pool of `n_workers` processes, and tiles that
+    were already prepared with the same content and config are skipped.
 
     """
 
@@ -67,9 +148,13 @@ class BuildingValidationOptimizer:
         design: Any,
         buildings_correction_labels: Any,
         use_final_classification_codes: bool = False,
+        n_workers: int = 1,
+        save_prepared_las: bool = True,
         debug=False,
     ):
         self.debug = debug
+        self.n_workers = n_workers
+        self.save_prepared_las = save_prepared_las
         self.todo = todo
         self.paths = paths
         self.bv = building_validator
@@ -79,6 +164,13 @@ class BuildingValidationOptimizer:
         self.use_final_classification_codes = use_final_classification_codes
         self.setup()
 
+    def __getstate__(self):
+        # An in-memory study cannot be shared with worker processes, which only prepare tiles.
+        state = self.__dict__.copy()
+        if _is_in_memory(self.study):
+            state["study"] = None
+        return state
+
     def run(self):
         """Run decision threshold optimization."""
         if "prepare" in self.todo:
@@ -97,6 +189,8 @@ class BuildingValidationOptimizer:
         codes to adapt to those of the optimization dataset.
 
         """
+        if "update" in self.todo and not self.save_prepared_las:
+            raise ValueError("The update step needs prepared LAS: set save_prepared_las to true.")
         if "prepare" in self.todo or "update" in self.todo:
             las_paths = glob(osp.join(self.paths.input_las_dir, "*.las"))
             laz_paths = glob(osp.join(self.paths.input_las_dir, "*.laz"))
@@ -136,21 +230,102 @@ class BuildingValidationOptimizer:
         """Preparation step.
 
         Prepares and saves each point cloud in the specified directory,
-        and extracts all cluster information in a list of
-        `BuildingValidationClusterInfo` objects that is serialized into
-        a pickle object.
+        and extracts all cluster information into a `ClusterStore`.
+
+        Tiles are prepared over a pool of `n_workers` processes. The clusters
+        of each tile are written to a shard of the store, with a key that
+        depends on the content of the tile and on the config of the
+        preparation. Tiles whose shard already has the same key are skipped,
+        so that an interrupted preparation can be resumed, and that adding
+        tiles to the dataset only costs the new tiles. Shards are finally
+        merged into the store, in the order of tiles.
 
         """
-        clusters = []
-        for src_las_path, prepared_las_path in tqdm(
-            zip(self.las_filepaths, self.prepared_las_filepaths),
-            desc="Preparation.",
-            total=len(self.las_filepaths),
-            unit="tiles",
-        ):
-            self.bv.prepare(src_las_path, prepared_las_path, True)
-            clusters += self._extract_clusters_from_las(prepared_las_path)
-        self._dump_clusters(clusters)
+        shard_dirs = [
+            osp.join(self.paths.cluster_store_dir, "shards", osp.basename(las_path))
+            for las_path in self.las_filepaths
+        ]
+        tile_args = (
+            self.las_filepaths,
+            self.prepared_las_filepaths,
+            shard_dirs,
+            repeat(self._get_preparation_hash()),
+        )
+        n_workers = min(self.n_workers, len(self.las_filepaths))
+        executor = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else nullcontext()
+        with executor:
+            map_func = executor.map if n_workers > 1 else map
+            skipped = list(
+                tqdm(
+                    map_func(self._prepare_tile, *tile_args),
+                    desc="Preparation.",
+                    total=len(self.las_filepaths),
+                    unit="tiles",
+                )
+            )
+        if any(skipped):
+            log.info(f"{sum(skipped)} tile(s) out of {len(skipped)} were already prepared")
+
+        store = ClusterStore.create(self.paths.cluster_store_dir)
+        for shard_dir in shard_dirs:
+            store.extend(ClusterStore(shard_dir))
+        log.info(f"Stored {len(store)} clusters in {self.paths.cluster_store_dir}")
+
+    def _prepare_tile(
+        self, src_las_path: str, prepared_las_path: str, shard_dir: str, preparation_hash: str
+    ) -> bool:
+        """Prepares a tile and writes its clusters to a shard, unless it is up to date.
+
+        Returns:
+            bool: True if the tile was skipped.
+
+        """
+        key = get_cache_key(src_las_path, preparation_hash)
+        key_path = osp.join(shard_dir, SHARD_KEY_FILENAME)
+        if osp.isfile(key_path) and (osp.isfile(prepared_las_path) or not self.save_prepared_las):
+            with open(key_path, "r") as f:
+                if f.read() == key:
+                    return True
+        if osp.isfile(key_path):
+            # The shard is invalid until it is written again.
+            os.remove(key_path)
+
+        las_metadata = self.bv.prepare(src_las_path, prepared_las_path, save_result=False)
+        points = self.bv.pipeline.arrays[0]
+        # The prepared LAS is written in the background while clusters are extracted.
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            if self.save_prepared_las:
+                saved = writer.submit(save_prepared_las, points, prepared_las_path, las_metadata)
+            shard = ClusterStore.create(shard_dir)
+            shard.append(**self._extract_clusters(points))
+            if self.save_prepared_las:
+                saved.result()  # raises the errors of the writer
+        with open(key_path, "w") as f:
+            f.write(key)
+        return False
+
+    def _get_preparation_hash(self) -> str:
+        """Hash of the parameters that prepared tiles and their clusters depend on."""
+        sections = {
+            "shp_path": self.bv.shp_path,
+            "cluster": self.bv.cluster,
+            "bd_uni_request": self.bv.bd_uni_request,
+            "epsg": self.bv.data_format.epsg,
+            "las_dimensions": self.bv.data_format.las_dimensions,
+            "codes": self.bv.codes,
+            "overlay": self.bv.overlay,
+            "candidate_buildings_codes": self.bv.candidate_buildings_codes,
+            "buildings_correction_labels": self.buildings_correction_labels,
+        }
+        sections = {
+            name: (
+                OmegaConf.to_container(value, resolve=True)
+                if isinstance(value, (DictConfig, ListConfig))
+                else value
+            )
+            for name, value in sections.items()
+        }
+        return hash_config_sections(OmegaConf.create(sections), sections.keys())
 
     def optimize(self):
         """Optimization step.
@@ -159,12 +334,47 @@ class BuildingValidationOptimizer:
         Runs the genetic algorithm for N generations.
         For each set of decision thresholds, computes the Recall, Precision,
         and Automation of the `BuildingValidator`.
+        Trials are asked to the study by batches (e.g. a generation), evaluated
+        together, and then told to the study.
+        With `n_workers` > 1, trials are split over a pool of processes that
+        share the study through its storage (e.g. a journal file or a SQLite
+        database), and that memory-map the same `ClusterStore`.
+        With `design.resume`, `design.n_trials` is the number of finished
+        trials of the study, e.g. to resume an interrupted study from its
+        storage. A new study may be warm-started from known thresholds (see
+        `_warm_start`).
         Finally, serializes the set of optimal thresholds.
 
         """
-        clusters = self._load_clusters()
-        objective = functools.partial(self._objective, clusters=clusters)
-        self.study.optimize(objective, n_trials=self.design.n_trials)
+        n_trials = self.design.n_trials
+        finished_trials = self.study.get_trials(deepcopy=False, states=(TrialState.COMPLETE,))
+        if finished_trials:
+            # Otherwise, a seeded sampler would sample the thresholds of previous runs again.
+            self.study.sampler.reseed_rng()
+        else:
+            self._warm_start()
+        if self.design.get("resume", True):
+            if finished_trials:
+                log.info(f"Resuming a study with {len(finished_trials)} finished trials.")
+            n_trials = max(0, n_trials - len(finished_trials))
+            if not n_trials:
+                log.warning(
+                    f"The study already has {len(finished_trials)} finished trials: no trial is "
+                    f"run. Increase design.n_trials, or set design.resume=false to run "
+                    f"{self.design.n_trials} more trials."
+                )
+        n_workers = min(self.n_workers, n_trials)
+        if n_workers > 1:
+            if _is_in_memory(self.study):
+                raise ValueError(
+                    "Optimization with n_workers > 1 needs a study storage shared by processes "
+                    "(see study.storage)."
+                )
+            worker_n_trials = [len(idx) for idx in np.array_split(range(n_trials), n_workers)]
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                list(executor.map(self._run_trials, worker_n_trials, range(n_workers)))
+        elif n_trials:
+            self._run_trials(n_trials)
         best_thresholds = self._select_best_rules(self.study)
         log.info(f"Best_trial thresholds: \n{best_thresholds}")
         self._dump_best_rules(best_thresholds)
@@ -186,11 +396,10 @@ class BuildingValidationOptimizer:
             dict: a dictionnary of metrics of schema {metric_name:metric_value}.
 
         """
-        clusters = self._load_clusters()
+        evaluator = BuildingValidationEvaluator(self.bv, self._load_clusters())
         self._set_thresholds_from_file_if_available()
-        decisions = np.array([self.bv._make_group_decision(c) for c in clusters])
-        mts_gt = np.array([c.target for c in clusters])
-        metrics_dict = self.evaluate_decisions(mts_gt, decisions)
+        decisions = evaluator.make_group_decisions(self.bv.thresholds)
+        metrics_dict = self.evaluate_decisions(evaluator.targets, decisions)
         log.info(f"\n Results:\n{self._get_results_logs_str(metrics_dict)}")
         self._save_results_to_yaml(metrics_dict)
 
@@ -227,51 +436,43 @@ class BuildingValidationOptimizer:
             self.bv.update(prepared_las_path, target_las_path)
             log.info(f"Saved to {target_las_path}")
 
-    def _extract_clusters_from_las(
-        self, prepared_las_path: str
-    ) -> List[BuildingValidationClusterInfo]:
-        """Extract a cluster information object  in a prepared LAS.
+    def _extract_clusters(self, points: np.ndarray) -> Dict[str, np.ndarray]:
+        """Extract the cluster information of a prepared point cloud, for all clusters at once.
 
         Args:
-            prepared_las (str): path to LAS prepared for building validation.
+            points (np.ndarray): points prepared for building validation.
 
         Returns:
-            List[BuildingValidationClusterInfo]: cluster information for each cluster of
-            candidate buildings
+            Dict[str, np.ndarray]: columns of the clusters, to be appended to a `ClusterStore`.
 
         """
-        las, _ = pdal_read_las_array(prepared_las_path, self.bv.data_format.epsg)
-        # las: laspy.LasData = laspy.read(prepared_las_path)
-        dim_cluster_id = las[self.bv.data_format.las_dimensions.ClusterID_candidate_building]
-        dim_classification = las[self.bv.data_format.las_dimensions.classification]
-
-        split_idx = split_idx_by_dim(dim_cluster_id)
-        # removes the group of unclustered points, which has ClusterID = 0
-        START_IDX_OF_CLUSTERS = 1
-        split_idx = split_idx[START_IDX_OF_CLUSTERS:]
-        clusters = []
-        for pts_idx in tqdm(split_idx, desc="Extract cluster info from LAS", unit="clusters"):
-            infos: BuildingValidationClusterInfo = self.bv._extract_cluster_info_by_idx(
-                las, pts_idx
-            )
-            infos.target = self._define_MTS_ground_truth_flag(dim_classification[pts_idx])
-            clusters += [infos]
-        return clusters
-
-    def _define_MTS_ground_truth_flag(self, targets) -> int:
-        """Based on the fraction of confirmed building points, set the nature of the shape or
-        declare an ambiguous case"""
-        tp_frac = np.mean(
-            np.isin(
-                targets,
-                self.buildings_correction_labels.codes.true_positives,
-            )
+        dims = self.bv.data_format.las_dimensions
+        # unclustered points, which have ClusterID = 0, are not indexed
+        cluster_index = ClusterIndex(points[dims.ClusterID_candidate_building])
+        true_positives = np.isin(
+            points[dims.classification], self.buildings_correction_labels.codes.true_positives
+        )
+        return {
+            "probabilities": points[dims.ai_building_proba][cluster_index.point_idx],
+            "overlays": points[dims.uni_db_overlay][cluster_index.point_idx],
+            "entropies": points[dims.entropy][cluster_index.point_idx],
+            "sizes": cluster_index.sizes,
+            "targets": self._define_MTS_ground_truth_flags(
+                cluster_index.segment_mean(true_positives)
+            ),
+        }
+
+    def _define_MTS_ground_truth_flags(self, tp_fractions: np.ndarray) -> np.ndarray:
+        """Based on the fraction of confirmed building points of each cluster, set the nature
+        of the shape or declare an ambiguous case"""
+        return np.select(
+            [
+                tp_fractions >= self.buildings_correction_labels.min_frac.true_positives,
+                tp_fractions < self.buildings_correction_labels.min_frac.false_positives,
+            ],
+            [self.bv.codes.final.building, self.bv.codes.final.not_building],
+            default=self.bv.codes.final.unsure,
         )
-        if tp_frac >= self.buildings_correction_labels.min_frac.true_positives:
-            return self.bv.codes.final.building
-        elif tp_frac < self.buildings_correction_labels.min_frac.false_positives:
-            return self.bv.codes.final.not_building
-        return self.bv.codes.final.unsure
 
     def _compute_penalty(self, auto, precision, recall):
         """Positive float indicative a solution violates the constraint of minimal
@@ -285,58 +486,94 @@ class BuildingValidationOptimizer:
             penalty += self.design.constraints.min_automation_constraint - auto
         return [penalty]
 
-    def _objective(self, trial, clusters: List[BuildingValidationClusterInfo] = None):
-        """Objective function for optuna optimization.
-        Use prepared list to access group-level probas and targets.
+    def _warm_start(self):
+        """Enqueue known thresholds as the first trials of a new study.
+
+        With `design.warm_start.application_thresholds`, the thresholds of the
+        `BuildingValidator` (i.e. the ones in production) are enqueued. With
+        `design.warm_start.previous_study`, the thresholds of the Pareto front of
+        a previous study (e.g. optimized for a previous model) are enqueued.
+        This seeds the first population of NSGA-II with good solutions, so that
+        fewer trials are needed to converge, e.g. after a model update.
+
+        """
+        warm_start = self.design.get("warm_start", {})
+        seeds = []
+        if warm_start.get("application_thresholds", False):
+            seeds.append(
+                {
+                    name: float(getattr(self.bv.thresholds, name))
+                    for name in THRESHOLDS_SEARCH_SPACE
+                }
+            )
+        if warm_start.get("previous_study", None) is not None:
+            previous_study = warm_start.previous_study()
+            seeds.extend(trial.params for trial in previous_study.best_trials)
+        for params in seeds:
+            self.study.enqueue_trial(params, skip_if_exists=True)
+        if seeds:
+            log.info(f"Warm-started the study with {len(seeds)} known sets of thresholds.")
+
+    def _run_trials(self, n_trials: int, worker_idx: int = 0):
+        """Run trials of the study by batches, e.g. in a worker process.
+
+        Args:
+            n_trials (int): number of trials to run
+            worker_idx (int): index of the worker process, used to reseed its sampler.
+
+        """
+        if worker_idx:
+            # Otherwise, workers with a seeded sampler would sample the same thresholds.
+            self.study.sampler.reseed_rng()
+        evaluator = BuildingValidationEvaluator(self.bv, self._load_clusters())
+        batch_size = self.design.get("trials_batch_size", 1)
+        with tqdm(
+            total=n_trials, desc="Optimization.", unit="trials", position=worker_idx
+        ) as progress:
+            while progress.n < n_trials:
+                trials = [
+                    self.study.ask(THRESHOLDS_SEARCH_SPACE)
+                    for _ in range(min(batch_size, n_trials - progress.n))
+                ]
+                for trial, values in zip(trials, self._evaluate_trials(trials, evaluator)):
+                    self.study.tell(trial, values)
+                progress.update(len(trials))
+
+    def _evaluate_trials(
+        self, trials: List[optuna.Trial], evaluator: BuildingValidationEvaluator
+    ) -> List[Tuple[float, float, float]]:
+        """Objective function for optuna optimization, for a batch of trials.
+        Use prepared clusters to make group-level decisions for all trials at once,
+        and access targets.
 
         Args:
-            trial: optuna trial
-            clusters (List[BuildngValidationClusterInfo], optional): _description_.
-            Defaults to None.
+            trials (List[optuna.Trial]): trials asked to the study, with thresholds sampled in
+            THRESHOLDS_SEARCH_SPACE
+            evaluator (BuildingValidationEvaluator): decisions on prepared clusters.
 
         Returns:
-            float, float, float: automatisation, precision, recall
+            List[Tuple[float, float, float]]: automatisation, precision, recall of each trial
 
         """
-        params = {
-            "min_confidence_confirmation": trial.suggest_float(
-                "min_confidence_confirmation", 0.0, 1.0
-            ),
-            "min_frac_confirmation": trial.suggest_float("min_frac_confirmation", 0.0, 1.0),
-            "min_confidence_refutation": trial.suggest_float(
-                "min_confidence_refutation", 0.0, 1.0
-            ),
-            "min_frac_refutation": trial.suggest_float("min_frac_refutation", 0.0, 1.0),
-            "min_uni_db_overlay_frac": trial.suggest_float("min_uni_db_overlay_frac", 0.5, 1.0),
-            "min_frac_confirmation_factor_if_bd_uni_overlay": trial.suggest_float(
-                "min_frac_confirmation_factor_if_bd_uni_overlay", 0.5, 1.0
-            ),
-            # Max entropy for 7 classes. When looking at prediction's entropy,
-            # the observed maximal value is aqual to the Shannon entropy divided by two,
-            # so this is what we consider as the max for the min entropy for uncertainty.
-            "min_entropy_uncertainty": trial.suggest_float(
-                "min_entropy_uncertainty", 0.0, -math.log2(1 / 7) / 2.0
-            ),
-            "min_frac_entropy_uncertain": trial.suggest_float(
-                "min_frac_entropy_uncertain", 0.33, 1.0
-            ),
-        }
-        self.bv.thresholds = thresholds(**params)
-        decisions = np.array([self.bv._make_group_decision(c) for c in clusters])
-        mts_gt = np.array([c.target for c in clusters])
-        metrics_dict = self.evaluate_decisions(mts_gt, decisions)
-
+        trials_thresholds = [thresholds(**trial.params) for trial in trials]
+        # The evaluator bounds the memory used to make decisions, by chunks of trials.
+        decisions = evaluator.make_group_decisions_batch(trials_thresholds)
+        metrics_dict = self.evaluate_decisions(evaluator.targets, decisions)
         # WARNING: order should always be automation, precision, recall
-        values = (
-            metrics_dict[self.design.metrics.proportion_of_automated_decisions],
-            metrics_dict[self.design.metrics.precision],
-            metrics_dict[self.design.metrics.recall],
+        values = np.stack(
+            [
+                metrics_dict[self.design.metrics.proportion_of_automated_decisions],
+                metrics_dict[self.design.metrics.precision],
+                metrics_dict[self.design.metrics.recall],
+            ],
+            axis=-1,
         )
-        auto, precision, recall = (value if not np.isnan(value) else 0 for value in values)
+        trials_values = np.nan_to_num(values, nan=0.0).reshape(len(trials), 3).tolist()
 
-        # This enables constrained optimization
-        trial.set_user_attr("constraint", self._compute_penalty(auto, precision, recall))
-        return auto, precision, recall
+        for trial, (auto, precision, recall) in zip(trials, trials_values):
+            # This enables constrained optimization
+            trial.set_user_attr("constraint", self._compute_penalty(auto, precision, recall))
+        return [tuple(values) for values in trials_values]
 
     def _select_best_rules(self, study):
         """Find the trial that meet constraints and that maximizes automation."""
@@ -349,9 +586,10 @@ class BuildingValidationOptimizer:
             best = respect_constraints[0]
         except Exception:
             log.warning("No trial respecting constraints - returning best metrics-products.")
+            # Best trials of a constrained study only include feasible trials.
             trials = sorted(
-                study.best_trials,
-                key=lambda x: np.product(x.values),
+                study.get_trials(states=(TrialState.COMPLETE,)),
+                key=lambda x: np.prod(x.values),
                 reverse=True,
             )
             best = trials[0]
@@ -363,18 +601,11 @@ class BuildingValidationOptimizer:
         best_trial_params.dump(self.paths.building_validation_thresholds)
         log.info(f"Saved best params to {self.paths.building_validation_thresholds}")
 
-    def _dump_clusters(self, clusters):
-        """Serializes the list of cluster-level information objects."""
-        with open(self.paths.group_info_pickle_path, "wb") as f:
-            pickle.dump(clusters, f)
-            log.info(f"Pickled groups to {self.paths.group_info_pickle_path}")
-
-    def _load_clusters(self):
-        """Deserializes the list of cluster-level information objects."""
-        with open(self.paths.group_info_pickle_path, "rb") as f:
-            clusters = pickle.load(f)
-            log.info(f"Loading pickled groups from {self.paths.group_info_pickle_path}")
-        return clusters
+    def _load_clusters(self) -> ClusterStore:
+        """Opens the store of cluster-level information, memory-mapped."""
+        store = ClusterStore(self.paths.cluster_store_dir)
+        log.info(f"Loaded {len(store)} clusters from {self.paths.cluster_store_dir}")
+        return store
 
     def evaluate_decisions(self, mts_gt, ia_decision) -> Dict[str, Any]:
         r"""Evaluate confirmation and refutation decisions.
@@ -409,36 +640,33 @@ class BuildingValidationOptimizer:
 
         Recall : (Yu + Yc) / (Yu + Yn + Yc)
 
+        The matrix of counts is computed once, and every metric derives from it. Decisions
+        of a batch of trials may be evaluated at once.
+
         Args:
             mts_gt (np.array): ground truth of rule- based classification (0, 1, 2)
-            ia_decision (np.array): AI application decision (0, 1, 2)
+            ia_decision (np.array): AI application decision (0, 1, 2), or (trials, clusters)
+            decisions of a batch of trials.
 
         Returns:
-            dict: dictionnary of metrics.
+            dict: dictionnary of metrics. For a batch of trials, each metric (but the count of
+            groups) has a leading trials axis.
 
         """
+        ia_decision = np.asarray(ia_decision)
         metrics_dict = dict()
 
         # VECTORS INFOS
-        num_shapes = len(ia_decision)
+        num_shapes = ia_decision.shape[-1]
         metrics_dict.update({self.design.metrics.groups_count: num_shapes})
 
-        cm = confusion_matrix(
-            mts_gt,
-            ia_decision,
-            labels=self.design.confusion_matrix_order,
-            normalize=None,
-        )
-        metrics_dict.update({self.design.metrics.confusion_matrix_no_norm: cm.copy()})
+        # All metrics derive from the matrices of counts.
+        cm_counts = get_confusion_matrices(mts_gt, ia_decision, self.design.confusion_matrix_order)
+        metrics_dict.update({self.design.metrics.confusion_matrix_no_norm: cm_counts.copy()})
 
         # CRITERIA
-        cm = confusion_matrix(
-            mts_gt,
-            ia_decision,
-            labels=self.design.confusion_matrix_order,
-            normalize="all",
-        )
-        P_MTS_U, P_MTS_N, P_MTS_C = cm.sum(axis=1)
+        cm = _normalize(cm_counts, axis=(-2, -1))
+        P_MTS_U, P_MTS_N, P_MTS_C = np.moveaxis(cm.sum(axis=-1), -1, 0)
         metrics_dict.update(
             {
                 self.design.metrics.group_unsure: P_MTS_U,
@@ -446,7 +674,7 @@ class BuildingValidationOptimizer:
                 self.design.metrics.group_building: P_MTS_C,
             }
         )
-        P_IA_u, P_IA_r, P_IA_c = cm.sum(axis=0)
+        P_IA_u, P_IA_r, P_IA_c = np.moveaxis(cm.sum(axis=-2), -1, 0)
         PAD = P_IA_c + P_IA_r
         metrics_dict.update(
             {
@@ -458,14 +686,9 @@ class BuildingValidationOptimizer:
         )
 
         # ACCURACIES
-        cm = confusion_matrix(
-            mts_gt,
-            ia_decision,
-            labels=self.design.confusion_matrix_order,
-            normalize="pred",
-        )
-        RA = cm[1, 1]
-        CA = cm[2, 2]
+        cm = _normalize(cm_counts, axis=-2)
+        RA = cm[..., 1, 1]
+        CA = cm[..., 2, 2]
         metrics_dict.update(
             {
                 self.design.metrics.refutation_accuracy: RA,
@@ -474,33 +697,24 @@ class BuildingValidationOptimizer:
         )
 
         # NORMALIZED CM
-        cm = confusion_matrix(
-            mts_gt,
-            ia_decision,
-            labels=self.design.confusion_matrix_order,
-            normalize="true",
-        )
+        cm = _normalize(cm_counts, axis=-1)
         metrics_dict.update({self.design.metrics.confusion_matrix_norm: cm.copy()})
 
         # QUALITY
-        non_ambiguous_idx = mts_gt != self.bv.codes.final.unsure
-        ia_decision = ia_decision[non_ambiguous_idx]
-        mts_gt = mts_gt[non_ambiguous_idx]
-        cm = confusion_matrix(
-            mts_gt,
-            ia_decision,
-            labels=self.design.confusion_matrix_order,
-            normalize="all",
-        )
-        final_true_positives = cm[2, 0] + cm[2, 2]  # Yu + Yc
-        final_false_positives = cm[1, 2]  # Nc
+        # Ambiguous clusters are the ones of the first row (unsure targets).
+        cm = cm_counts.copy()
+        cm[..., 0, :] = 0
+        cm = _normalize(cm, axis=(-2, -1))
+        final_true_positives = cm[..., 2, 0] + cm[..., 2, 2]  # Yu + Yc
+        final_false_positives = cm[..., 1, 2]  # Nc
 
-        #  precision = (Yu + Yc) / (Yu + Yc + Nc)
-        precision = final_true_positives / (final_true_positives + final_false_positives)
+        with np.errstate(all="ignore"):
+            #  precision = (Yu + Yc) / (Yu + Yc + Nc)
+            precision = final_true_positives / (final_true_positives + final_false_positives)
 
-        # recall = (Yu + Yc) / (Yu + Yn + Yc)
-        positives = cm[2, :].sum()
-        recall = final_true_positives / positives
+            # recall = (Yu + Yc) / (Yu + Yn + Yc)
+            positives = cm[..., 2, :].sum(axis=-1)
+            recall = final_true_positives / positives
 
         metrics_dict.update(
             {
@@ -509,7 +723,11 @@ class BuildingValidationOptimizer:
             }
         )
 
-        return metrics_dict
+        # Scalars rather than 0-d arrays for a single trial.
+        return {
+            name: value[()] if isinstance(value, np.ndarray) and value.ndim == 0 else value
+            for name, value in metrics_dict.items()
+        }
 
     def _get_results_logs_str(self, metrics_dict: dict):
         """Format all metrics as a str for logging."""
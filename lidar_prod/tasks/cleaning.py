@@ -4,12 +4,41 @@ import os.path as osp
 from typing import Iterable, Optional, Union
 
 import laspy
+import numpy as np
 import pdal
+from numpy.lib import recfunctions
 
 from lidar_prod.tasks.utils import get_pdal_writer, pdal_read_las_array
 
 log = logging.getLogger(__name__)
 
+# Dimensions of the LAS point formats, as named by pdal. Other dimensions are extra dimensions.
+LAS_STANDARD_DIMENSIONS = [
+    "X",
+    "Y",
+    "Z",
+    "Intensity",
+    "ReturnNumber",
+    "NumberOfReturns",
+    "ScanDirectionFlag",
+    "EdgeOfFlightLine",
+    "Classification",
+    "Synthetic",
+    "KeyPoint",
+    "Withheld",
+    "Overlap",
+    "ScanAngleRank",
+    "UserData",
+    "PointSourceId",
+    "GpsTime",
+    "ScanChannel",
+    "ClassFlags",
+    "Red",
+    "Green",
+    "Blue",
+    "Infrared",
+]
+
 
 class Cleaner:
     """Keep only necessary extra dimensions channels."""
@@ -61,7 +90,18 @@ class Cleaner:
 
         """
         points, metadata = pdal_read_las_array(src_las_path, epsg)
+        self.save(points, target_las_path, metadata)
+
+    def save(self, points: np.ndarray, target_las_path: str, las_metadata: dict):
+        """Save points to a LAS, keeping only the specified extra dimensions.
 
+        Args:
+            points (np.ndarray): named array of points, e.g. from an executed pdal pipeline.
+            target_las_path (str): output LAS path, with specified extra dims.
+            las_metadata (dict): metadata of the input las, used to propagate its header (epsg,
+        las version, etc) to the output las
+
+        """
         # Check input dims to see what we can keep.
         input_dims = points.dtype.fields.keys()
         self.extra_dims_as_dict = {
@@ -69,12 +109,33 @@ class Cleaner:
         }
 
         pipeline = pdal.Pipeline(arrays=[points]) | get_pdal_writer(
-            target_las_path, reader_metadata=metadata, extra_dims=self.get_extra_dims_as_str()
+            target_las_path, reader_metadata=las_metadata, extra_dims=self.get_extra_dims_as_str()
         )
         os.makedirs(osp.dirname(target_las_path), exist_ok=True)
         pipeline.execute()
         log.info(f"Saved to {target_las_path}")
 
+    def remove_dimensions_from_array(self, points: np.ndarray) -> np.ndarray:
+        """Remove extra dimensions from a (pdal) named array of points.
+
+        Standard LAS dimensions are always kept. The returned array is a compact copy, so that
+        the memory of removed dimensions can be released.
+
+        """
+        # if we want to keep all dimension, we do nothing
+        if self.extra_dims == ["all"]:
+            return points
+
+        dimensions_to_keep = [
+            dimension
+            for dimension in points.dtype.names
+            if dimension in LAS_STANDARD_DIMENSIONS or dimension in self.extra_dims_as_dict
+        ]
+        if len(dimensions_to_keep) == len(points.dtype.names):
+            return points
+
+        return recfunctions.repack_fields(points[dimensions_to_keep])
+
     def remove_dimensions(self, las_data: laspy.lasdata.LasData):
         """remove dimension from (laspy) data"""
         # if we want to keep all dimension, we do nothing
@@ -0,0 +1,179 @@
+import os
+import os.path as osp
+from typing import Iterable
+
+import numpy as np
+
+from lidar_prod.tasks.building_validation import BuildingValidationClusterInfo
+
+# Columns with a value per point, stored in the order of clusters.
+POINT_COLUMNS = {
+    "probabilities": np.float32,
+    "overlays": np.uint8,
+    "entropies": np.float32,
+}
+# Columns with a value per cluster. Targets are final classification codes.
+CLUSTER_COLUMNS = {"targets": np.uint8}
+# Points of the i-th cluster are the ones in [offsets[i], offsets[i + 1]).
+OFFSETS = "offsets"
+
+
+def _get_column_path(directory: str, name: str) -> str:
+    return osp.join(directory, f"{name}.npy")
+
+
+def _append_to_npy(path: str, values: np.ndarray, start: int):
+    """Write values at a position of a 1D .npy file, and drop any value after them.
+
+    Headers of .npy files keep spare space for the length of their first axis to grow, so that
+    the header is rewritten in place with the same size.
+
+    Args:
+        path (str): path to the .npy file
+        values (np.ndarray): values to append
+        start (int): position of the first value, at most the length of the file array.
+
+    """
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version != (1, 0):
+            raise ValueError(f"Unsupported .npy format version {version} for {path}")
+        (length,), fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        if start > length:
+            raise ValueError(f"Cannot append at {start} to an array of length {length} in {path}")
+        f.seek(f.tell() + start * dtype.itemsize)
+        f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+        f.truncate()
+        f.seek(0)
+        np.lib.format.write_array_header_1_0(
+            f,
+            {
+                "descr": np.lib.format.dtype_to_descr(dtype),
+                "fortran_order": fortran_order,
+                "shape": (start + len(values),),
+            },
+        )
+
+
+class ClusterStore:
+    """Columnar store of the clusters of candidate buildings used to optimize thresholds.
+
+    Values of the points of all clusters are concatenated in one .npy file per column, and
+    clusters are delimited by offsets, as in a compressed sparse row layout. Clusters are
+    appended incrementally (e.g. tile by tile during preparation), and the store is opened by
+    memory-mapping its columns, in constant time whatever its size.
+
+    The store is a sequence of `BuildingValidationClusterInfo`, whose arrays are views of the
+    columns.
+    """
+
+    def __init__(self, directory: str):
+        """Opens an existing store, with its columns memory-mapped in read-only mode.
+
+        Points and targets appended after the last offset (e.g. if an append was interrupted)
+        are ignored.
+
+        Args:
+            directory (str): directory of the store.
+
+        """
+        self.directory = directory
+        self._open()
+
+    def _open(self):
+        self.offsets = np.load(_get_column_path(self.directory, OFFSETS), mmap_mode="r")
+        n_points = self.offsets[-1]
+        for name in POINT_COLUMNS:
+            column = np.load(_get_column_path(self.directory, name), mmap_mode="r")
+            setattr(self, name, column[:n_points])
+        for name in CLUSTER_COLUMNS:
+            column = np.load(_get_column_path(self.directory, name), mmap_mode="r")
+            setattr(self, name, column[: len(self)])
+
+    @staticmethod
+    def create(directory: str) -> "ClusterStore":
+        """Creates an empty store, replacing the columns of any existing one."""
+        os.makedirs(directory, exist_ok=True)
+        for name, dtype in {**POINT_COLUMNS, **CLUSTER_COLUMNS}.items():
+            np.save(_get_column_path(directory, name), np.empty(0, dtype=dtype))
+        np.save(_get_column_path(directory, OFFSETS), np.zeros(1, dtype=np.int64))
+        return ClusterStore(directory)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> BuildingValidationClusterInfo:
+        if not -len(self) <= i < len(self):
+            raise IndexError(f"Cluster index {i} out of range for a store of {len(self)}")
+        i = i % len(self)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return BuildingValidationClusterInfo(
+            self.probabilities[start:end],
+            self.overlays[start:end],
+            self.entropies[start:end],
+            int(self.targets[i]),
+        )
+
+    def append(
+        self,
+        probabilities: np.ndarray,
+        overlays: np.ndarray,
+        entropies: np.ndarray,
+        sizes: np.ndarray,
+        targets: np.ndarray,
+    ):
+        """Appends clusters to the store, which is then opened again.
+
+        Offsets are written last, so that the store stays consistent if an append is
+        interrupted: values written after the last offset are then overwritten by the next
+        append.
+
+        Args:
+            probabilities (np.ndarray): building probability of each point, in cluster order
+            overlays (np.ndarray): BDUni overlay flag of each point, in cluster order
+            entropies (np.ndarray): entropy of each point, in cluster order
+            sizes (np.ndarray): number of points of each cluster
+            targets (np.ndarray): target of each cluster
+
+        """
+        sizes = np.asarray(sizes, dtype=np.int64)
+        if not len(probabilities) == len(overlays) == len(entropies) == sizes.sum():
+            raise ValueError("Point columns must have as many values as the points of clusters.")
+        if len(targets) != len(sizes):
+            raise ValueError("Targets must have as many values as clusters.")
+        n_points = int(self.offsets[-1])
+        columns = {
+            "probabilities": (probabilities, n_points),
+            "overlays": (overlays, n_points),
+            "entropies": (entropies, n_points),
+            "targets": (targets, len(self)),
+            OFFSETS: (n_points + np.cumsum(sizes), len(self) + 1),
+        }
+        for name, (values, start) in columns.items():
+            _append_to_npy(_get_column_path(self.directory, name), values, start)
+        self._open()
+
+    def extend(self, other: "ClusterStore"):
+        """Appends the clusters of another store, e.g. of a shard of the store."""
+        self.append(
+            other.probabilities,
+            other.overlays,
+            other.entropies,
+            np.diff(other.offsets),
+            other.targets,
+        )
+
+    def append_clusters(self, clusters: Iterable[BuildingValidationClusterInfo]):
+        """Appends clusters described by `BuildingValidationClusterInfo` objects."""
+        clusters = list(clusters)
+
+        def concatenate(arrays, dtype):
+            return np.concatenate([np.empty(0, dtype=dtype)] + list(arrays))
+
+        self.append(
+            concatenate((c.probabilities for c in clusters), np.float32),
+            concatenate((c.overlays for c in clusters), np.uint8),
+            concatenate((c.entropies for c in clusters), np.float32),
+            np.array([len(c.probabilities) for c in clusters], dtype=np.int64),
+            np.array([c.target for c in clusters], dtype=np.uint8),
+        )
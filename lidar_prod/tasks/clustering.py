@@ -0,0 +1,355 @@
+import itertools
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import numpy as np
+import numpy.lib.recfunctions as rfn
+import pdal
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from lidar_prod.tasks.utils import IncrementalPipeline
+
+log = logging.getLogger(__name__)
+
+# Number of grid cells whose neighbours are searched at once. Bounds the memory used by the
+# candidate pairs of points of a block.
+CLUSTERING_BLOCK_SIZE = 50_000
+
+# "pdal": filters.cluster of pdal. "grid": grid-hash clustering of `get_cluster_labels`.
+CLUSTERING_ENGINES = ("pdal", "grid")
+
+
+def _get_neighbour_offsets(n_dims: int, reach: int = 1) -> np.ndarray:
+    """Offsets to the cell itself and to half of its neighbours within `reach` cells, so that
+    each pair of neighbouring cells is searched once."""
+    offsets = [
+        offset
+        for offset in itertools.product(range(-reach, reach + 1), repeat=n_dims)
+        if offset >= (0,) * n_dims
+    ]
+    return np.array(offsets, dtype=np.int64)
+
+
+def _get_close_pairs(
+    coordinates: np.ndarray,
+    cell_keys: np.ndarray,
+    cell_starts: np.ndarray,
+    cell_counts: np.ndarray,
+    cells: np.ndarray,
+    offset_keys: np.ndarray,
+    tolerance: float,
+):
+    """Pairs of points closer than tolerance, for some cells and their neighbours.
+
+    Points are sorted by cell, so the points of a cell are a contiguous slice of coordinates.
+    """
+    pairs = []
+    for offset_key in offset_keys:
+        neighbours = np.searchsorted(cell_keys, cell_keys[cells] + offset_key)
+        neighbours = np.minimum(neighbours, len(cell_keys) - 1)
+        found = cell_keys[neighbours] == cell_keys[cells] + offset_key
+        cells_a, cells_b = cells[found], neighbours[found]
+
+        # All pairs of points between two neighbouring cells.
+        n_pairs = cell_counts[cells_a] * cell_counts[cells_b]
+        pair_cells = np.repeat(np.arange(len(cells_a)), n_pairs)
+        rank = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+        points_a = cell_starts[cells_a][pair_cells] + rank // cell_counts[cells_b][pair_cells]
+        points_b = cell_starts[cells_b][pair_cells] + rank % cell_counts[cells_b][pair_cells]
+        if offset_key == 0:
+            keep = points_a < points_b
+            points_a, points_b = points_a[keep], points_b[keep]
+
+        # Same distance as the radius search of pdal (squared L2, strictly below tolerance).
+        squared_distances = np.zeros(len(points_a))
+        for dim in range(coordinates.shape[1]):
+            squared_distances += (coordinates[points_a, dim] - coordinates[points_b, dim]) ** 2
+        close = squared_distances < tolerance**2
+        pairs.append((points_a[close], points_b[close]))
+    return pairs
+
+
+def _get_sorted_components(
+    sorted_coordinates: np.ndarray,
+    sorted_keys: np.ndarray,
+    offset_keys: np.ndarray,
+    tolerance: float,
+    n_threads: int,
+) -> np.ndarray:
+    """Connected components of the graph of points closer than tolerance, for points sorted by
+    the key of their cell in a grid (where offset_keys lead to the neighbouring cells)."""
+    n_points = len(sorted_keys)
+    cell_starts = np.concatenate([[0], np.flatnonzero(np.diff(sorted_keys)) + 1])
+    cell_counts = np.diff(np.append(cell_starts, n_points))
+    cell_keys = sorted_keys[cell_starts]
+
+    def get_block_pairs(start: int):
+        block = np.arange(start, min(start + CLUSTERING_BLOCK_SIZE, len(cell_keys)))
+        return _get_close_pairs(
+            sorted_coordinates,
+            cell_keys,
+            cell_starts,
+            cell_counts,
+            block,
+            offset_keys,
+            tolerance,
+        )
+
+    starts = range(0, len(cell_keys), CLUSTERING_BLOCK_SIZE)
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            blocks_pairs = list(executor.map(get_block_pairs, starts))
+    else:
+        blocks_pairs = [get_block_pairs(start) for start in starts]
+    pairs = [pair for block_pairs in blocks_pairs for pair in block_pairs]
+    points_a = np.concatenate([pair[0] for pair in pairs])
+    points_b = np.concatenate([pair[1] for pair in pairs])
+
+    graph = scipy.sparse.coo_matrix(
+        (np.ones(len(points_a), dtype=np.int8), (points_a, points_b)),
+        shape=(n_points, n_points),
+    )
+    _, sorted_components = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    return sorted_components
+
+
+def _number_clusters(components: np.ndarray, min_points: int) -> np.ndarray:
+    """Number components that are large enough, in the order of their first point."""
+    unique_components, first_points, sizes = np.unique(
+        components, return_index=True, return_counts=True
+    )
+    kept = sizes >= min_points
+    kept_components = unique_components[kept][np.argsort(first_points[kept])]
+    component_labels = np.zeros(len(unique_components), dtype=np.uint64)
+    component_labels[kept_components] = np.arange(1, len(kept_components) + 1)
+    return component_labels[components]
+
+
+def get_cluster_labels(
+    coordinates: np.ndarray, tolerance: float, min_points: int, n_threads: int = 1
+) -> np.ndarray:
+    """Euclidean clustering of points, with the same partition as `filters.cluster` of pdal.
+
+    Points are hashed into a grid of `tolerance`, so that neighbours of a point within tolerance
+    are in its cell or in adjacent cells. Pairs of close points are searched by blocks of cells
+    (over `n_threads` threads), and clusters are the connected components of the graph of close
+    points. Clusters are numbered in the order of their first point, as in pdal.
+
+    Args:
+        coordinates (np.ndarray): (N, 2) or (N, 3) array of coordinates
+        tolerance (float): points closer than tolerance belong to the same cluster
+        min_points (int): clusters with less points are ignored
+        n_threads (int): number of threads
+
+    Returns:
+        np.ndarray: cluster index of each point, starting at 1 (0 means no cluster).
+
+    """
+    n_points, n_dims = coordinates.shape
+    if not n_points:
+        return np.zeros(n_points, dtype=np.uint64)
+
+    # Cells are slightly larger than tolerance, so that rounding errors cannot put close points
+    # in cells that are not adjacent. Cells are shifted by one to keep neighbours of border
+    # cells in the grid.
+    cells = np.floor(coordinates / (tolerance * (1 + 1e-9))).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    grid_shape = cells.max(axis=0) + 2
+    keys = np.ravel_multi_index(tuple(cells.T), grid_shape)
+    order = np.argsort(keys, kind="stable")
+    offset_keys = _get_neighbour_offsets(n_dims) @ np.array(
+        [np.prod(grid_shape[dim + 1 :]) for dim in range(n_dims)]
+    )
+
+    sorted_components = _get_sorted_components(
+        coordinates[order], keys[order], offset_keys, tolerance, n_threads
+    )
+    components = np.empty(n_points, dtype=np.int64)
+    components[order] = sorted_components
+    return _number_clusters(components, min_points)
+
+
+class TileSpatialIndex:
+    """Spatial index of the points of a tile, shared by the clusterings of the building module.
+
+    Points are sorted once by cell of a XY grid over their integer coordinates (at `resolution`).
+    Each clustering then only selects its points in the sorted order, and searches neighbours in
+    the cells within its own tolerance, instead of sorting points again. Neighbours are found
+    with the same distance test as `get_cluster_labels`, hence the same clusters.
+
+    The index is built from the points of the first clustering, and points of later clusterings
+    must be the same points in the same order (as in the successive stages of a pipeline).
+    """
+
+    def __init__(self, cell_size: float = 0.5, resolution: float = 0.01):
+        """Initialization.
+
+        Args:
+            cell_size (float): size of the cells of the grid, in meters.
+            resolution (float): resolution of the integer coordinates, in meters.
+
+        """
+        self.cell_size = cell_size
+        self.resolution = resolution
+        self.order: Optional[np.ndarray] = None
+        self.sorted_keys: Optional[np.ndarray] = None
+        self.sorted_coordinates: Optional[np.ndarray] = None
+        self.grid_n_rows: int = 0
+
+    def build(self, points: np.ndarray):
+        """Sort points by cell."""
+        integer_xy = np.column_stack(
+            [
+                np.floor((points[dim] - points[dim].min()) / self.resolution).astype(np.int64)
+                for dim in ["X", "Y"]
+            ]
+        )
+        cells = integer_xy // self._get_integer_cell_size()
+        # Offsets to cells beyond the first or last row lead to cells of another column, far
+        # away: this only adds candidate pairs that are rejected by the distance test.
+        self.grid_n_rows = int(cells[:, 1].max()) + 1
+        keys = cells[:, 0] * self.grid_n_rows + cells[:, 1]
+        self.order = np.argsort(keys, kind="stable")
+        self.sorted_keys = keys[self.order]
+        self.sorted_coordinates = np.column_stack([points[dim][self.order] for dim in "XYZ"])
+
+    def _get_integer_cell_size(self) -> int:
+        # One more unit than cell_size, for the rounding of integer coordinates (see _get_reach)
+        return round(self.cell_size / self.resolution) + 1
+
+    def _get_reach(self, tolerance: float) -> int:
+        """Number of cells around a cell that may contain points closer than tolerance.
+
+        Integer coordinates of points closer than tolerance differ by at most
+        tolerance / resolution + 1, so the reach is 1 for tolerances up to cell_size.
+        """
+        max_integer_distance = math.floor(tolerance / self.resolution * (1 + 1e-9)) + 1
+        return math.ceil(max_integer_distance / self._get_integer_cell_size())
+
+    def get_cluster_labels(
+        self,
+        points: np.ndarray,
+        mask: np.ndarray,
+        tolerance: float,
+        min_points: int,
+        is3d: bool = True,
+        n_threads: int = 1,
+    ) -> np.ndarray:
+        """Euclidean clustering of the points of a mask, as `get_cluster_labels`.
+
+        Args:
+            points (np.ndarray): points of the tile, used to build the index on first use
+            mask (np.ndarray): boolean mask of the points to cluster
+            tolerance (float): points closer than tolerance belong to the same cluster
+            min_points (int): clusters with less points are ignored
+            is3d (bool): use the Z coordinate in distances
+            n_threads (int): number of threads
+
+        Returns:
+            np.ndarray: cluster index of each point, starting at 1 (0 means no cluster or not
+            in the mask).
+
+        """
+        if self.order is None:
+            self.build(points)
+        if len(points) != len(self.order):
+            raise ValueError(
+                f"The spatial index was built on {len(self.order)} points, and cannot be used to "
+                + f"cluster {len(points)} points."
+            )
+        labels = np.zeros(len(points), dtype=np.uint64)
+        sorted_mask = mask[self.order]
+        if not sorted_mask.any():
+            return labels
+
+        offset_keys = _get_neighbour_offsets(2, self._get_reach(tolerance)) @ np.array(
+            [self.grid_n_rows, 1]
+        )
+        sorted_coordinates = self.sorted_coordinates[sorted_mask]
+        if not is3d:
+            sorted_coordinates = sorted_coordinates[:, :2]
+        sorted_components = _get_sorted_components(
+            sorted_coordinates, self.sorted_keys[sorted_mask], offset_keys, tolerance, n_threads
+        )
+
+        # Components of the masked points, in their original order.
+        components = np.empty(len(points), dtype=np.int64)
+        components[self.order[sorted_mask]] = sorted_components
+        labels[mask] = _number_clusters(components[mask], min_points)
+        return labels
+
+
+def cluster_points(
+    pipeline: pdal.pipeline.Pipeline,
+    cluster,
+    where: str,
+    get_where_mask: Callable[[np.ndarray], np.ndarray],
+    dim_cluster_id: str,
+    spatial_index: Optional[TileSpatialIndex] = None,
+) -> pdal.pipeline.Pipeline:
+    """Cluster points of a pipeline into a cluster id dimension, with the engine of a cluster
+    config.
+
+    With the "pdal" engine, a `filters.cluster` stage is appended to the pipeline. With the "grid"
+    engine, the pipeline is executed, its points are clustered with `get_cluster_labels`, and a
+    new pipeline is started from the clustered points, to append the next stages to.
+
+    As with `filters.cluster`, only points of clusters get an id: other points keep their value.
+
+    Args:
+        pipeline (pdal.pipeline.Pipeline): pipeline of the points to cluster
+        cluster: cluster config with `tolerance`, `min_points`, and optionally `is3d` (defaults to
+        true, as in pdal), `engine` (defaults to "pdal") and `n_threads` (for the grid engine).
+        where (str): pdal expression of the points to cluster
+        get_where_mask (Callable[[np.ndarray], np.ndarray]): equivalent of `where` on an array of
+        points, used by the grid engine.
+        dim_cluster_id (str): name of the cluster id dimension
+        spatial_index (TileSpatialIndex, optional): index of the points of the tile, shared with
+        other clusterings of the same points, used by the grid engine.
+
+    Returns:
+        pdal.pipeline.Pipeline: pipeline to append the next stages to.
+
+    """
+    engine = cluster.get("engine", "pdal")
+    is3d = cluster.get("is3d", True)
+    if engine not in CLUSTERING_ENGINES:
+        raise ValueError(
+            f"Unknown clustering engine {engine}, expected one of {CLUSTERING_ENGINES}"
+        )
+    if engine == "pdal":
+        return pipeline | pdal.Filter.cluster(
+            min_points=cluster.min_points,
+            tolerance=cluster.tolerance,
+            is3d=is3d,
+            where=where,
+        )
+
+    pipeline.execute()
+    points = pipeline.arrays[0]
+    if dim_cluster_id not in points.dtype.names:
+        points = rfn.append_fields(
+            points, dim_cluster_id, np.zeros(len(points), dtype=np.uint64), usemask=False
+        )
+    mask = get_where_mask(points)
+    n_threads = cluster.get("n_threads", 1)
+    if spatial_index is not None:
+        labels = spatial_index.get_cluster_labels(
+            points, mask, cluster.tolerance, cluster.min_points, is3d=is3d, n_threads=n_threads
+        )
+    else:
+        idx = np.flatnonzero(mask)
+        coordinates = np.column_stack(
+            [points["X"][idx], points["Y"][idx]] + ([points["Z"][idx]] if is3d else [])
+        )
+        labels = np.zeros(len(points), dtype=np.uint64)
+        labels[idx] = get_cluster_labels(
+            coordinates, cluster.tolerance, cluster.min_points, n_threads=n_threads
+        )
+    clustered = labels > 0
+    points[dim_cluster_id][clustered] = labels[clustered]
+    log.info(f"Grid clustering: {labels.max(initial=0)} clusters of {mask.sum()} points")
+    return IncrementalPipeline([points])
@@ -0,0 +1,203 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+import numpy as np
+import scipy.ndimage
+import shapely
+
+log = logging.getLogger(__name__)
+
+# Number of points tested at once. Bounds the memory used by the shapely points of a chunk.
+OVERLAY_CHUNK_SIZE = 100_000
+
+
+def prune_geometries(geometries: np.ndarray, bboxes: np.ndarray) -> np.ndarray:
+    """Keep the geometries whose bounding box intersects at least one of the bboxes.
+
+    Args:
+        geometries (np.ndarray): array of shapely geometries
+        bboxes (np.ndarray): (N, 4) array of x_min, y_min, x_max, y_max
+
+    Returns:
+        np.ndarray: array of shapely geometries, in their original order.
+
+    """
+    if not len(geometries) or not len(bboxes):
+        return geometries[:0]
+    tree = shapely.STRtree(geometries)
+    _, geometries_idx = tree.query(shapely.box(*bboxes.T))
+    return geometries[np.unique(geometries_idx)]
+
+
+def overlay_points(
+    x: np.ndarray,
+    y: np.ndarray,
+    geometries: np.ndarray,
+    n_threads: int = 1,
+    chunk_size: int = OVERLAY_CHUNK_SIZE,
+) -> np.ndarray:
+    """Flag points that are covered by at least one geometry (boundaries included).
+
+    Points are tested by chunks against an STRtree of the geometries. Shapely releases the GIL
+    during the queries, so chunks are processed in parallel over `n_threads` threads.
+
+    Args:
+        x (np.ndarray): X coordinates of points
+        y (np.ndarray): Y coordinates of points
+        geometries (np.ndarray): array of shapely polygons
+        n_threads (int): number of threads
+        chunk_size (int): number of points tested at once by a thread
+
+    Returns:
+        np.ndarray: boolean flag of each point.
+
+    """
+    flags = np.zeros(len(x), dtype=bool)
+    if not len(x) or not len(geometries):
+        return flags
+    tree = shapely.STRtree(geometries)
+
+    def overlay_chunk(start: int):
+        end = start + chunk_size
+        points = shapely.points(x[start:end], y[start:end])
+        # A point intersects a polygon iff it is inside the polygon or on its boundary.
+        points_idx, _ = tree.query(points, predicate="intersects")
+        flags[start + points_idx] = True
+
+    starts = range(0, len(x), chunk_size)
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(overlay_chunk, starts))
+    else:
+        for start in starts:
+            overlay_chunk(start)
+    return flags
+
+
+# States of the cells of an overlay raster.
+OUTSIDE = 0
+BOUNDARY = 1
+INSIDE = 2
+
+
+def _get_cell_idx(coordinates: np.ndarray, origin: float, cell_size: float) -> np.ndarray:
+    return np.floor((coordinates - origin) / cell_size).astype(np.int64)
+
+
+def rasterize_geometries(
+    geometries: np.ndarray,
+    origin: Tuple[float, float],
+    shape: Tuple[int, int],
+    cell_size: float,
+) -> np.ndarray:
+    """Burn polygons into a raster of cells that are inside, outside or on a boundary.
+
+    Boundaries of polygons are sampled every half cell, and the cells of samples and their
+    neighbours are on a boundary: this covers every cell that a boundary passes through, with a
+    margin of one cell against rounding errors. Other cells form connected regions that no
+    boundary crosses, i.e. that are entirely inside or outside of the polygons, and a single cell
+    is tested exactly by region. The cost grows with the perimeter of the polygons and the number
+    of cells, not with their product.
+
+    Args:
+        geometries (np.ndarray): array of shapely polygons
+        origin (Tuple[float, float]): x_min, y_min of the raster
+        shape (Tuple[int, int]): number of rows (along y) and columns (along x) of the raster
+        cell_size (float): size of the cells
+
+    Returns:
+        np.ndarray: raster of OUTSIDE / BOUNDARY / INSIDE states, indexed by [row, column].
+
+    """
+    raster = np.full(shape, OUTSIDE, dtype=np.uint8)
+    if not len(geometries):
+        return raster
+    x_origin, y_origin = origin
+    n_rows, n_cols = shape
+
+    # Segments of the boundaries
+    coordinates, line_idx = shapely.get_coordinates(
+        shapely.get_parts(shapely.boundary(geometries)), return_index=True
+    )
+    same_line = line_idx[1:] == line_idx[:-1]
+    starts = coordinates[:-1][same_line]
+    ends = coordinates[1:][same_line]
+
+    # Samples every half cell (at most) along each segment, ends included.
+    lengths = np.hypot(*(ends - starts).T)
+    n_samples = np.maximum(np.ceil(lengths / (cell_size / 2)).astype(np.int64), 1) + 1
+    segment_idx = np.repeat(np.arange(len(starts)), n_samples)
+    sample_rank = np.arange(n_samples.sum()) - np.repeat(
+        np.cumsum(n_samples) - n_samples, n_samples
+    )
+    t = (sample_rank / (n_samples[segment_idx] - 1))[:, None]
+    samples = starts[segment_idx] * (1 - t) + ends[segment_idx] * t
+
+    # Cells of samples, in a raster padded by one cell so that samples just outside of the
+    # raster still mark their neighbours.
+    cols = _get_cell_idx(samples[:, 0], x_origin, cell_size) + 1
+    rows = _get_cell_idx(samples[:, 1], y_origin, cell_size) + 1
+    in_padded_raster = (cols >= 0) & (rows >= 0) & (cols < n_cols + 2) & (rows < n_rows + 2)
+    on_boundary = np.zeros((n_rows + 2, n_cols + 2), dtype=bool)
+    on_boundary[rows[in_padded_raster], cols[in_padded_raster]] = True
+    on_boundary = scipy.ndimage.binary_dilation(on_boundary, structure=np.ones((3, 3)))
+    on_boundary = on_boundary[1:-1, 1:-1]
+    raster[on_boundary] = BOUNDARY
+
+    # Regions of cells not on a boundary, connected by their edges.
+    regions, n_regions = scipy.ndimage.label(~on_boundary)
+    if n_regions:
+        _, first_cell = np.unique(regions.ravel(), return_index=True)
+        first_cell = first_cell[1:]  # label 0 is for boundary cells
+        rows, cols = np.unravel_index(first_cell, shape)
+        region_inside = overlay_points(
+            x_origin + (cols + 0.5) * cell_size, y_origin + (rows + 0.5) * cell_size, geometries
+        )
+        inside = np.concatenate([[False], region_inside])[regions]
+        raster[inside] = INSIDE
+    return raster
+
+
+def overlay_points_with_raster(
+    x: np.ndarray,
+    y: np.ndarray,
+    geometries: np.ndarray,
+    cell_size: float,
+    n_threads: int = 1,
+    chunk_size: int = OVERLAY_CHUNK_SIZE,
+) -> np.ndarray:
+    """Flag points that are covered by at least one geometry, with a raster lookup.
+
+    Geometries are burnt into a raster of `cell_size` over the extent of the points (see
+    `rasterize_geometries`). Points get their flag from their cell in constant time, and only
+    points in cells on a boundary are tested exactly with `overlay_points`. Flags are the same as
+    the ones of `overlay_points`.
+
+    Args:
+        x (np.ndarray): X coordinates of points
+        y (np.ndarray): Y coordinates of points
+        geometries (np.ndarray): array of shapely polygons
+        cell_size (float): size of the cells of the raster
+        n_threads (int): number of threads for the exact tests
+        chunk_size (int): number of points tested at once by a thread
+
+    Returns:
+        np.ndarray: boolean flag of each point.
+
+    """
+    if not len(x) or not len(geometries):
+        return np.zeros(len(x), dtype=bool)
+    origin = (x.min(), y.min())
+    cols = _get_cell_idx(x, origin[0], cell_size)
+    rows = _get_cell_idx(y, origin[1], cell_size)
+    raster = rasterize_geometries(geometries, origin, (rows.max() + 1, cols.max() + 1), cell_size)
+
+    states = raster[rows, cols]
+    flags = states == INSIDE
+    on_boundary = np.flatnonzero(states == BOUNDARY)
+    log.debug(f"Raster overlay: {len(on_boundary)}/{len(x)} points tested exactly")
+    flags[on_boundary] = overlay_points(
+        x[on_boundary], y[on_boundary], geometries, n_threads=n_threads, chunk_size=chunk_size
+    )
+    return flags
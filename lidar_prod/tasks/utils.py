@@ -1,9 +1,11 @@
 import logging
 import math
 import subprocess
+from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import partial
 from numbers import Number
-from typing import Any, Dict, Iterable
+from typing import Any, Callable, ContextManager, Dict, Iterable, Optional, Tuple
 
 import geopandas
 import laspy
@@ -26,15 +28,177 @@ class BDUniConnectionParams:
     bd_name: str
 
 
-def split_idx_by_dim(dim_array):
+class ClusterIndex:
+    """Index of the points of each cluster of a point cloud.
+
+    Points are grouped by cluster label in a compressed sparse row layout: `point_idx` holds
+    the indices of points sorted by cluster, and the points of the i-th cluster are
+    `point_idx[offsets[i]:offsets[i + 1]]`. Clusters are ordered by ascending label, and points
+    keep their order within a cluster. Points with the background label are not indexed.
+
+    Segment reductions (sums, means, min and max by cluster) and broadcasting of per-cluster
+    values back to points are computed with array operations, without materializing an array of
+    indices per cluster.
     """
-    Returns a sequence of arrays of indices of elements sharing the same value in dim_array
-    Groups are ordered by ascending value.
+
+    def __init__(self, labels: np.ndarray, background: Number = 0):
+        """Builds the index.
+
+        Args:
+            labels (np.ndarray): cluster label of each point.
+            background (Number): label of unclustered points. Defaults to 0, as in pdal.
+
+        """
+        self.clustered_mask = labels != background
+        self.labels, cluster_idx = np.unique(labels[self.clustered_mask], return_inverse=True)
+        # index of the cluster of each clustered point, in the order of points.
+        self.cluster_idx = cluster_idx.reshape(-1)
+        self.sizes = np.bincount(self.cluster_idx, minlength=len(self.labels))
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)])
+        order = np.argsort(self.cluster_idx, kind="stable")
+        self.point_idx = np.flatnonzero(self.clustered_mask)[order]
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def indices(self, i: int) -> np.ndarray:
+        """Indices of the points of the i-th cluster (a view, without copy)."""
+        return self.point_idx[self.offsets[i] : self.offsets[i + 1]]
+
+    def segment_sum(self, values: np.ndarray) -> np.ndarray:
+        """Sum of values by cluster.
+
+        Args:
+            values (np.ndarray): value of each point of the point cloud.
+
+        Returns:
+            np.ndarray: sum of the values of the points of each cluster.
+
+        """
+        return np.bincount(
+            self.cluster_idx, weights=values[self.clustered_mask], minlength=len(self)
+        )
+
+    def segment_mean(self, values: np.ndarray) -> np.ndarray:
+        """Mean of values by cluster. Exact for boolean values, i.e. for fractions of points.
+
+        Args:
+            values (np.ndarray): value of each point of the point cloud.
+
+        Returns:
+            np.ndarray: mean of the values of the points of each cluster.
+
+        """
+        return self.segment_sum(values) / self.sizes
+
+    def segment_min(self, values: np.ndarray) -> np.ndarray:
+        """Min of values by cluster (see `segment_sum`)."""
+        return self._segment_reduce(np.minimum, values)
+
+    def segment_max(self, values: np.ndarray) -> np.ndarray:
+        """Max of values by cluster (see `segment_sum`)."""
+        return self._segment_reduce(np.maximum, values)
+
+    def _segment_reduce(self, ufunc: np.ufunc, values: np.ndarray) -> np.ndarray:
+        if not len(self):
+            return np.empty(0, dtype=values.dtype)
+        # Clusters are never empty, so that each cluster is reduced over its own segment.
+        return ufunc.reduceat(values[self.point_idx], self.offsets[:-1])
+
+    def broadcast(self, cluster_values: np.ndarray) -> np.ndarray:
+        """Broadcasts values by cluster to the clustered points.
+
+        Args:
+            cluster_values (np.ndarray): value of each cluster.
+
+        Returns:
+            np.ndarray: value of the cluster of each clustered point, in the order of points,
+            e.g. to be assigned with `points[dim][index.clustered_mask] = ...`
+
+        """
+        return cluster_values[self.cluster_idx]
+
+
+def _get_sortable_keys(values: np.ndarray) -> np.ndarray:
+    """Map float32 values to uint32 keys with the same order."""
+    bits = values.view(np.uint32)
+    return np.where(bits >> 31, ~bits, bits | np.uint32(1 << 31)).astype(np.uint32)
+
+
+class SortedSegments:
+    """Float32 values of segments (e.g. the points of clusters), sorted within each segment to
+    count the values above thresholds in all segments at once.
+
+    Values are sorted once by (segment, value), as uint64 keys that combine the index of the
+    segment and an order-preserving integer key of the value. The values of all segments that
+    are greater than or equal to a threshold are then located by a single `np.searchsorted`, for
+    one or many thresholds.
     """
-    idx = np.argsort(dim_array)
-    sorted_dim_array = dim_array[idx]
-    group_idx = np.array_split(idx, np.where(np.diff(sorted_dim_array) != 0)[0] + 1)
-    return group_idx
+
+    def __init__(self, values: np.ndarray, offsets: np.ndarray):
+        """Sorts values by segment.
+
+        Args:
+            values (np.ndarray): float32 values, without NaN, in the order of segments.
+            offsets (np.ndarray): values of the i-th segment are values[offsets[i]:offsets[i+1]].
+
+        """
+        # Adding 0 turns -0.0 into 0.0, as both are equal but have different keys.
+        values = np.asarray(values, dtype=np.float32) + np.float32(0)
+        sizes = np.diff(offsets)
+        segment_idx = np.repeat(np.arange(len(sizes), dtype=np.uint64), sizes)
+        self.keys = np.sort((segment_idx << np.uint64(32)) | _get_sortable_keys(values))
+        self.ends = np.asarray(offsets[1:])
+        self._segment_keys = np.arange(len(sizes), dtype=np.uint64) << np.uint64(32)
+        # Distinct values, to find the smallest value above a threshold.
+        self.unique_values = np.unique(values)
+
+    def __len__(self) -> int:
+        return len(self.ends)
+
+    def count_greater_equal(self, threshold: float) -> np.ndarray:
+        """Number of values of each segment that are greater than or equal to a threshold.
+
+        The comparison is the one of `values >= threshold` with numpy, i.e. with the same
+        promotion of the threshold: counts are the same as `segment_sum(values >= threshold)`.
+
+        Args:
+            threshold (float): threshold
+
+        Returns:
+            np.ndarray: number of values >= threshold by segment.
+
+        """
+        return self.count_greater_equal_batch([threshold])[0]
+
+    def count_greater_equal_batch(self, thresholds: Iterable[float]) -> np.ndarray:
+        """Number of values of each segment that are greater than or equal to each threshold.
+
+        Args:
+            thresholds (Iterable[float]): thresholds, compared one by one to values.
+
+        Returns:
+            np.ndarray: (thresholds, segments) array of numbers of values >= threshold.
+
+        """
+        smallest_keys = np.array([self._get_smallest_key(t) for t in thresholds], dtype=np.uint64)
+        first_idx = np.searchsorted(self.keys, self._segment_keys + smallest_keys[:, None])
+        return self.ends - first_idx
+
+    def _get_smallest_key(self, threshold: float) -> int:
+        """Key of the smallest value >= threshold, found by bisection as comparisons are
+        monotonic. Without such value, 2**32 is returned: added to the key of a segment, it
+        locates the end of the segment."""
+        low, high = 0, len(self.unique_values)
+        while low < high:
+            middle = (low + high) // 2
+            if self.unique_values[middle : middle + 1] >= threshold:
+                high = middle
+            else:
+                low = middle + 1
+        if low == len(self.unique_values):
+            return 1 << 32
+        return int(_get_sortable_keys(self.unique_values[low : low + 1])[0])
 
 
 def get_pipeline(
@@ -56,14 +220,118 @@ def get_pipeline(
         pdal pipeline, updated pipeline_metadata dict
     """
     if isinstance(input_value, str):
-        pipeline = pdal.Pipeline() | get_pdal_reader(input_value, epsg)
-        pipeline.execute()
-        las_metadata = get_input_las_metadata(pipeline)
+        reader_pipeline = pdal.Pipeline() | get_pdal_reader(input_value, epsg)
+        reader_pipeline.execute()
+        las_metadata = get_input_las_metadata(reader_pipeline)
+        # Later stages are executed on the points that were read, without reading them again.
+        pipeline = IncrementalPipeline(reader_pipeline.arrays, reader_pipeline.metadata)
     else:
         pipeline = input_value
     return pipeline, las_metadata
 
 
+class IncrementalPipeline:
+    """Pipeline that only executes newly appended stages, on points that were already read or
+    computed.
+
+    Appending a stage to an executed pdal pipeline and executing it again executes every stage
+    again, starting with the reader. Here, points are kept once executed, and `execute` runs only
+    the stages appended since the last execution, on these points.
+
+    It is used as a pdal pipeline: stages are appended with `|` or `|=`, points are read from
+    `arrays` (a copy, as with pdal) once executed. `metadata` is the metadata of the pipeline
+    that produced the initial points, e.g. of the reader (see `get_input_las_metadata`).
+    """
+
+    def __init__(self, arrays: Iterable[np.ndarray], metadata: dict = None):
+        self._arrays = list(arrays)
+        self._stages = []
+        self.metadata = metadata
+
+    def __or__(self, stage) -> "IncrementalPipeline":
+        pipeline = IncrementalPipeline(self._arrays, self.metadata)
+        pipeline._stages = self._stages + [stage]
+        return pipeline
+
+    def __ior__(self, stage) -> "IncrementalPipeline":
+        self._stages.append(stage)
+        return self
+
+    def execute(self) -> int:
+        """Execute the pending stages. Returns the number of points."""
+        if self._stages:
+            pipeline = pdal.Pipeline(arrays=self._arrays)
+            for stage in self._stages:
+                pipeline |= stage
+            pipeline.execute()
+            self._arrays = pipeline.arrays
+            self._stages = []
+        return sum(len(array) for array in self._arrays)
+
+    @property
+    def arrays(self):
+        if self._stages:
+            raise RuntimeError("call execute() before fetching arrays")
+        return [array.copy() for array in self._arrays]
+
+
+def add_typed_dimensions(
+    pipeline: pdal.pipeline.Pipeline | IncrementalPipeline, dimensions: Dict[str, Any]
+) -> IncrementalPipeline:
+    """Add dimensions with explicit types to the points of a pipeline, filled with zeros.
+
+    Dimensions created by pdal (e.g. by `filters.ferry` with "=>Dim") are 8-bytes doubles, while
+    intermediary flags and cluster ids fit in 1 or 4 bytes. Dimensions that already exist keep
+    their type. Values are then set with `filters.assign` or `filters.overlay`, which keep the
+    type of existing dimensions, unlike `filters.ferry`.
+
+    Points of an `IncrementalPipeline` are moved to the returned pipeline rather than copied: the
+    input pipeline is left without points, and each of its arrays is released once its fields are
+    copied, so that at most one array is held twice. An `IncrementalPipeline` that already has
+    all the dimensions is returned as is.
+
+    Args:
+        pipeline (pdal.pipeline.Pipeline | IncrementalPipeline): pipeline of the points, executed
+        if needed.
+        dimensions (Dict[str, Any]): numpy type of each dimension to add, by name.
+
+    Returns:
+        IncrementalPipeline: pipeline to append the next stages to.
+
+    """
+    pipeline.execute()
+    if isinstance(pipeline, IncrementalPipeline):
+        # No defensive copy of the points, unlike `IncrementalPipeline.arrays`.
+        source_arrays, pipeline._arrays = pipeline._arrays, []
+    else:
+        source_arrays = pipeline.arrays
+
+    def get_new_dimensions(array: np.ndarray) -> Dict[str, Any]:
+        return {name: dtype for name, dtype in dimensions.items() if name not in array.dtype.names}
+
+    if not any(get_new_dimensions(array) for array in source_arrays):
+        if isinstance(pipeline, IncrementalPipeline):
+            pipeline._arrays = source_arrays
+            return pipeline
+        return IncrementalPipeline(source_arrays, pipeline.metadata)
+
+    arrays = []
+    while source_arrays:
+        array = source_arrays.pop(0)
+        new_dimensions = get_new_dimensions(array)
+        if new_dimensions:
+            typed_array = np.zeros(
+                len(array),
+                dtype=array.dtype.descr
+                + [(name, dtype) for name, dtype in new_dimensions.items()],
+            )
+            for name in array.dtype.names:
+                typed_array[name] = array[name]
+            array = typed_array
+        arrays.append(array)
+    return IncrementalPipeline(arrays, pipeline.metadata)
+
+
 def get_input_las_metadata(pipeline: pdal.pipeline.Pipeline):
     """Get las reader metadata from the input pipeline"""
     return pipeline.metadata["metadata"]["readers.las"]
@@ -80,7 +348,20 @@ def get_integer_bbox(pipeline: pdal.pipeline.Pipeline, buffer: Number = 0) -> Di
     Returns:
         Dict[str, int]: x/y min/max values as a dictionary
     """
-    metadata = get_input_las_metadata(pipeline)
+    return get_integer_bbox_from_las_metadata(get_input_las_metadata(pipeline), buffer)
+
+
+def get_integer_bbox_from_las_metadata(metadata: dict, buffer: Number = 0) -> Dict[str, int]:
+    """Get XY bounding box from las reader metadata, cast x/y min/max to integers.
+
+    Args:
+        metadata (dict): las reader metadata (as returned by `get_input_las_metadata`)
+        buffer (Number, optional): buffer to add to the bounds before casting it to integers.
+        Defaults to 0.
+
+    Returns:
+        Dict[str, int]: x/y min/max values as a dictionary
+    """
     bbox = {
         "x_min": math.floor(metadata["minx"] - buffer),
         "y_min": math.floor(metadata["miny"] - buffer),
@@ -90,6 +371,30 @@ def get_integer_bbox(pipeline: pdal.pipeline.Pipeline, buffer: Number = 0) -> Di
     return bbox
 
 
+def get_integer_bbox_from_las_header(las_path: str, buffer: Number = 0) -> Dict[str, int]:
+    """Get XY bounding box from the header of a las file, cast x/y min/max to integers.
+
+    Same as `get_integer_bbox`, without reading the points.
+
+    Args:
+        las_path (str): path to the las file
+        buffer (Number, optional): buffer to add to the bounds before casting it to integers.
+        Defaults to 0.
+
+    Returns:
+        Dict[str, int]: x/y min/max values as a dictionary
+    """
+    with laspy.open(las_path) as f:
+        header = f.header
+        metadata = {
+            "minx": header.mins[0],
+            "miny": header.mins[1],
+            "maxx": header.maxs[0],
+            "maxy": header.maxs[1],
+        }
+    return get_integer_bbox_from_las_metadata(metadata, buffer)
+
+
 def get_pdal_reader(las_path: str, epsg: int | str) -> pdal.Reader.las:
     """Standard Reader which imposes Lamber 93 SRS.
 
@@ -193,18 +498,14 @@ def pdal_read_las_array(las_path: str, epsg: int | str = None):
     return p1.arrays[0], metadata
 
 
-def check_bbox_intersects_territoire_with_srid(
-    bd_params: BDUniConnectionParams, bbox: Dict[str, int], epsg_srid: int | str
-):
-    """Check if a bounding box intersects one of the territories from the BDUni database
-    (public.gcms_territoire) with the expected srid.
-    As geometries are indicated with srid = 0 in the database (but stored in their original
-    projection),
-    both geometries are compared using this common srid.
-    In the territoire geometry query, ST_Union is used to combine different territoires that
-    would have the same
-    srid (eg. 5490 for Guadeloupe and Martinique)
-    """
+def get_srid_from_epsg(epsg: int | str) -> int | str:
+    """Get the srid of an epsg given either as a code (2154, "2154") or as "EPSG:2154"."""
+    return epsg if (isinstance(epsg, int) or epsg.isdigit()) else epsg.split(":")[-1]
+
+
+@contextmanager
+def connect_to_bd_uni(bd_params: BDUniConnectionParams):
+    """Cursor on a new connection to a database, closed on exit."""
     conn = psycopg2.connect(
         dbname=bd_params.bd_name,
         user=bd_params.user,
@@ -214,18 +515,7 @@ def check_bbox_intersects_territoire_with_srid(
     try:
         with conn:
             with conn.cursor() as curs:
-                query = f"""select ST_Intersects(
-                    ST_MakeEnvelope(
-                        {bbox["x_min"]}, {bbox["y_min"]}, {bbox["x_max"]}, {bbox["y_max"]}, 0
-                        ),
-                    ST_SetSRID(ST_Envelope(ST_Union(ST_Force2D(geometrie))),0))::bool
-                    as consistency_bbox_srid
-                    from public.gcms_territoire
-                    where srid = '{epsg_srid}'
-                    limit 1;
-                """
-                curs.execute(query)
-                out = curs.fetchone()
+                yield curs
 
     # Unlike file objects or other resources, exiting the connection’s with block doesn’t
     # close the connection hence we need to close it manually
@@ -233,7 +523,79 @@ def check_bbox_intersects_territoire_with_srid(
     finally:
         conn.close()
 
-    return out[0]
+
+SQL_TERRITOIRE_ENVELOPE = """SELECT
+        ST_XMin(envelope), ST_YMin(envelope), ST_XMax(envelope), ST_YMax(envelope)
+    FROM (
+        SELECT ST_Envelope(ST_Union(ST_Force2D(geometrie))) AS envelope
+        FROM public.gcms_territoire
+        WHERE srid = %(srid)s
+    ) AS territoire;
+"""
+
+# Envelopes of the territories, by database and srid. Territories do not change during a run, so
+# they are requested once per process instead of once per tile.
+_territoire_envelopes: Dict[Tuple[str, str, str], Optional[Tuple[float, ...]]] = {}
+
+
+def get_territoire_envelope(
+    bd_params: BDUniConnectionParams,
+    epsg_srid: int | str,
+    cursor_factory: Callable[[], ContextManager] = None,
+) -> Optional[Tuple[float, float, float, float]]:
+    """Get the envelope (x_min, y_min, x_max, y_max) of the union of the territories from the
+    BDUni database (public.gcms_territoire) with a srid, or None if there is no such territory.
+
+    In the territoire geometry query, ST_Union is used to combine different territoires that
+    would have the same srid (eg. 5490 for Guadeloupe and Martinique).
+    Envelopes are memoized per process.
+
+    Args:
+        bd_params (BDUniConnectionParams): database connection parameters
+        epsg_srid (int | str): srid of the territories
+        cursor_factory (Callable[[], ContextManager], optional): factory of a cursor to the
+        database, e.g. over a pooled connection. Defaults to a new connection.
+
+    """
+    key = (bd_params.host, bd_params.bd_name, str(epsg_srid))
+    if key not in _territoire_envelopes:
+        if cursor_factory is None:
+            cursor_factory = partial(connect_to_bd_uni, bd_params)
+        with cursor_factory() as curs:
+            curs.execute(SQL_TERRITOIRE_ENVELOPE, {"srid": int(epsg_srid)})
+            out = curs.fetchone()
+        _territoire_envelopes[key] = None if out is None or out[0] is None else tuple(out)
+    return _territoire_envelopes[key]
+
+
+def bbox_intersects_envelope(
+    bbox: Dict[str, int], envelope: Optional[Tuple[float, float, float, float]]
+) -> bool:
+    """Same as PostGIS ST_Intersects between a bbox and an envelope: touching boundaries
+    intersect."""
+    if envelope is None:
+        return False
+    x_min, y_min, x_max, y_max = envelope
+    return (
+        bbox["x_min"] <= x_max
+        and bbox["x_max"] >= x_min
+        and bbox["y_min"] <= y_max
+        and bbox["y_max"] >= y_min
+    )
+
+
+def check_bbox_intersects_territoire_with_srid(
+    bd_params: BDUniConnectionParams, bbox: Dict[str, int], epsg_srid: int | str
+):
+    """Check if a bounding box intersects one of the territories from the BDUni database
+    (public.gcms_territoire) with the expected srid.
+    As geometries are indicated with srid = 0 in the database (but stored in their original
+    projection),
+    both geometries are compared using this common srid.
+    The envelope of the territories is requested once per process and srid, and the check
+    is then done locally (see `get_territoire_envelope`).
+    """
+    return bbox_intersects_envelope(bbox, get_territoire_envelope(bd_params, epsg_srid))
 
 
 def request_bd_uni_for_building_shapefile(
@@ -257,7 +619,7 @@ def request_bd_uni_for_building_shapefile(
     The gcms_territoire table gives hints on each territory (SRID, footprint)
     """
 
-    epsg_srid = epsg if (isinstance(epsg, int) or epsg.isdigit()) else epsg.split(":")[-1]
+    epsg_srid = get_srid_from_epsg(epsg)
 
     if not check_bbox_intersects_territoire_with_srid(bd_params, bbox, epsg_srid):
         raise ValueError(
@@ -3,6 +3,8 @@ import pyproj
 import pytest
 from hydra import compose, initialize
 
+from lidar_prod.tasks.building_validation import thresholds
+from lidar_prod.tasks.cluster_store import ClusterStore
 from lidar_prod.tasks.utils import get_pipeline, pdal_read_las_array
 
 
@@ -79,3 +81,38 @@ def check_expected_classification(output_las_path: str, expected_codes: set):
     assert actual_codes.issubset(
         expected_codes
     ), f"Expected classification: {expected_codes}, got: {actual_codes}"
+
+
+def get_random_store(directory, num_clusters=2_000, num_points=50_000, seed=0):
+    rng = np.random.default_rng(seed)
+    cluster_idx = np.sort(rng.integers(0, num_clusters, size=num_points))
+    cluster_idx = np.unique(cluster_idx, return_inverse=True)[1]
+
+    # Values vary by cluster to get all kinds of decisions, and are quantized to have points
+    # exactly on thresholds.
+    def draw_by_cluster(scale):
+        values = rng.random(num_clusters)[cluster_idx] + scale * rng.normal(size=num_points)
+        return np.round(np.clip(values, 0, 1), 2)
+
+    store = ClusterStore.create(directory)
+    store.append(
+        probabilities=draw_by_cluster(0.1),
+        overlays=draw_by_cluster(0.3) > 0.5,
+        entropies=draw_by_cluster(0.2),
+        sizes=np.bincount(cluster_idx),
+        targets=rng.choice([0, 6, 208], size=cluster_idx.max() + 1),
+    )
+    return store
+
+
+def get_random_thresholds(rng):
+    return thresholds(
+        min_confidence_confirmation=float(rng.choice([rng.random(), 0.5, 0.7])),
+        min_frac_confirmation=float(rng.random()),
+        min_frac_confirmation_factor_if_bd_uni_overlay=float(rng.choice([rng.random(), 1.2])),
+        min_uni_db_overlay_frac=float(rng.random()),
+        min_confidence_refutation=float(rng.choice([rng.random(), 0.3])),
+        min_frac_refutation=float(rng.random()),
+        min_entropy_uncertainty=np.float64(rng.choice([rng.random(), 0.25])),
+        min_frac_entropy_uncertain=float(rng.random()),
+    )
@@ -0,0 +1,89 @@
+import os
+import os.path as osp
+import tempfile
+
+from omegaconf import OmegaConf
+
+from lidar_prod.commons.result_cache import (
+    ResultCache,
+    get_cache_key,
+    hash_config_sections,
+)
+
+MANIFEST_FILENAME = "manifest.jsonl"
+
+
+def write_file(path, content: bytes = b""):
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def test_hash_config_sections():
+    cfg = OmegaConf.create({"a": {"x": 1, "y": "${b}"}, "b": 2, "c": {"z": 3}})
+    h = hash_config_sections(cfg, ["a"])
+    # resolved values are hashed, and other sections are ignored
+    cfg.c.z = 4
+    assert hash_config_sections(cfg, ["a"]) == h
+    cfg.b = 3
+    assert hash_config_sections(cfg, ["a"]) != h
+
+
+def test_hash_config_sections_ignores_keys():
+    cfg = OmegaConf.create({"a": {"x": 1, "exec": {"n_threads": 1}}, "b": {"n_threads": 1}})
+    ignored_keys = ["a.exec.n_threads", "b.n_threads", "a.missing.key", "c.n_threads"]
+    h = hash_config_sections(cfg, ["a", "b"], ignored_keys)
+    cfg.a.exec.n_threads = 8
+    cfg.b.n_threads = 8
+    assert hash_config_sections(cfg, ["a", "b"], ignored_keys) == h
+    # the config itself is not modified
+    assert cfg.b.n_threads == 8
+    cfg.a.x = 2
+    assert hash_config_sections(cfg, ["a", "b"], ignored_keys) != h
+
+
+def test_cache_key_depends_on_content_and_config():
+    with tempfile.TemporaryDirectory() as td:
+        src = osp.join(td, "src.las")
+        write_file(src, b"some points")
+        key = get_cache_key(src, "config_hash")
+        assert get_cache_key(src, "config_hash") == key
+        assert get_cache_key(src, "another_config_hash") != key
+        write_file(src, b"other points")
+        assert get_cache_key(src, "config_hash") != key
+
+
+def test_result_cache_record_and_reload():
+    with tempfile.TemporaryDirectory() as td:
+        target = osp.join(td, "tile.las")
+        cache = ResultCache(td, MANIFEST_FILENAME)
+        cache.record(target, "key1")
+        # no key as long as the target does not exist
+        assert cache.get_key(target) is None
+        write_file(target)
+        assert cache.get_key(target) == "key1"
+
+        # last recorded key wins when reloading the manifest
+        cache.record(target, "key2")
+        assert ResultCache(td, MANIFEST_FILENAME).get_key(target) == "key2"
+
+
+def test_result_cache_invalidate_and_evict():
+    with tempfile.TemporaryDirectory() as td:
+        targets = [osp.join(td, f"tile_{i}.las") for i in range(3)]
+        cache = ResultCache(td, MANIFEST_FILENAME)
+        for i, target in enumerate(targets):
+            write_file(target)
+            cache.record(target, f"key{i}")
+
+        assert cache.invalidate([targets[0]]) == ["tile_0.las"]
+        reloaded_cache = ResultCache(td, MANIFEST_FILENAME)
+        assert reloaded_cache.get_key(targets[0]) is None
+        assert reloaded_cache.get_key(targets[1]) == "key1"
+
+        # entries of deleted outputs are evicted
+        os.remove(targets[2])
+        assert reloaded_cache.evict_stale() == ["tile_2.las"]
+        assert ResultCache(td, MANIFEST_FILENAME).entries == {"tile_1.las": "key1"}
+
+        assert cache.invalidate() != []
+        assert ResultCache(td, MANIFEST_FILENAME).entries == {}
@@ -1,4 +1,11 @@
-from lidar_prod.tasks.basic_identification_optimization import BasicIdentifierOptimizer
+import numpy as np
+import pytest
+
+from lidar_prod.tasks.basic_identification import IoU
+from lidar_prod.tasks.basic_identification_optimization import (
+    BasicIdentifierOptimizer,
+    IoUSweep,
+)
 
 LAS_SUBSET_FILE_VEGETATION = "tests/files/436000_6478000.subset.postIA.las"
 
@@ -20,3 +27,51 @@ def test_basic_identifier_optimizer(vegetation_unclassifed_hydra_cfg):
     basic_identifier_optimizer.optimize()
     trial = basic_identifier_optimizer.study.best_trial
     assert trial.value > 0.9  # IoU value
+
+
+def test_basic_identifier_optimizer_threshold_sweep(vegetation_unclassifed_hydra_cfg):
+    data_format = vegetation_unclassifed_hydra_cfg["data_format"]
+    basic_identifier_optimizer = BasicIdentifierOptimizer(
+        vegetation_unclassifed_hydra_cfg,
+        data_format["las_dimensions"]["ai_vegetation_proba"],
+        data_format["las_dimensions"]["ai_vegetation_unclassified_groups"],
+        data_format["codes"]["vegetation"],
+        data_format["las_dimensions"]["classification"],
+        vegetation_unclassifed_hydra_cfg["basic_identification"]["vegetation_nb_trials"],
+        list(data_format["codes"]["vegetation_target"].values()),
+        threshold_sweep=True,
+    )
+    basic_identifier_optimizer.optimize()
+    assert basic_identifier_optimizer.best_iou.iou > 0.9
+    thresholds, ious = basic_identifier_optimizer.iou_curve
+    assert ious.max() == basic_identifier_optimizer.best_iou.iou
+    # The exact best threshold is at least as good as the ones sampled by optuna.
+    basic_identifier_optimizer.threshold_sweep = False
+    basic_identifier_optimizer.optimize()
+    assert basic_identifier_optimizer.best_iou.iou >= basic_identifier_optimizer.study.best_value
+
+
+def test_iou_sweep_matches_iou_by_mask():
+    rng = np.random.default_rng(0)
+    iou_sweep = IoUSweep()
+    tiles = []
+    for _ in range(3):
+        # Rounded probabilities, so that points of different tiles share probabilities.
+        probabilities = np.round(rng.random(1_000), 2).astype(np.float32)
+        target_mask = rng.random(1_000) < probabilities
+        iou_sweep.add(probabilities, target_mask)
+        tiles.append((probabilities, target_mask))
+
+    thresholds, ious = iou_sweep.get_iou_curve()
+    np.testing.assert_array_equal(thresholds, np.unique([p for p, _ in tiles]))
+    for threshold, iou in zip(thresholds, ious):
+        expected = IoU.combine_iou([IoU.iou_by_mask(p >= threshold, t) for p, t in tiles])
+        assert iou == expected.iou
+    best_threshold, best_iou = iou_sweep.get_best_threshold()
+    assert best_iou.iou == ious.max()
+    for threshold in np.linspace(0, 1, 101):
+        iou = IoU.combine_iou([IoU.iou_by_mask(p >= threshold, t) for p, t in tiles])
+        assert iou.iou <= best_iou.iou
+
+    with pytest.raises(ValueError):
+        IoUSweep().get_best_threshold()
@@ -0,0 +1,119 @@
+import shutil
+from pathlib import Path
+
+import geopandas
+import pytest
+import shapely
+
+from lidar_prod.tasks.bd_uni_cache import BDUniFootprintCache
+
+TMP_DIR = Path("tmp/lidar_prod/tasks/bd_uni_cache")
+
+EPSG = 2154
+BBOX = {"x_min": 1000, "y_min": 2000, "x_max": 1400, "y_max": 2400}
+ADJACENT_BBOX = {"x_min": 1300, "y_min": 2000, "x_max": 1700, "y_max": 2400}
+
+
+def setup_module(module):
+    try:
+        shutil.rmtree(TMP_DIR)
+    except FileNotFoundError:
+        pass
+    TMP_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def get_buildings_in_bbox(bbox):
+    """Fake BD Uni: 20m wide buildings every 100m, so that some span two cells of 200m."""
+    return [
+        shapely.box(x, y, x + 20, y + 20)
+        for x in range(0, 3000, 100)
+        for y in range(0, 3000, 100)
+        if x + 20 >= bbox["x_min"]
+        and x <= bbox["x_max"]
+        and y + 20 >= bbox["y_min"]
+        and y <= bbox["y_max"]
+    ]
+
+
+class FakeBDUniClient:
+    """Client of the fake BD Uni, which records requested bboxes."""
+
+    def __init__(self):
+        self.requested_bboxes = []
+
+    def check_bbox_intersects_territoire(self, bbox, epsg_srid):
+        return True
+
+    def fetch_buildings(self, bbox, epsg_srid):
+        self.requested_bboxes.append(bbox)
+        buildings = get_buildings_in_bbox(bbox)
+        return geopandas.GeoDataFrame(
+            {"PRESENCE": [1] * len(buildings)}, geometry=buildings, crs=f"EPSG:{epsg_srid}"
+        )
+
+
+def to_sorted_wkt(geometries):
+    """Comparable representation of geometries, as rings are reoriented in shapefiles."""
+    return sorted(shapely.to_wkt(shapely.normalize(geometries)))
+
+
+def test_footprints_are_served_locally():
+    client = FakeBDUniClient()
+    cache = BDUniFootprintCache(path=str(TMP_DIR / "served_locally.sqlite"), cell_size=200)
+    expected_geometries = to_sorted_wkt(get_buildings_in_bbox(BBOX))
+
+    for _ in range(2):
+        gdf = cache.get_buildings(client, BBOX, EPSG)
+        assert to_sorted_wkt(gdf.geometry.values) == expected_geometries
+        assert gdf.crs.to_epsg() == EPSG
+        assert (gdf["PRESENCE"] == 1).all()
+    assert len(client.requested_bboxes) == 1
+
+    # Only the cells that are not cached yet are requested.
+    gdf = cache.get_buildings(client, ADJACENT_BBOX, EPSG)
+    assert len(client.requested_bboxes) == 2
+    assert client.requested_bboxes[-1]["x_min"] == 1600
+    assert to_sorted_wkt(gdf.geometry.values) == to_sorted_wkt(
+        get_buildings_in_bbox(ADJACENT_BBOX)
+    )
+
+
+def test_empty_area():
+    client = FakeBDUniClient()
+    cache = BDUniFootprintCache(path=str(TMP_DIR / "empty.sqlite"), cell_size=200)
+    empty_bbox = {"x_min": 5000, "y_min": 5000, "x_max": 5100, "y_max": 5100}
+    for _ in range(2):
+        assert len(cache.get_buildings(client, empty_bbox, EPSG)) == 0
+    assert len(client.requested_bboxes) == 1
+
+
+def test_bbox_outside_of_territoire():
+    client = FakeBDUniClient()
+    client.check_bbox_intersects_territoire = lambda bbox, epsg_srid: False
+    cache = BDUniFootprintCache(path=str(TMP_DIR / "outside.sqlite"), cell_size=200)
+    with pytest.raises(ValueError):
+        cache.get_buildings(client, BBOX, EPSG)
+
+
+def test_expired_cells_are_requested_again():
+    client = FakeBDUniClient()
+    cache = BDUniFootprintCache(path=str(TMP_DIR / "expired.sqlite"), cell_size=200, ttl=0)
+    for _ in range(2):
+        cache.get_footprints(client, BBOX, EPSG)
+    assert len(client.requested_bboxes) == 2
+
+
+def test_least_recently_used_cells_are_evicted():
+    client = FakeBDUniClient()
+    cache_path = str(TMP_DIR / "evicted.sqlite")
+    cache = BDUniFootprintCache(path=cache_path, cell_size=200)
+    cache.get_footprints(client, BBOX, EPSG)
+    cache.get_footprints(client, ADJACENT_BBOX, EPSG)
+    assert len(client.requested_bboxes) == 2
+
+    # Evict everything
+    cache = BDUniFootprintCache(path=cache_path, cell_size=200, max_size_mb=0)
+    cache.get_footprints(client, BBOX, EPSG)
+    assert len(client.requested_bboxes) == 2
+    cache.get_footprints(client, ADJACENT_BBOX, EPSG)
+    assert len(client.requested_bboxes) == 3
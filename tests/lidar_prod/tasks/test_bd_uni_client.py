@@ -0,0 +1,133 @@
+import io
+
+import geopandas
+import pytest
+import shapely
+
+from lidar_prod.tasks import bd_uni_client, utils
+from lidar_prod.tasks.bd_uni_client import BDUniClient, to_overlay_datasource
+from lidar_prod.tasks.utils import BDUniConnectionParams
+
+BD_PARAMS = BDUniConnectionParams(host="localhost", user="user", pwd="pwd", bd_name="bduni")
+EPSG = 2154
+BBOX = {"x_min": 1000, "y_min": 2000, "x_max": 1100, "y_max": 2100}
+TERRITOIRE_ENVELOPE = (0.0, 0.0, 10000.0, 10000.0)
+
+# Recorded response of the BD Uni: footprints are returned as WKB in a binary buffer.
+RECORDED_BUILDINGS = [
+    shapely.box(1010, 2010, 1030, 2030),
+    shapely.Polygon([(1050, 2050), (1090, 2050), (1070, 2080)]),
+]
+
+
+class FakeCursor:
+    """Cursor that replays recorded responses of the BD Uni, based on the requested table."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.response = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params):
+        self.connection.queries.append((query, params))
+        if "FROM batiment" in query:
+            self.response = [(memoryview(shapely.to_wkb(b)),) for b in RECORDED_BUILDINGS]
+        else:
+            self.response = [self.connection.territoire_envelope]
+
+    def fetchone(self):
+        return self.response[0]
+
+    def fetchall(self):
+        return self.response
+
+
+class FakeConnection:
+    closed = 0
+
+    def __init__(self):
+        self.territoire_envelope = TERRITOIRE_ENVELOPE
+        self.queries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakePool:
+    def __init__(self, connection):
+        self.connection = connection
+        self.num_connections_in_use = 0
+
+    def getconn(self):
+        self.num_connections_in_use += 1
+        return self.connection
+
+    def putconn(self, conn, close=False):
+        self.num_connections_in_use -= 1
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    pool = FakePool(FakeConnection())
+    monkeypatch.setattr(bd_uni_client, "get_connection_pool", lambda bd_params: pool)
+    monkeypatch.setattr(utils, "_territoire_envelopes", {})
+    return pool
+
+
+def test_get_buildings(fake_pool):
+    client = BDUniClient(BD_PARAMS)
+    gdf = client.get_buildings(BBOX, f"EPSG:{EPSG}")
+
+    assert gdf.crs.to_epsg() == EPSG
+    assert list(gdf.geometry.values) == RECORDED_BUILDINGS
+    assert (gdf["PRESENCE"] == 1).all()
+    # The same pooled connection is used for both requests, and given back to the pool.
+    queries = fake_pool.connection.queries
+    assert len(queries) == 2
+    assert all(params["srid"] == EPSG for _, params in queries)
+    assert fake_pool.num_connections_in_use == 0
+
+    # The envelope of the territoire is requested once per process.
+    client.get_buildings({"x_min": 0, "y_min": 0, "x_max": 100, "y_max": 100}, EPSG)
+    assert len(queries) == 3
+    with pytest.raises(ValueError):
+        client.get_buildings({"x_min": 20000, "y_min": 0, "x_max": 20100, "y_max": 100}, EPSG)
+    assert len(queries) == 3
+
+
+def test_get_buildings_outside_of_territoire(fake_pool):
+    fake_pool.connection.territoire_envelope = (None, None, None, None)
+    client = BDUniClient(BD_PARAMS)
+    with pytest.raises(ValueError):
+        client.get_buildings(BBOX, EPSG)
+    assert fake_pool.num_connections_in_use == 0
+
+
+def test_to_overlay_datasource(fake_pool):
+    gdf = BDUniClient(BD_PARAMS).get_buildings(BBOX, EPSG)
+    datasource = to_overlay_datasource(gdf)
+
+    read_gdf = geopandas.read_file(io.BytesIO(datasource.encode("utf-8")))
+    assert read_gdf.crs.to_epsg() == EPSG
+    assert read_gdf.geometry.equals(gdf.geometry)
+    assert (read_gdf["PRESENCE"] == 1).all()
+
+
+def test_connection_pool_is_reused_in_a_process(monkeypatch):
+    monkeypatch.setattr(bd_uni_client, "_connection_pools", {})
+    monkeypatch.setattr(
+        bd_uni_client.psycopg2.pool, "SimpleConnectionPool", lambda *args, **kwargs: object()
+    )
+    pool = bd_uni_client.get_connection_pool(BD_PARAMS)
+    assert bd_uni_client.get_connection_pool(BD_PARAMS) is pool
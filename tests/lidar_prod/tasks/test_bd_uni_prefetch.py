@@ -0,0 +1,140 @@
+import pickle
+import shutil
+from pathlib import Path
+
+import geopandas
+import laspy
+import numpy as np
+import shapely
+
+from lidar_prod.tasks.bd_uni_prefetch import (
+    get_coverage_envelopes,
+    prefetch_bd_uni_buildings,
+)
+from lidar_prod.tasks.utils import get_integer_bbox_from_las_header
+
+TMP_DIR = Path("tmp/lidar_prod/tasks/bd_uni_prefetch")
+
+EPSG = 2154
+BUFFER = 50
+
+
+def setup_module(module):
+    try:
+        shutil.rmtree(TMP_DIR)
+    except FileNotFoundError:
+        pass
+    TMP_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def get_buildings_in_bbox(bbox):
+    """Fake BD Uni: 20m wide buildings every 100m."""
+    return [
+        shapely.box(x, y, x + 20, y + 20)
+        for x in range(0, 5000, 100)
+        for y in range(0, 5000, 100)
+        if x + 20 >= bbox["x_min"]
+        and x <= bbox["x_max"]
+        and y + 20 >= bbox["y_min"]
+        and y <= bbox["y_max"]
+    ]
+
+
+class FakeBDUniClient:
+    def __init__(self):
+        self.requested_bboxes = []
+
+    def get_buildings(self, bbox, epsg):
+        self.requested_bboxes.append(bbox)
+        buildings = get_buildings_in_bbox(bbox)
+        return geopandas.GeoDataFrame(
+            {"PRESENCE": [1] * len(buildings)}, geometry=buildings, crs=f"EPSG:{epsg}"
+        )
+
+
+def write_tile(las_path, x_min, y_min, size=1000):
+    header = laspy.LasHeader(point_format=6, version="1.4")
+    header.scales = [0.01, 0.01, 0.01]
+    las = laspy.LasData(header)
+    las.x = np.array([x_min + 0.5, x_min + size - 0.5])
+    las.y = np.array([y_min + 0.5, y_min + size - 0.5])
+    las.z = np.array([0.0, 0.0])
+    las.write(las_path)
+    return las_path
+
+
+def bbox(x_min, y_min, x_max, y_max):
+    return {"x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max}
+
+
+def test_get_integer_bbox_from_las_header():
+    las_path = write_tile(str(TMP_DIR / "header.las"), 1000, 2000)
+    assert get_integer_bbox_from_las_header(las_path, BUFFER) == bbox(950, 1950, 2050, 3050)
+
+
+def test_get_coverage_envelopes():
+    bboxes = [
+        bbox(0, 0, 1000, 1000),
+        bbox(1000, 0, 2000, 1000),  # touches the first one
+        bbox(5000, 0, 6000, 1000),  # isolated
+        bbox(19000, 0, 20000, 1000),
+        bbox(20000, 0, 22000, 1000),  # touches the previous one, but center in another cell
+    ]
+
+    def sort(envelopes):
+        return sorted(envelopes, key=lambda e: (e["x_min"], e["y_min"]))
+
+    assert sort(get_coverage_envelopes(bboxes, max_envelope_size=40000)) == [
+        bbox(0, 0, 2000, 1000),
+        bbox(5000, 0, 6000, 1000),
+        bbox(19000, 0, 22000, 1000),
+    ]
+    assert sort(get_coverage_envelopes(bboxes, max_envelope_size=20000)) == [
+        bbox(0, 0, 2000, 1000),
+        bbox(5000, 0, 6000, 1000),
+        bbox(19000, 0, 20000, 1000),
+        bbox(20000, 0, 22000, 1000),
+    ]
+
+
+def test_prefetch_bd_uni_buildings():
+    las_paths = [
+        write_tile(str(TMP_DIR / f"tile_{x}_{y}.las"), x, y)
+        for x in range(1000, 3000, 1000)
+        for y in range(1000, 3000, 1000)
+    ]
+    client = FakeBDUniClient()
+    prefetched = prefetch_bd_uni_buildings(
+        client, las_paths, f"EPSG:{EPSG}", buffer=BUFFER, max_envelope_size=10000
+    )
+    assert len(client.requested_bboxes) == 1
+
+    # Prefetched buildings are sent to worker processes.
+    prefetched = pickle.loads(pickle.dumps(prefetched))
+    for las_path in las_paths:
+        tile_bbox = get_integer_bbox_from_las_header(las_path, BUFFER)
+        assert prefetched.covers(tile_bbox, EPSG)
+        buildings = prefetched.get_buildings(tile_bbox)
+        assert sorted(buildings.geometry.to_wkt()) == sorted(
+            shapely.to_wkt(get_buildings_in_bbox(tile_bbox))
+        )
+        assert (buildings["PRESENCE"] == 1).all()
+
+    assert not prefetched.covers(bbox(0, 0, 1000, 1000), EPSG)
+    assert not prefetched.covers(tile_bbox, 5490)
+
+
+def test_prefetch_bd_uni_buildings_outside_of_territoire():
+    las_path = write_tile(str(TMP_DIR / "outside.las"), 1000, 1000)
+    client = FakeBDUniClient()
+
+    def get_buildings_outside_of_territoire(bbox, epsg):
+        raise ValueError("bbox does not intersect any territoire")
+
+    client.get_buildings = get_buildings_outside_of_territoire
+    prefetched = prefetch_bd_uni_buildings(
+        client, [las_path], EPSG, buffer=BUFFER, max_envelope_size=10000
+    )
+    # Tiles fall back to per-tile requests
+    assert not prefetched.covers(get_integer_bbox_from_las_header(las_path, BUFFER), EPSG)
+    assert len(prefetched.buildings) == 0
@@ -1,5 +1,8 @@
 import shutil
 from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
 
 from lidar_prod.tasks.building_completion import BuildingCompletor
 from lidar_prod.tasks.utils import get_pdal_writer
@@ -59,3 +62,45 @@ def test_run(hydra_cfg):
             dims.candidate_buildings_flag,
         ],
     )
+
+
+def test_update_classification(hydra_cfg):
+    """Groups that contain a confirmed building point are completed: candidates are confirmed
+    and other points are flagged, while other groups and unclustered points are left as is."""
+    dims = hydra_cfg.data_format.las_dimensions
+    building = hydra_cfg.data_format.codes.building.final.building
+    not_building = hydra_cfg.data_format.codes.building.final.not_building
+    points = np.zeros(
+        8,
+        dtype=[
+            (dims.classification, np.uint8),
+            (dims.ClusterID_confirmed_or_high_proba, np.float64),
+            (dims.completion_non_candidate_flag, np.float64),
+            (dims.candidate_buildings_flag, np.float64),
+        ],
+    )
+    # Group 3 contains a confirmed point, group 1 does not, last points are not clustered.
+    points[dims.ClusterID_confirmed_or_high_proba] = [3, 3, 3, 1, 1, 0, 0, 3]
+    points[dims.classification] = [building, not_building, 1, not_building, 1, building, 1, 1]
+    points[dims.candidate_buildings_flag] = [1, 1, 0, 1, 0, 0, 0, 0]
+
+    bc_cfg = hydra_cfg.building_completion
+    bc = BuildingCompletor(
+        min_building_proba=bc_cfg.min_building_proba,
+        cluster=bc_cfg.cluster,
+        data_format=bc_cfg.data_format,
+    )
+    bc.pipeline = SimpleNamespace(arrays=[points])
+    bc.update_classification()
+
+    assert points[dims.classification].tolist() == [
+        building,
+        building,
+        1,
+        not_building,
+        1,
+        building,
+        1,
+        1,
+    ]
+    assert points[dims.completion_non_candidate_flag].tolist() == [0, 0, 1, 0, 0, 0, 0, 1]
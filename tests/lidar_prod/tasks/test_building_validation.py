@@ -5,8 +5,16 @@ import hydra
 import numpy as np
 import pytest
 
-from lidar_prod.tasks.building_validation import BuildingValidator, thresholds
-from lidar_prod.tasks.utils import BDUniConnectionParams, get_las_data_from_las
+from lidar_prod.tasks.building_validation import (
+    BuildingValidationClusterInfo,
+    BuildingValidator,
+    thresholds,
+)
+from lidar_prod.tasks.utils import (
+    BDUniConnectionParams,
+    ClusterIndex,
+    get_las_data_from_las,
+)
 from tests.conftest import (
     check_expected_classification,
     check_las_contains_dims,
@@ -173,6 +181,59 @@ def test_run(hydra_cfg):
     )
 
 
+@pytest.mark.parametrize("engine", ["shapely", "raster"])
+def test_in_process_overlay_engine_matches_pdal_overlay(hydra_cfg, engine):
+    """In-process overlays flag clustered candidates exactly as the pdal overlay."""
+    input_las_path = "tests/files/870000_6618000.subset.postIA.las"
+    shp_path = "tests/files/870000_6618000.subset.postIA.shp"
+    bv_cfg = hydra_cfg.building_validation.application
+    dims = hydra_cfg.data_format.las_dimensions
+
+    points = {}
+    for overlay_engine in ["pdal", engine]:
+        bv_cfg.overlay.engine = overlay_engine
+        bv = BuildingValidator(
+            shp_path=shp_path,
+            cluster=bv_cfg.cluster,
+            bd_uni_request=bv_cfg.bd_uni_request,
+            data_format=bv_cfg.data_format,
+            thresholds=bv_cfg.thresholds,
+            use_final_classification_codes=bv_cfg.use_final_classification_codes,
+            overlay=bv_cfg.overlay,
+        )
+        bv.prepare(input_las_path, "")
+        points[overlay_engine] = np.sort(bv.pipeline.arrays[0], order=["X", "Y", "Z", "GpsTime"])
+
+    clustered = points["pdal"][dims.ClusterID_candidate_building] > 0
+    assert np.any(points["pdal"][dims.uni_db_overlay][clustered] == 1)
+    assert np.array_equal(
+        points[engine][dims.uni_db_overlay][clustered],
+        points["pdal"][dims.uni_db_overlay][clustered],
+    )
+
+
+def test_prepare_creates_compact_intermediary_dimensions(hydra_cfg):
+    bv_cfg = hydra_cfg.building_validation.application
+    dims = hydra_cfg.data_format.las_dimensions
+    bv = BuildingValidator(
+        shp_path="tests/files/870000_6618000.subset.postIA.shp",
+        cluster=bv_cfg.cluster,
+        bd_uni_request=bv_cfg.bd_uni_request,
+        data_format=bv_cfg.data_format,
+        thresholds=bv_cfg.thresholds,
+        use_final_classification_codes=bv_cfg.use_final_classification_codes,
+        overlay=bv_cfg.overlay,
+    )
+    bv.prepare("tests/files/870000_6618000.subset.postIA.las", "")
+    points = bv.pipeline.arrays[0]
+
+    assert points.dtype[dims.candidate_buildings_flag] == np.uint8
+    assert points.dtype[dims.uni_db_overlay] == np.uint8
+    assert points.dtype[dims.ClusterID_candidate_building] == np.uint32
+    assert points[dims.ClusterID_candidate_building].max() > 0
+    assert np.any(points[dims.uni_db_overlay] == 1)
+
+
 def test_thresholds():
     dump_file = str(TMP_DIR / "threshold_dump.yml")
 
@@ -192,3 +253,57 @@ def test_thresholds():
     th1 = th.load(dump_file)
 
     assert th1 == th
+
+
+@pytest.mark.parametrize("use_final_classification_codes", [True, False])
+def test_vectorized_group_decisions_match_per_cluster_decisions(
+    hydra_cfg, use_final_classification_codes
+):
+    """The vectorized decisions of `update` must be identical to the per-cluster ones."""
+    bv_cfg = hydra_cfg.building_validation.application
+    bv = BuildingValidator(
+        cluster=bv_cfg.cluster,
+        bd_uni_request=bv_cfg.bd_uni_request,
+        data_format=bv_cfg.data_format,
+        thresholds=bv_cfg.thresholds,
+        use_final_classification_codes=use_final_classification_codes,
+    )
+    rng = np.random.default_rng(0)
+    num_clusters = 2_000
+    num_points = 50_000
+    cluster_idx = rng.integers(0, num_clusters, size=num_points)
+
+    # Values vary by cluster to get all kinds of decisions, and are quantized to have points
+    # exactly on thresholds.
+    def draw_by_cluster(scale):
+        values = rng.random(num_clusters)[cluster_idx] + scale * rng.normal(size=num_points)
+        return np.round(np.clip(values, 0, 1), 2)
+
+    probabilities = draw_by_cluster(0.1).astype(np.float32)
+    entropies = draw_by_cluster(0.2).astype(np.float32)
+    overlays = (draw_by_cluster(0.3) > 0.5).astype(np.float64)
+
+    # ClusterIDs start at 1
+    decisions = bv._make_detailed_group_decisions(
+        ClusterIndex(cluster_idx + 1), probabilities, overlays, entropies
+    )
+    if use_final_classification_codes:
+        decisions = bv._get_final_codes(decisions)
+    decision_func = (
+        bv._make_group_decision
+        if use_final_classification_codes
+        else bv._make_detailed_group_decision
+    )
+    expected_decisions = [
+        decision_func(
+            BuildingValidationClusterInfo(
+                probabilities[cluster_idx == i],
+                overlays[cluster_idx == i],
+                entropies[cluster_idx == i],
+            )
+        )
+        for i in range(cluster_idx.max() + 1)
+    ]
+    assert np.array_equal(decisions, expected_decisions)
+    # Make sure that all decision codes are exercised.
+    assert len(np.unique(decisions)) >= (3 if use_final_classification_codes else 6)
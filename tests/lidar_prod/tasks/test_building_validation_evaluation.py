@@ -0,0 +1,66 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from lidar_prod.tasks.building_validation import BuildingValidator, thresholds
+from lidar_prod.tasks.building_validation_evaluation import BuildingValidationEvaluator
+from lidar_prod.tasks.cluster_store import ClusterStore
+from tests.conftest import get_random_store, get_random_thresholds
+
+TMP_DIR = Path("tmp/lidar_prod/tasks/building_validation_evaluation")
+
+
+def setup_module(module):
+    try:
+        shutil.rmtree(TMP_DIR)
+    except FileNotFoundError:
+        pass
+    TMP_DIR.mkdir(parents=True, exist_ok=True)
+
+
+@pytest.mark.parametrize("use_final_classification_codes", [True, False])
+def test_evaluator_decisions_match_per_cluster_decisions(
+    hydra_cfg, use_final_classification_codes
+):
+    bv_cfg = hydra_cfg.building_validation.application
+    bv = BuildingValidator(
+        cluster=bv_cfg.cluster,
+        bd_uni_request=bv_cfg.bd_uni_request,
+        data_format=bv_cfg.data_format,
+        thresholds=bv_cfg.thresholds,
+    )
+    store = get_random_store(str(TMP_DIR / "random"))
+    evaluator = BuildingValidationEvaluator(bv, store)
+    assert len(evaluator) == len(store)
+    np.testing.assert_array_equal(evaluator.targets, store.targets)
+
+    rng = np.random.default_rng(1)
+    all_decisions = []
+    for bv_thresholds in [thresholds(**bv_cfg.thresholds)] + [
+        get_random_thresholds(rng) for _ in range(10)
+    ]:
+        bv.thresholds = bv_thresholds
+        if use_final_classification_codes:
+            decisions = evaluator.make_group_decisions(bv_thresholds)
+            expected_decisions = [bv._make_group_decision(info) for info in store]
+        else:
+            decisions = evaluator.make_detailed_group_decisions(bv_thresholds)
+            expected_decisions = [bv._make_detailed_group_decision(info) for info in store]
+        np.testing.assert_array_equal(decisions, expected_decisions)
+        all_decisions.append(decisions)
+    # Make sure that all decision codes are exercised.
+    assert len(np.unique(all_decisions)) >= (3 if use_final_classification_codes else 6)
+
+
+def test_evaluator_on_empty_store(hydra_cfg):
+    bv_cfg = hydra_cfg.building_validation.application
+    bv = BuildingValidator(
+        cluster=bv_cfg.cluster,
+        bd_uni_request=bv_cfg.bd_uni_request,
+        data_format=bv_cfg.data_format,
+        thresholds=bv_cfg.thresholds,
+    )
+    evaluator = BuildingValidationEvaluator(bv, ClusterStore.create(str(TMP_DIR / "empty")))
+    assert len(evaluator.make_group_decisions(thresholds(**bv_cfg.thresholds))) == 0
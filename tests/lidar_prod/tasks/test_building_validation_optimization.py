@@ -7,13 +7,15 @@ import hydra
 import numpy as np
 import pytest
 import yaml
+from sklearn.metrics import confusion_matrix
 
 from lidar_prod.tasks.building_validation import thresholds
 from lidar_prod.tasks.building_validation_optimization import (
     BuildingValidationOptimizer,
+    get_confusion_matrices,
 )
 from lidar_prod.tasks.utils import BDUniConnectionParams
-from tests.conftest import pdal_read_las_array
+from tests.conftest import get_random_store, pdal_read_las_array
 
 """We test the building validation optimizer against two LAS:
 
@@ -144,6 +146,299 @@ def test_BVOptimization_on_subset(hydra_cfg):
     assert actual_codes.issubset(expected_codes)
 
 
+def test_BVOptimization_evaluates_trials_by_batches(hydra_cfg):
+    opt_cfg = hydra_cfg.building_validation.optimization
+    opt_cfg.paths.results_output_dir = str(TMP_DIR / "batches")
+    opt_cfg.todo = "optimize"
+    opt_cfg.design.n_trials = 120
+    opt_cfg.design.trials_batch_size = 50
+    get_random_store(opt_cfg.paths.cluster_store_dir, num_clusters=200, num_points=5_000)
+
+    bvo: BuildingValidationOptimizer = hydra.utils.instantiate(opt_cfg)
+    bvo.run()
+
+    trials = bvo.study.trials
+    assert len(trials) == 120
+    assert os.path.isfile(opt_cfg.paths.building_validation_thresholds)
+    # Each trial gets the metrics of its own thresholds.
+    clusters = bvo._load_clusters()
+    for trial in trials[::10]:
+        bvo.bv.thresholds = thresholds(**trial.params)
+        decisions = [bvo.bv._make_group_decision(info) for info in clusters]
+        metrics_dict = bvo.evaluate_decisions(np.asarray(clusters.targets), np.array(decisions))
+        assert (
+            trial.values[0]
+            == metrics_dict[opt_cfg.design.metrics.proportion_of_automated_decisions]
+        )
+        assert "constraint" in trial.user_attrs
+
+
+def test_BVOptimization_runs_trials_in_parallel_with_a_shared_storage(hydra_cfg):
+    opt_cfg = hydra_cfg.building_validation.optimization
+    opt_cfg.paths.results_output_dir = str(TMP_DIR / "parallel")
+    opt_cfg.todo = "optimize"
+    opt_cfg.n_workers = 2
+    opt_cfg.design.n_trials = 30
+    opt_cfg.design.trials_batch_size = 10
+    get_random_store(opt_cfg.paths.cluster_store_dir, num_clusters=100, num_points=2_000)
+
+    # An in-memory study cannot be shared by workers.
+    bvo: BuildingValidationOptimizer = hydra.utils.instantiate(opt_cfg)
+    with pytest.raises(ValueError):
+        bvo.run()
+
+    opt_cfg.study.storage = {
+        "_target_": "optuna.storages.JournalStorage",
+        "log_storage": {
+            "_target_": "optuna.storages.journal.JournalFileBackend",
+            "file_path": str(TMP_DIR / "parallel" / "study.log"),
+        },
+    }
+    bvo = hydra.utils.instantiate(opt_cfg)
+    bvo.run()
+    assert os.path.isfile(opt_cfg.paths.building_validation_thresholds)
+    trials = bvo.study.trials
+    assert len(trials) == 30
+    assert all("constraint" in trial.user_attrs for trial in trials)
+    # Workers sample different thresholds.
+    assert len({tuple(trial.params.values()) for trial in trials}) == 30
+
+    # Another run contributes trials to the same study.
+    opt_cfg.design.resume = False
+    bvo = hydra.utils.instantiate(opt_cfg)
+    bvo.run()
+    assert len(bvo.study.trials) == 60
+
+
+def test_BVOptimization_resumes_and_warm_starts_studies(hydra_cfg):
+    opt_cfg = hydra_cfg.building_validation.optimization
+    out_dir = TMP_DIR / "warm_start"
+    opt_cfg.paths.results_output_dir = str(out_dir)
+    opt_cfg.todo = "optimize"
+    opt_cfg.design.n_trials = 20
+    opt_cfg.design.trials_batch_size = 10
+    opt_cfg.study.storage = f"sqlite:///{out_dir}/study.db"
+    opt_cfg.design.warm_start.application_thresholds = True
+    # All trials are feasible, so that the Pareto front is not empty.
+    for constraint in opt_cfg.design.constraints:
+        opt_cfg.design.constraints[constraint] = 0.0
+    get_random_store(opt_cfg.paths.cluster_store_dir, num_clusters=100, num_points=2_000)
+
+    bvo: BuildingValidationOptimizer = hydra.utils.instantiate(opt_cfg)
+    bvo.run()
+    trials = bvo.study.trials
+    assert len(trials) == 20
+    # The thresholds in production are the first trial.
+    application_thresholds = hydra_cfg.building_validation.application.thresholds
+    assert trials[0].params == pytest.approx(dict(application_thresholds))
+
+    # Finished trials are counted, e.g. when resuming an interrupted study.
+    bvo = hydra.utils.instantiate(opt_cfg)
+    bvo.run()
+    assert len(bvo.study.trials) == 20
+    opt_cfg.design.n_trials = 30
+    bvo = hydra.utils.instantiate(opt_cfg)
+    bvo.run()
+    assert len(bvo.study.trials) == 30
+    # Resumed runs do not sample the same thresholds again.
+    assert len({tuple(trial.params.values()) for trial in bvo.study.trials}) == 30
+
+    # A new study is seeded with the Pareto front of the previous one.
+    pareto_front = [trial.params for trial in bvo.study.best_trials]
+    assert pareto_front
+    opt_cfg.study.study_name = "warm_started"
+    opt_cfg.design.warm_start.application_thresholds = False
+    opt_cfg.design.warm_start.previous_study = {
+        "_target_": "optuna.load_study",
+        "_partial_": True,
+        "study_name": "auto_precision_recall",
+        "storage": f"sqlite:///{out_dir}/study.db",
+    }
+    bvo = hydra.utils.instantiate(opt_cfg)
+    bvo.run()
+    trials = bvo.study.trials
+    assert [trial.params for trial in trials[: len(pareto_front)]] == pareto_front
+
+
+def test_BVOptimization_prepare_is_parallel_and_resumable(hydra_cfg):
+    opt_cfg = hydra_cfg.building_validation.optimization
+    out_dir = TMP_DIR / "resumable"
+    opt_cfg.paths.results_output_dir = str(out_dir)
+    input_las_dir = out_dir / "inputs"
+    os.makedirs(input_las_dir, exist_ok=False)
+    opt_cfg.paths.input_las_dir = str(input_las_dir)
+    opt_cfg.todo = "prepare"
+    opt_cfg.n_workers = 2
+    bd_uni_connection_params: BDUniConnectionParams = hydra.utils.instantiate(
+        hydra_cfg.bd_uni_connection_params
+    )
+    num_clusters_by_tile = SUBSET_EXPECTED_METRICS["exact"]["groups_count"]
+
+    def prepare():
+        bvo: BuildingValidationOptimizer = hydra.utils.instantiate(opt_cfg)
+        bvo.bv.bd_uni_connection_params = bd_uni_connection_params
+        bvo.run()
+        return bvo
+
+    for name in ["a.las", "b.las"]:
+        shutil.copy(LAS_SUBSET_FILE, input_las_dir / name)
+    bvo = prepare()
+    store = bvo._load_clusters()
+    assert len(store) == 2 * num_clusters_by_tile
+    # Both tiles have the same clusters, whichever worker prepared them.
+    np.testing.assert_array_equal(
+        store.probabilities[: store.offsets[num_clusters_by_tile]],
+        store.probabilities[store.offsets[num_clusters_by_tile] :],
+    )
+    prepared_mtimes = [os.path.getmtime(path) for path in bvo.prepared_las_filepaths]
+
+    # Only a new tile is prepared.
+    shutil.copy(LAS_SUBSET_FILE, input_las_dir / "c.las")
+    bvo = prepare()
+    assert [os.path.getmtime(path) for path in bvo.prepared_las_filepaths[:2]] == prepared_mtimes
+    assert len(bvo._load_clusters()) == 3 * num_clusters_by_tile
+
+    # Tiles are prepared again when the config of the preparation changes.
+    opt_cfg.buildings_correction_labels.min_frac.true_positives = 0.9
+    bvo = prepare()
+    assert os.path.getmtime(bvo.prepared_las_filepaths[0]) > prepared_mtimes[0]
+
+
+def test_extract_clusters_from_points(hydra_cfg):
+    opt_cfg = hydra_cfg.building_validation.optimization
+    opt_cfg.paths.results_output_dir = str(TMP_DIR / "extract")
+    bvo: BuildingValidationOptimizer = hydra.utils.instantiate(opt_cfg, todo="optimize")
+    dims = bvo.bv.data_format.las_dimensions
+    labels = bvo.buildings_correction_labels
+
+    rng = np.random.default_rng(0)
+    num_points = 20_000
+    points = np.zeros(
+        num_points,
+        dtype=[
+            (dims.ClusterID_candidate_building, "u4"),
+            (dims.classification, "u1"),
+            (dims.ai_building_proba, "f4"),
+            (dims.uni_db_overlay, "u1"),
+            (dims.entropy, "f4"),
+        ],
+    )
+    cluster_ids = rng.integers(0, 500, size=num_points)
+    points[dims.ClusterID_candidate_building] = cluster_ids
+    # Fractions of true positives vary by cluster to get all kinds of targets.
+    tp_frac = rng.choice([0.0, 0.03, 0.5, 0.96, 1.0], size=500)[cluster_ids]
+    points[dims.classification] = np.where(
+        rng.random(num_points) < tp_frac,
+        labels.codes.true_positives[0],
+        labels.codes.false_positives[0],
+    )
+    points[dims.ai_building_proba] = rng.random(num_points)
+    points[dims.uni_db_overlay] = rng.integers(0, 2, size=num_points)
+    points[dims.entropy] = rng.random(num_points)
+
+    columns = bvo._extract_clusters(points)
+
+    expected_sizes, expected_targets = [], []
+    for cluster_id in range(1, 500):
+        pts = points[points[dims.ClusterID_candidate_building] == cluster_id]
+        expected_sizes.append(len(pts))
+        tp_frac = np.mean(np.isin(pts[dims.classification], labels.codes.true_positives))
+        if tp_frac >= labels.min_frac.true_positives:
+            expected_targets.append(bvo.bv.codes.final.building)
+        elif tp_frac < labels.min_frac.false_positives:
+            expected_targets.append(bvo.bv.codes.final.not_building)
+        else:
+            expected_targets.append(bvo.bv.codes.final.unsure)
+    # Points of clusters are in the order of clusters, then in their original order.
+    clustered_points = points[np.argsort(cluster_ids, kind="stable")]
+    clustered_points = clustered_points[clustered_points[dims.ClusterID_candidate_building] > 0]
+
+    np.testing.assert_array_equal(columns["sizes"], expected_sizes)
+    np.testing.assert_array_equal(columns["targets"], expected_targets)
+    assert len(np.unique(columns["targets"])) == 3
+    for name, dim in [
+        ("probabilities", dims.ai_building_proba),
+        ("overlays", dims.uni_db_overlay),
+        ("entropies", dims.entropy),
+    ]:
+        np.testing.assert_array_equal(columns[name], clustered_points[dim])
+
+
+def test_get_confusion_matrices():
+    rng = np.random.default_rng(0)
+    labels = [214, 208, 6]
+    targets = rng.choice(labels + [1], size=1_000)
+    decisions = rng.choice(labels + [2], size=(5, 1_000))
+    cms = get_confusion_matrices(targets, decisions, labels)
+    assert cms.shape == (5, 3, 3)
+    for cm, trial_decisions in zip(cms, decisions):
+        assert np.array_equal(cm, confusion_matrix(targets, trial_decisions, labels=labels))
+        assert np.array_equal(get_confusion_matrices(targets, trial_decisions, labels), cm)
+
+
+def get_expected_metrics(bvo, mts_gt, ia_decision):
+    """Metrics computed with sklearn, as evaluate_decisions did with one matrix per metric."""
+    metrics = bvo.design.metrics
+    labels = bvo.design.confusion_matrix_order
+
+    def cm(normalize, mask=slice(None)):
+        return confusion_matrix(
+            mts_gt[mask], ia_decision[mask], labels=labels, normalize=normalize
+        )
+
+    P_MTS_U, P_MTS_N, P_MTS_C = cm("all").sum(axis=1)
+    P_IA_u, P_IA_r, P_IA_c = cm("all").sum(axis=0)
+    quality_cm = cm("all", mts_gt != bvo.bv.codes.final.unsure)
+    with np.errstate(all="ignore"):
+        final_true_positives = quality_cm[2, 0] + quality_cm[2, 2]
+        precision = final_true_positives / (final_true_positives + quality_cm[1, 2])
+        recall = final_true_positives / quality_cm[2, :].sum()
+    return {
+        metrics.groups_count: len(ia_decision),
+        metrics.confusion_matrix_no_norm: cm(None),
+        metrics.group_unsure: P_MTS_U,
+        metrics.group_no_buildings: P_MTS_N,
+        metrics.group_building: P_MTS_C,
+        metrics.proportion_of_automated_decisions: P_IA_c + P_IA_r,
+        metrics.proportion_of_uncertainty: P_IA_u,
+        metrics.proportion_of_refutation: P_IA_r,
+        metrics.proportion_of_confirmation: P_IA_c,
+        metrics.refutation_accuracy: cm("pred")[1, 1],
+        metrics.confirmation_accuracy: cm("pred")[2, 2],
+        metrics.confusion_matrix_norm: cm("true"),
+        metrics.precision: precision,
+        metrics.recall: recall,
+    }
+
+
+def test_evaluate_decisions_from_a_single_matrix(hydra_cfg):
+    opt_cfg = hydra_cfg.building_validation.optimization
+    opt_cfg.paths.results_output_dir = str(TMP_DIR / "metrics")
+    bvo: BuildingValidationOptimizer = hydra.utils.instantiate(opt_cfg, todo="evaluate")
+    codes = bvo.design.confusion_matrix_order
+    rng = np.random.default_rng(0)
+    mts_gt = rng.choice(codes, size=300)
+    trials_decisions = rng.choice(codes, size=(4, 300))
+    # Without confirmations: some metrics divide by 0.
+    trials_decisions[-1] = codes[0]
+
+    batch_metrics = bvo.evaluate_decisions(mts_gt, trials_decisions)
+    for i, decisions in enumerate(trials_decisions):
+        metrics_dict = bvo.evaluate_decisions(mts_gt, decisions)
+        expected_metrics = get_expected_metrics(bvo, mts_gt, decisions)
+        assert metrics_dict.keys() == expected_metrics.keys()
+        for name, expected in expected_metrics.items():
+            np.testing.assert_array_equal(metrics_dict[name], expected)
+            assert type(metrics_dict[name]) is type(expected)
+            if name != bvo.design.metrics.groups_count:
+                np.testing.assert_array_equal(batch_metrics[name][i], expected)
+
+    # Only ambiguous targets: precision and recall are undefined.
+    metrics_dict = bvo.evaluate_decisions(np.full(300, codes[0]), trials_decisions[0])
+    assert np.isnan(metrics_dict[bvo.design.metrics.precision])
+    assert np.isnan(metrics_dict[bvo.design.metrics.recall])
+
+
 @pytest.mark.slow()
 def test_BVOptimization_on_large_file(hydra_cfg):
 
@@ -1,6 +1,7 @@
 import os.path as osp
 import tempfile
 
+import numpy as np
 import pytest
 
 from lidar_prod.tasks.cleaning import Cleaner
@@ -66,6 +67,26 @@ def test_pdal_cleaning_format(extra_dims):
         check_las_format_versions_and_srs(clean_las_path, SRC_LAS_EPSG)
 
 
+@pytest.mark.parametrize(
+    "extra_dims, expected_dims",
+    [
+        ("", ["X", "Classification"]),
+        ("entropy=float", ["X", "Classification", "entropy"]),
+        ("all", ["X", "Classification", "entropy", "building"]),
+    ],
+)
+def test_remove_dimensions_from_array(extra_dims, expected_dims):
+    points = np.zeros(
+        3,
+        dtype=[("X", "f8"), ("Classification", "u1"), ("entropy", "f4"), ("building", "f4")],
+    )
+    points["entropy"] = [0.1, 0.2, 0.3]
+    cleaned_points = Cleaner(extra_dims=extra_dims).remove_dimensions_from_array(points)
+    assert list(cleaned_points.dtype.names) == expected_dims
+    if "entropy" in expected_dims:
+        assert np.array_equal(cleaned_points["entropy"], points["entropy"])
+
+
 @pytest.mark.parametrize(
     "extra_dims, expected",
     [
@@ -0,0 +1,90 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from lidar_prod.tasks.building_validation import BuildingValidationClusterInfo
+from lidar_prod.tasks.cluster_store import ClusterStore, _append_to_npy
+
+TMP_DIR = Path("tmp/lidar_prod/tasks/cluster_store")
+
+
+def setup_module(module):
+    try:
+        shutil.rmtree(TMP_DIR)
+    except FileNotFoundError:
+        pass
+    TMP_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def get_clusters(sizes, seed):
+    rng = np.random.default_rng(seed)
+    return [
+        BuildingValidationClusterInfo(
+            rng.random(size),
+            rng.integers(0, 2, size),
+            rng.random(size),
+            int(rng.choice([0, 6, 208])),
+        )
+        for size in sizes
+    ]
+
+
+def assert_clusters_equal(store, clusters):
+    assert len(store) == len(clusters)
+    for info, expected in zip(store, clusters):
+        np.testing.assert_array_equal(
+            info.probabilities, expected.probabilities.astype(np.float32)
+        )
+        np.testing.assert_array_equal(info.overlays, expected.overlays)
+        np.testing.assert_array_equal(info.entropies, expected.entropies.astype(np.float32))
+        assert info.target == expected.target
+
+
+def test_clusters_are_appended_and_memory_mapped():
+    directory = str(TMP_DIR / "appended")
+    store = ClusterStore.create(directory)
+    assert len(store) == 0
+    clusters = get_clusters([3, 1, 10], seed=0)
+    store.append_clusters(clusters)
+    store.append_clusters([])
+    more_clusters = get_clusters([5, 2], seed=1)
+    store.append_clusters(more_clusters)
+
+    store = ClusterStore(directory)
+    assert_clusters_equal(store, clusters + more_clusters)
+    assert isinstance(store.probabilities.base, np.memmap)
+    assert store.probabilities.dtype == np.float32
+    assert store.overlays.dtype == np.uint8
+    np.testing.assert_array_equal(store.offsets, [0, 3, 4, 14, 19, 21])
+    assert store[-1].target == more_clusters[-1].target
+    with pytest.raises(IndexError):
+        store[len(store)]
+
+
+def test_interrupted_append_is_ignored_and_overwritten():
+    directory = str(TMP_DIR / "interrupted")
+    store = ClusterStore.create(directory)
+    clusters = get_clusters([4, 2], seed=2)
+    store.append_clusters(clusters)
+
+    # Points written without their offsets, as if an append was interrupted.
+    _append_to_npy(f"{directory}/probabilities.npy", np.ones(7), start=6)
+    store = ClusterStore(directory)
+    assert_clusters_equal(store, clusters)
+
+    more_clusters = get_clusters([3], seed=3)
+    store.append_clusters(more_clusters)
+    assert_clusters_equal(ClusterStore(directory), clusters + more_clusters)
+    assert np.load(f"{directory}/probabilities.npy").shape == (9,)
+
+
+def test_npy_header_is_rewritten_in_place():
+    path = str(TMP_DIR / "header.npy")
+    np.save(path, np.empty(0, dtype=np.float32))
+    values = np.arange(100_000, dtype=np.float32)
+    _append_to_npy(path, values, start=0)
+    np.testing.assert_array_equal(np.load(path), values)
+    with pytest.raises(ValueError):
+        _append_to_npy(path, values, start=len(values) + 1)
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+import scipy.sparse.csgraph
+
+from lidar_prod.tasks.building_identification import BuildingIdentifier
+from lidar_prod.tasks.clustering import TileSpatialIndex, get_cluster_labels
+
+
+def get_expected_cluster_labels(coordinates, tolerance, min_points):
+    """Brute force clustering: connected components of points strictly closer than tolerance,
+    numbered in the order of their first point."""
+    squared_distances = ((coordinates[:, None, :] - coordinates[None, :, :]) ** 2).sum(axis=-1)
+    _, components = scipy.sparse.csgraph.connected_components(
+        squared_distances < tolerance**2, directed=False
+    )
+    labels = np.zeros(len(coordinates), dtype=np.uint64)
+    next_label = 1
+    for component in dict.fromkeys(components):
+        in_component = components == component
+        if in_component.sum() >= min_points:
+            labels[in_component] = next_label
+            next_label += 1
+    return labels
+
+
+@pytest.mark.parametrize("n_dims", [2, 3])
+@pytest.mark.parametrize("tolerance,min_points", [(0.5, 3), (0.3, 1), (1.0, 10)])
+@pytest.mark.parametrize("n_threads", [1, 2])
+def test_get_cluster_labels(n_dims, tolerance, min_points, n_threads):
+    rng = np.random.default_rng(0)
+    # Quantized coordinates, to have points exactly at tolerance from each other.
+    coordinates = np.round(rng.uniform(0, 20, size=(1500, n_dims)), 1) + 1000
+
+    labels = get_cluster_labels(coordinates, tolerance, min_points, n_threads=n_threads)
+
+    assert np.array_equal(labels, get_expected_cluster_labels(coordinates, tolerance, min_points))
+
+
+def test_get_cluster_labels_without_points():
+    assert len(get_cluster_labels(np.empty((0, 3)), 0.5, 10)) == 0
+
+
+@pytest.mark.parametrize("cell_size", [0.05, 0.3, 0.5, 2.0])
+def test_tile_spatial_index_matches_get_cluster_labels(cell_size):
+    rng = np.random.default_rng(0)
+    n_points = 20_000
+    points = np.zeros(n_points, dtype=[("X", "f8"), ("Y", "f8"), ("Z", "f8")])
+    points["X"] = np.round(rng.uniform(0, 60, n_points), 2) + 870000
+    points["Y"] = np.round(rng.uniform(0, 40, n_points), 2) + 6618000
+    points["Z"] = np.round(rng.uniform(0, 5, n_points), 2)
+    spatial_index = TileSpatialIndex(cell_size=cell_size)
+
+    # Successive clusterings of different subsets of points, with the same index.
+    for tolerance, min_points, is3d in [(0.5, 10, True), (0.3, 10, False), (0.75, 20, False)]:
+        mask = rng.random(n_points) < 0.7
+        labels = spatial_index.get_cluster_labels(points, mask, tolerance, min_points, is3d=is3d)
+
+        dims = ["X", "Y", "Z"] if is3d else ["X", "Y"]
+        coordinates = np.column_stack([points[dim][mask] for dim in dims])
+        expected_labels = np.zeros(n_points, dtype=np.uint64)
+        expected_labels[mask] = get_cluster_labels(coordinates, tolerance, min_points)
+        assert np.array_equal(labels, expected_labels)
+
+
+def test_tile_spatial_index_rejects_other_points():
+    points = np.zeros(10, dtype=[("X", "f8"), ("Y", "f8"), ("Z", "f8")])
+    spatial_index = TileSpatialIndex()
+    spatial_index.get_cluster_labels(points, np.ones(10, dtype=bool), 0.5, 1)
+    with pytest.raises(ValueError):
+        spatial_index.get_cluster_labels(points[:5], np.ones(5, dtype=bool), 0.5, 1)
+
+
+def test_grid_engine_matches_pdal_clustering(hydra_cfg):
+    input_las_path = "tests/files/870000_6618000.subset.postCompletion.laz"
+    bi_cfg = hydra_cfg.building_identification
+    dim_cluster_id = hydra_cfg.data_format.las_dimensions.ai_building_identified
+
+    cluster_ids = {}
+    for engine in ["pdal", "grid"]:
+        bi_cfg.cluster.engine = engine
+        bi = BuildingIdentifier(
+            min_building_proba=bi_cfg.min_building_proba,
+            cluster=bi_cfg.cluster,
+            data_format=hydra_cfg.data_format,
+        )
+        bi.run(input_las_path)
+        cluster_ids[engine] = bi.pipeline.arrays[0][dim_cluster_id]
+
+    assert cluster_ids["pdal"].max() > 1
+    assert np.array_equal(cluster_ids["grid"], cluster_ids["pdal"])
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import shapely
+
+from lidar_prod.tasks.overlay import (
+    BOUNDARY,
+    INSIDE,
+    OUTSIDE,
+    overlay_points,
+    overlay_points_with_raster,
+    prune_geometries,
+    rasterize_geometries,
+)
+
+POLYGONS = np.array(
+    [
+        shapely.box(0, 0, 10, 10),
+        shapely.Polygon([(20, 0), (30, 0), (25, 10)]),
+        # polygon with a hole
+        shapely.Polygon(
+            [(40, 0), (50, 0), (50, 10), (40, 10)], holes=[[(42, 2), (48, 2), (48, 8), (42, 8)]]
+        ),
+    ]
+)
+
+
+@pytest.mark.parametrize("n_threads", [1, 4])
+def test_overlay_points_matches_covers(n_threads):
+    rng = np.random.default_rng(0)
+    # Quantized coordinates, to have points on boundaries.
+    x = np.round(rng.uniform(-5, 55, size=20_000), 1)
+    y = np.round(rng.uniform(-5, 15, size=20_000), 1)
+
+    flags = overlay_points(x, y, POLYGONS, n_threads=n_threads, chunk_size=1000)
+
+    points = shapely.points(x, y)
+    expected_flags = np.any([shapely.covers(polygon, points) for polygon in POLYGONS], axis=0)
+    assert np.array_equal(flags, expected_flags)
+    # Make sure that boundaries and holes are exercised.
+    assert np.any(flags & (x == 10))
+    assert not np.any(flags & (x > 42) & (x < 48) & (y > 2) & (y < 8))
+
+
+def test_overlay_points_without_points_or_geometries():
+    assert len(overlay_points(np.array([]), np.array([]), POLYGONS)) == 0
+    assert not np.any(overlay_points(np.array([5.0]), np.array([5.0]), POLYGONS[:0]))
+
+
+def test_prune_geometries():
+    bboxes = np.array([[-5, -5, 1, 1], [45, 5, 46, 6]])
+    assert list(prune_geometries(POLYGONS, bboxes)) == [POLYGONS[0], POLYGONS[2]]
+    assert len(prune_geometries(POLYGONS, np.empty((0, 4)))) == 0
+
+
+@pytest.mark.parametrize("cell_size", [0.1, 0.5, 0.7, 3.0])
+def test_overlay_points_with_raster_matches_exact_overlay(cell_size):
+    rng = np.random.default_rng(0)
+    # Quantized coordinates, to have points on boundaries and on edges of cells.
+    x = np.round(rng.uniform(-5, 55, size=20_000), 1)
+    y = np.round(rng.uniform(-5, 15, size=20_000), 1)
+
+    flags = overlay_points_with_raster(x, y, POLYGONS, cell_size=cell_size)
+
+    assert np.array_equal(flags, overlay_points(x, y, POLYGONS))
+
+
+def test_rasterize_geometries():
+    raster = rasterize_geometries(POLYGONS[:1], origin=(-5, -5), shape=(20, 20), cell_size=1)
+    # The box from 0 to 10 has its boundary in columns/rows 5 and 15, which are dilated by a cell.
+    assert np.all(raster[7:14, 7:14] == INSIDE)
+    assert np.all(raster[4:17, [4, 5, 6, 14, 15, 16]] == BOUNDARY)
+    assert np.all(raster[[4, 5, 6, 14, 15, 16], 4:17] == BOUNDARY)
+    assert np.all(raster[:, :4] == OUTSIDE)
+    assert np.all(raster[17:, :] == OUTSIDE)
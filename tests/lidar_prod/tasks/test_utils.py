@@ -7,10 +7,16 @@ import pdal
 import pytest
 
 from lidar_prod.tasks.utils import (
+    ClusterIndex,
+    IncrementalPipeline,
+    SortedSegments,
+    add_typed_dimensions,
+    bbox_intersects_envelope,
     check_bbox_intersects_territoire_with_srid,
+    get_input_las_metadata,
     get_pdal_writer,
+    get_pipeline,
     request_bd_uni_for_building_shapefile,
-    split_idx_by_dim,
 )
 
 TMP_DIR = Path("tmp/lidar_prod/tasks/utils")
@@ -39,38 +45,47 @@ def create_synthetic_las_data_within_bounds(synthetic_las_path: str, bbox) -> No
     pipeline.execute()
 
 
-def test_split_idx_by_dim():
-    d1 = [1, 1, 2, 3]
-    d2 = [10, 10, 20, 30]
-    dim_array = np.array([d1, d2]).transpose()
+def test_cluster_index():
+    labels = np.array([3, 0, 1, 3, 0, 7, 1, 3])
+    values = np.array([1.0, 100.0, 2.0, 3.0, 100.0, 4.0, 6.0, 5.0])
+    index = ClusterIndex(labels)
 
-    group_idx = split_idx_by_dim(dim_array[:, 0])
-    expected_groups = [np.array([0, 1]), np.array([2]), np.array([3])]
-    expected_values = [np.array([10, 10]), np.array([20]), np.array([30])]
+    assert len(index) == 3
+    assert np.array_equal(index.labels, [1, 3, 7])
+    assert np.array_equal(index.sizes, [2, 3, 1])
+    expected_groups = [np.array([2, 6]), np.array([0, 3, 7]), np.array([5])]
+    for i, group in enumerate(expected_groups):
+        assert np.array_equal(index.indices(i), group)
+    # Points with the background label are ignored by reductions.
+    assert np.array_equal(index.segment_sum(values), [8.0, 9.0, 4.0])
+    assert np.array_equal(index.segment_mean(values), [4.0, 3.0, 4.0])
+    assert np.array_equal(index.segment_mean(values > 2), [0.5, 2 / 3, 1.0])
+    assert np.array_equal(index.segment_min(values), [2.0, 1.0, 4.0])
+    assert np.array_equal(index.segment_max(values), [6.0, 5.0, 4.0])
+    assert np.array_equal(index.broadcast(index.labels), labels[labels != 0])
 
-    assert len(group_idx) == 3
-    for i, group in enumerate(group_idx):
-        assert np.array_equal(group, expected_groups[i])
-        assert np.array_equal(dim_array[group, 1], expected_values[i])
 
+def test_cluster_index_without_clusters():
+    index = ClusterIndex(np.zeros(5))
 
-def test_split_idx_by_dim_unordered():
-    """
-    This also works if split dimension is not sorted.
-    The expected values are still sorted.
-    """
-    d1 = [1, 3, 2, 1]
-    d2 = [10, 30, 20, 10]
-    dim_array = np.array([d1, d2]).transpose()
+    assert len(index) == 0
+    assert len(index.segment_sum(np.ones(5))) == 0
+    assert len(index.segment_min(np.ones(5))) == 0
+    assert len(index.broadcast(np.array([]))) == 0
 
-    group_idx = split_idx_by_dim(dim_array[:, 0])
-    expected_groups = [np.array([0, 3]), np.array([2]), np.array([1])]
-    expected_values = [np.array([10, 10]), np.array([20]), np.array([30])]
 
-    assert len(group_idx) == 3
-    for i, group in enumerate(group_idx):
-        assert np.array_equal(group, expected_groups[i])
-        assert np.array_equal(dim_array[group, 1], expected_values[i])
+@pytest.mark.parametrize(
+    "bbox,envelope,expected_result",
+    [
+        ({"x_min": 0, "y_min": 0, "x_max": 10, "y_max": 10}, (5, 5, 20, 20), True),
+        ({"x_min": 0, "y_min": 0, "x_max": 10, "y_max": 10}, (10, 10, 20, 20), True),  # touches
+        ({"x_min": 0, "y_min": 0, "x_max": 10, "y_max": 10}, (11, 0, 20, 20), False),
+        ({"x_min": 0, "y_min": 0, "x_max": 10, "y_max": 10}, (0, 11, 20, 20), False),
+        ({"x_min": 0, "y_min": 0, "x_max": 10, "y_max": 10}, None, False),  # no territory
+    ],
+)
+def test_bbox_intersects_envelope(bbox, envelope, expected_result):
+    assert bbox_intersects_envelope(bbox, envelope) == expected_result
 
 
 @pytest.mark.parametrize(
@@ -155,3 +170,64 @@ def test_request_bd_uni_for_building_shapefile_fail(hydra_cfg):
             bbox=dict(x_min=515000, y_min=1981000, x_max=515100, y_max=1981100),
             epsg=2154,
         )
+
+
+def test_incremental_pipeline():
+    las_path = "tests/files/870000_6618000.subset.postIA.las"
+    pipeline, las_metadata = get_pipeline(las_path, 2154)
+    assert isinstance(pipeline, IncrementalPipeline)
+    assert get_input_las_metadata(pipeline) == las_metadata
+    points = pipeline.arrays[0]
+
+    pipeline |= pdal.Filter.ferry(dimensions="=>Counter")
+    pipeline |= pdal.Filter.assign(value="Counter = Counter + 1")
+    with pytest.raises(RuntimeError):
+        pipeline.arrays
+    pipeline.execute()
+    # Only the new stage is executed, on the points computed by previous stages.
+    pipeline |= pdal.Filter.assign(value="Counter = Counter + 1")
+    pipeline.execute()
+
+    result = pipeline.arrays[0]
+    assert np.all(result["Counter"] == 2)
+    assert np.array_equal(result["X"], points["X"])
+    # arrays are copies, as with pdal.
+    result["Counter"] = 0
+    assert np.all(pipeline.arrays[0]["Counter"] == 2)
+
+
+def test_add_typed_dimensions():
+    points = np.zeros(3, dtype=[("X", "f8"), ("Flag", "f8")])
+    points["X"] = [1, 2, 3]
+    input_pipeline = IncrementalPipeline([points])
+    pipeline = add_typed_dimensions(input_pipeline, {"Flag": np.uint8, "ClusterId": np.uint32})
+    # Points are moved out of the input pipeline.
+    assert input_pipeline.execute() == 0
+    typed_points = pipeline.arrays[0]
+    assert typed_points.dtype.names == ("X", "Flag", "ClusterId")
+    # Existing dimensions keep their type and values.
+    assert typed_points.dtype["Flag"] == np.float64
+    assert typed_points.dtype["ClusterId"] == np.uint32
+    assert np.array_equal(typed_points["X"], points["X"])
+    assert np.all(typed_points["ClusterId"] == 0)
+
+    # Points that already have the dimensions are not copied.
+    assert add_typed_dimensions(pipeline, {"ClusterId": np.uint8}) is pipeline
+    assert pipeline._arrays[0].dtype["ClusterId"] == np.uint32
+
+
+def test_sorted_segments():
+    rng = np.random.default_rng(0)
+    sizes = rng.integers(0, 20, size=500)
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    values = np.round(rng.normal(size=offsets[-1]), 1).astype(np.float32)
+    values[::7] = -0.0
+    segments = SortedSegments(values, offsets)
+    segment_idx = np.repeat(np.arange(len(sizes)), sizes)
+
+    # Thresholds on values, between values, out of range, and rounded when cast to float32.
+    for threshold in [0.0, -0.0, 0.1, np.float64(0.1), 0.15, -3.5, 10.0, 0.1 + 1e-9]:
+        expected_counts = np.bincount(
+            segment_idx, weights=values >= threshold, minlength=len(sizes)
+        )
+        assert np.array_equal(segments.count_greater_equal(threshold), expected_counts)
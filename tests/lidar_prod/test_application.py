@@ -9,14 +9,23 @@ import pdal
 import pytest
 from omegaconf import open_dict
 
+from lidar_prod import application
 from lidar_prod.application import (
+    TASKS_CONFIG_SECTIONS,
     apply,
     apply_building_module,
+    get_result_cache,
     get_shapefile,
     identify_vegetation_unclassified,
+    invalidate_cache,
     just_clean,
 )
-from lidar_prod.tasks.utils import get_a_las_to_las_pdal_pipeline, get_las_data_from_las
+from lidar_prod.tasks.bd_uni_prefetch import BDUniPrefetch, get_prefetched_buildings
+from lidar_prod.tasks.utils import (
+    get_a_las_to_las_pdal_pipeline,
+    get_las_data_from_las,
+    pdal_read_las_array,
+)
 from tests.conftest import (
     check_expected_classification,
     check_las_contains_dims,
@@ -111,6 +120,61 @@ def test_application_data_invariance_and_data_format(
     )
 
 
+def test_application_in_memory_matches_file_based(hydra_cfg):
+    """The in-memory building module gives the same classification as the file-based one."""
+    out_dir = TMP_DIR / "application_in_memory"
+    out_dir.mkdir(parents=True)
+    hydra_cfg.building_validation.application.shp_path = SHAPE_FILE
+
+    file_based_las_path = str(out_dir / "file_based.las")
+    apply_building_module(hydra_cfg, LAS_SUBSET_FILE_BUILDING, file_based_las_path)
+    hydra_cfg.application.in_memory = True
+    in_memory_las_path = str(out_dir / "in_memory.las")
+    apply_building_module(hydra_cfg, LAS_SUBSET_FILE_BUILDING, in_memory_las_path)
+
+    check_las_invariance(file_based_las_path, in_memory_las_path, hydra_cfg.data_format.epsg)
+    _fc = hydra_cfg.data_format.codes.building.final
+    check_format_of_application_output_las(
+        in_memory_las_path,
+        hydra_cfg.data_format.epsg,
+        {1, 2, _fc.building, _fc.not_building, _fc.unsure},
+    )
+    file_based_points, _ = pdal_read_las_array(file_based_las_path, hydra_cfg.data_format.epsg)
+    in_memory_points, _ = pdal_read_las_array(in_memory_las_path, hydra_cfg.data_format.epsg)
+    assert file_based_points.dtype.names == in_memory_points.dtype.names
+    for dim in ["Classification", "Group"]:
+        assert np.array_equal(
+            np.unique(file_based_points[dim], return_counts=True),
+            np.unique(in_memory_points[dim], return_counts=True),
+        )
+
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_application_with_grid_clustering_matches_pdal_clustering(hydra_cfg, in_memory):
+    """Grid clusterings sharing a spatial index give the same output as pdal clusterings."""
+    out_dir = TMP_DIR / f"application_grid_clustering_{in_memory}"
+    out_dir.mkdir(parents=True)
+    hydra_cfg.building_validation.application.shp_path = SHAPE_FILE
+    hydra_cfg.application.in_memory = in_memory
+
+    pdal_las_path = str(out_dir / "pdal.las")
+    apply_building_module(hydra_cfg, LAS_SUBSET_FILE_BUILDING, pdal_las_path)
+    for cluster in [
+        hydra_cfg.building_validation.application.cluster,
+        hydra_cfg.building_completion.cluster,
+        hydra_cfg.building_identification.cluster,
+    ]:
+        cluster.engine = "grid"
+    grid_las_path = str(out_dir / "grid.las")
+    apply_building_module(hydra_cfg, LAS_SUBSET_FILE_BUILDING, grid_las_path)
+
+    pdal_points, _ = pdal_read_las_array(pdal_las_path, hydra_cfg.data_format.epsg)
+    grid_points, _ = pdal_read_las_array(grid_las_path, hydra_cfg.data_format.epsg)
+    assert pdal_points.dtype.names == grid_points.dtype.names
+    for dim in ["Classification", "Group"]:
+        assert np.array_equal(pdal_points[dim], grid_points[dim])
+
+
 def check_format_of_application_output_las(
     output_las_path: str, epsg: int | str, expected_codes: dict
 ):
@@ -196,6 +260,195 @@ def test_applying(vegetation_unclassifed_hydra_cfg, path, expected):
     apply(vegetation_unclassifed_hydra_cfg, dummy_method)
 
 
+def fail_on_first_dummy_file(config, src_las_path, target_las_path):
+    """Module-level logic, so that it can be sent to worker processes."""
+    if os.path.basename(src_las_path) == "dummy_file1.las":
+        raise ValueError("Simulated failure on a tile.")
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_applying_isolates_failed_tiles(vegetation_unclassifed_hydra_cfg, n_workers):
+    cfg = vegetation_unclassifed_hydra_cfg
+    cfg.paths.src_las = DUMMY_DIRECTORY_PATH
+    cfg.application.n_workers = n_workers
+    with tempfile.TemporaryDirectory() as td:
+        cfg.paths.output_dir = td
+
+        # by default, failures are raised once every tile was processed
+        with pytest.raises(RuntimeError, match="dummy_file1.las"):
+            apply(cfg, fail_on_first_dummy_file)
+
+        # the other tiles are still processed
+        cfg.application.ignore_failures = True
+        applied_file_list = apply(cfg, fail_on_first_dummy_file)
+        assert applied_file_list == [os.path.join(td, "dummy_file2.las")]
+
+
+def kill_worker_on_dead_tile(config, src_las_path, target_las_path):
+    """Module-level logic whose worker process dies on a tile, e.g. killed by the OOM killer."""
+    if os.path.basename(src_las_path) == config.dead_tile:
+        os._exit(1)
+
+
+@pytest.mark.parametrize("dead_tile", ["dummy_file1.las", "dummy_file2.las"])
+def test_applying_isolates_dead_workers(vegetation_unclassifed_hydra_cfg, dead_tile):
+    cfg = vegetation_unclassifed_hydra_cfg
+    cfg.paths.src_las = DUMMY_DIRECTORY_PATH
+    cfg.application.n_workers = 2
+    with open_dict(cfg):
+        cfg.dead_tile = dead_tile
+    with tempfile.TemporaryDirectory() as td:
+        cfg.paths.output_dir = td
+        # Only the tile whose worker died fails, whatever the order of results.
+        with pytest.raises(RuntimeError, match=f"^1 tile.*{dead_tile}$"):
+            apply(cfg, kill_worker_on_dead_tile)
+
+        cfg.application.ignore_failures = True
+        applied_file_list = apply(cfg, kill_worker_on_dead_tile)
+        assert len(applied_file_list) == 1
+        assert os.path.basename(applied_file_list[0]) != dead_tile
+
+
+def test_applying_in_parallel_keeps_order(vegetation_unclassifed_hydra_cfg):
+    cfg = vegetation_unclassifed_hydra_cfg
+    cfg.paths.src_las = DUMMY_DIRECTORY_PATH
+    cfg.application.n_workers = 2
+    with tempfile.TemporaryDirectory() as td:
+        cfg.paths.output_dir = td
+        applied_file_list = apply(cfg, just_clean_nothing)
+    assert [os.path.basename(p) for p in applied_file_list] == [
+        "dummy_file1.las",
+        "dummy_file2.las",
+    ]
+
+
+def just_clean_nothing(config, src_las_path, target_las_path):
+    """Module-level logic that does nothing, so that it can be sent to worker processes."""
+    pass
+
+
+def write_empty_target(config, src_las_path, target_las_path):
+    """Module-level logic that creates an empty target file."""
+    open(target_las_path, "w").close()
+
+
+def test_applying_skips_cached_tiles(vegetation_unclassifed_hydra_cfg, monkeypatch):
+    cfg = vegetation_unclassifed_hydra_cfg
+    cfg.paths.src_las = DUMMY_DIRECTORY_PATH
+    cfg.application.cache.enabled = True
+    # dummy logics are cached under the same name, as if they were the same task
+    for logic in [write_empty_target, fail_on_first_dummy_file]:
+        monkeypatch.setattr(logic, "__name__", "dummy_task")
+    monkeypatch.setitem(TASKS_CONFIG_SECTIONS, "dummy_task", ["data_format"])
+
+    with tempfile.TemporaryDirectory() as td:
+        cfg.paths.output_dir = td
+        first_applied_file_list = apply(cfg, write_empty_target)
+        assert len(first_applied_file_list) == 2
+
+        # tiles are up to date: the logic is not called anymore
+        assert apply(cfg, fail_on_first_dummy_file) == first_applied_file_list
+
+        # a change in config sections used by the task invalidates the cache
+        cfg.data_format.epsg = 2975
+        with pytest.raises(RuntimeError, match="dummy_file1.las"):
+            apply(cfg, fail_on_first_dummy_file)
+
+        # invalidation forces the processing of tiles
+        cfg.data_format.epsg = 2154
+        invalidate_cache(cfg)
+        with pytest.raises(RuntimeError, match="dummy_file1.las"):
+            apply(cfg, fail_on_first_dummy_file)
+
+
+def write_target_and_fail_with_epsg_2975(config, src_las_path, target_las_path):
+    """Module-level logic that fails while writing its target with epsg 2975."""
+    with open(target_las_path, "w") as f:
+        f.write(f"{config.data_format.epsg}")
+        if config.data_format.epsg == 2975:
+            raise ValueError("Simulated failure while writing a tile.")
+        f.write(" complete")
+
+
+def test_applying_does_not_skip_targets_left_incomplete(
+    vegetation_unclassifed_hydra_cfg, monkeypatch
+):
+    cfg = vegetation_unclassifed_hydra_cfg
+    cfg.paths.src_las = DUMMY_FILE_PATH
+    cfg.application.cache.enabled = True
+    monkeypatch.setitem(
+        TASKS_CONFIG_SECTIONS, write_target_and_fail_with_epsg_2975.__name__, ["data_format"]
+    )
+
+    with tempfile.TemporaryDirectory() as td:
+        cfg.paths.output_dir = td
+        target_las_path = os.path.join(td, "dummy_file1.las")
+        cfg.data_format.epsg = 2154
+        apply(cfg, write_target_and_fail_with_epsg_2975)
+
+        # a run with another config fails while overwriting the target
+        cfg.data_format.epsg = 2975
+        with pytest.raises(RuntimeError, match="dummy_file1.las"):
+            apply(cfg, write_target_and_fail_with_epsg_2975)
+
+        # the target of the first config is not up to date anymore, and is computed again
+        cfg.data_format.epsg = 2154
+        apply(cfg, write_target_and_fail_with_epsg_2975)
+        with open(target_las_path) as f:
+            assert f.read() == "2154 complete"
+
+
+def test_result_cache_key_ignores_execution_config(hydra_cfg):
+    cfg = hydra_cfg
+    cfg.application.cache.enabled = True
+    with tempfile.TemporaryDirectory() as td:
+        cfg.paths.output_dir = td
+        _, config_hash = get_result_cache(cfg, apply_building_module)
+        bv_cfg = cfg.building_validation.application
+        bv_cfg.bd_uni_request.cache.path = os.path.join(td, "another_account_cache.sqlite")
+        bv_cfg.bd_uni_request.cache.ttl = 1
+        bv_cfg.bd_uni_request.prefetch.enabled = True
+        bv_cfg.cluster.n_threads = 4
+        bv_cfg.overlay.n_threads = 4
+        cfg.building_completion.cluster.n_threads = 4
+        cfg.building_identification.cluster.n_threads = 4
+        assert get_result_cache(cfg, apply_building_module)[1] == config_hash
+
+        # parameters of the results are still part of the key
+        bv_cfg.cluster.tolerance = 1.0
+        assert get_result_cache(cfg, apply_building_module)[1] != config_hash
+
+
+def fail_without_prefetched_buildings(config, src_las_path, target_las_path):
+    """Module-level logic that checks that prefetched BD Uni buildings are available."""
+    if get_prefetched_buildings() is None:
+        raise ValueError("BD Uni buildings were not prefetched.")
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_applying_with_prefetched_buildings(
+    vegetation_unclassifed_hydra_cfg, monkeypatch, n_workers
+):
+    cfg = vegetation_unclassifed_hydra_cfg
+    cfg.paths.src_las = DUMMY_DIRECTORY_PATH
+    cfg.application.n_workers = n_workers
+    prefetched_buildings = BDUniPrefetch(
+        geopandas.GeoDataFrame(geometry=[], crs="EPSG:2154"), [], 2154
+    )
+    monkeypatch.setattr(
+        application,
+        "prefetch_bd_uni_buildings_for_tiles",
+        lambda config, src_las_paths: prefetched_buildings,
+    )
+    monkeypatch.setattr(application, "BD_UNI_TASKS", ["fail_without_prefetched_buildings"])
+
+    with tempfile.TemporaryDirectory() as td:
+        cfg.paths.output_dir = td
+        assert len(apply(cfg, fail_without_prefetched_buildings)) == 2
+    # Prefetched buildings are only available during apply
+    assert get_prefetched_buildings() is None
+
+
 def test_get_shapefile(hydra_cfg):
     destination_path = tempfile.NamedTemporaryFile().name
     get_shapefile(hydra_cfg, LAS_SUBSET_FILE_BUILDING, destination_path)